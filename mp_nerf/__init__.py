@@ -1,2 +1,4 @@
 from mp_nerf.massive_pnerf import *
-from mp_nerf.proteins import *
\ No newline at end of file
+from mp_nerf.proteins import *
+from mp_nerf.workspace import *
+from mp_nerf.incremental import *
\ No newline at end of file
@@ -0,0 +1,193 @@
+import numpy as np
+# diff / ml
+import torch
+# module
+from mp_nerf.massive_pnerf import *
+from mp_nerf.proteins import *
+
+
+def compose_transforms(first, second):
+    """ Composes rigid transforms in the row convention x -> x @ R + t.
+        Inputs:
+        * first: tuple of (..., 3, 3) rotations and (..., 3) translations
+        * second: same. applied before `first`
+        Outputs: (R, t) of x -> first(second(x))
+    """
+    rot = torch.matmul(second[0], first[0])
+    return rot, torch.matmul(second[1].unsqueeze(-2), first[0]).squeeze(-2) + first[1]
+
+
+class IncrementalFold(object):
+    """ Folded protein that can be updated after changes in a few residues
+        without refolding from scratch. Keeps the local frame of every residue
+        and a segment tree of the composed residue-to-residue transforms, so
+        changing residue i costs O(log L) compositions plus one rigid
+        transform of the downstream coords and re-placing the sidechain of i.
+        Meant for Monte Carlo / design loops. Inference only (no autograd).
+        Inputs: same as `protein_fold`.
+        * cloud_mask: (L, 14) mask of points that should be converted to coords
+        * point_ref_mask: (3, L, 11) maps point (except n-ca-c) to idxs of
+                                     previous 3 points in the coords array
+        * angles_mask: (2, L, 14) maps point to theta and dihedral
+        * bond_mask: (L, 14) gives the length of the bond originating that atom
+        * validate: None or one of ["strict", "warn-once", "off"]. see `validate_thetas`
+    """
+    def __init__(self, cloud_mask, point_ref_mask, angles_mask, bond_mask, validate=None):
+        self.cloud_mask     = cloud_mask
+        self.point_ref_mask = point_ref_mask
+        self.angles_mask    = angles_mask.detach().clone()
+        self.bond_mask      = bond_mask.detach()
+        self.validate       = validate
+        self.length  = cloud_mask.shape[0]
+        self.size    = 1 << max(self.length - 1, 1).bit_length()
+        kwargs = {"dtype": bond_mask.dtype, "device": bond_mask.device}
+        self.depth   = self.size.bit_length()
+        self.residues = torch.arange(self.length, device=bond_mask.device)
+        # segment tree of the steps residue i+1 -> residue i. node 1 is the root,
+        # unused node 0 and the padding are identities
+        self.tree_rot   = torch.eye(3, **kwargs).repeat(2 * self.size, 1, 1)
+        self.tree_trans = torch.zeros(2 * self.size, 3, **kwargs)
+        # nodes covering the steps 0, ..., i-1 of each residue (0 if none at that size)
+        self.prefix_nodes = torch.zeros(self.length, self.depth, dtype=torch.long,
+                                        device=bond_mask.device)
+        start = torch.zeros_like(self.residues)
+        for k, bit in enumerate(reversed(range(self.depth))):
+            take = (self.residues >> bit) & 1
+            self.prefix_nodes[:, k] = take * ((self.size >> bit) + (start >> bit))
+            start = start + (take << bit)
+        # sidechain gathers and the residue each placed atom belongs to
+        self.level_idxs = sidechain_dag_idxs(cloud_mask, point_ref_mask)
+        self.level_res  = [gather[0] // 14 for gather in self.level_idxs]
+        with torch.no_grad():
+            self.fold()
+
+
+    def steps(self, residues):
+        """ Builds the local backbone of the residues and the transform
+            that takes the local frame of the next residue into theirs.
+            Inputs:
+            * residues: (K,) long tensor. idxs of the residues
+            Outputs: (K, 4, 3) local backbones, (K, 3, 3) rotations, (K, 3) translations
+        """
+        backbone = backbone_fragments(self.angles_mask[:, residues].unsqueeze(0),
+                                      self.bond_mask[residues].unsqueeze(0), first=False)[0]
+        if residues[0] == 0:
+            # 1st residue starts the chain: N in the origin, CA and C in the x,y plane
+            backbone[0] = backbone_fragments(self.angles_mask[:, :1].unsqueeze(0),
+                                             self.bond_mask[:1].unsqueeze(0))[0, 0]
+        return backbone, backbone_rotations(backbone.unsqueeze(0))[0], backbone[:, 3]
+
+
+    def prefix(self, residues):
+        """ Composed transform from the local frame of each residue
+            to the global one (composition of the steps 0, ..., i-1).
+            Inputs:
+            * residues: (K,) long tensor. idxs of the residues
+            Outputs: (K, 3, 3) rotations, (K, 3) translations
+        """
+        nodes = self.prefix_nodes[residues]
+        rot, trans = self.tree_rot[nodes], self.tree_trans[nodes]
+        # reduce the nodes pairwise: log(log L) batched compositions
+        while rot.shape[1] > 1:
+            if rot.shape[1] % 2:
+                rot   = torch.cat([rot, self.tree_rot[:1].expand(rot.shape[0], 1, 3, 3)], dim=1)
+                trans = torch.cat([trans, self.tree_trans[:1].expand(trans.shape[0], 1, 3)], dim=1)
+            rot, trans = compose_transforms((rot[:, 0::2], trans[:, 0::2]),
+                                            (rot[:, 1::2], trans[:, 1::2]))
+        return rot[:, 0], trans[:, 0]
+
+
+    def set_steps(self, residues, rotations, translations):
+        """ Writes the steps of the residues in the leaves of the segment tree
+            and recomposes their ancestors.
+            Inputs:
+            * residues: (K,) long tensor. idxs of the residues
+            * rotations: (K, 3, 3) rotations of the steps
+            * translations: (K, 3) translations of the steps
+        """
+        nodes = residues + self.size
+        self.tree_rot[nodes], self.tree_trans[nodes] = rotations, translations
+        # repeated ancestors get the same value written twice
+        for _ in range(self.depth - 1):
+            nodes = nodes >> 1
+            self.tree_rot[nodes], self.tree_trans[nodes] = compose_transforms(
+                (self.tree_rot[2*nodes], self.tree_trans[2*nodes]),
+                (self.tree_rot[2*nodes+1], self.tree_trans[2*nodes+1])
+            )
+
+
+    def place(self, residues, backbone, rot, trans):
+        """ Places the backbone and sidechains of the residues given their
+            local backbones and frames. The rest of the coords must be in place.
+            Inputs:
+            * residues: (K,) long tensor. idxs of the residues
+            * backbone: (K, 4, 3) local backbones, as returned by `steps`
+            * rot, trans: (K, 3, 3) and (K, 3) frames, as returned by `prefix`
+        """
+        self.coords[residues, :4] = torch.matmul(backbone, rot) + trans.unsqueeze(-2)
+        # parallel sidechain - only the atoms of the residues
+        placed = torch.zeros(self.length, dtype=torch.bool, device=residues.device)
+        placed[residues] = True
+        level_idxs = [gather[:, placed[res]] for gather, res in zip(self.level_idxs, self.level_res)]
+        sidechain_fold_batch(self.coords.unsqueeze(0), self.cloud_mask.unsqueeze(0),
+                             self.point_ref_mask.unsqueeze(0), self.angles_mask.unsqueeze(0),
+                             self.bond_mask.unsqueeze(0), validate="off",
+                             level_idxs=[gather for gather in level_idxs if gather.shape[1]])
+
+
+    def fold(self):
+        """ Folds the whole protein and (re)builds the segment tree.
+            Outputs: (L, 14, 3) coords
+        """
+        validate_thetas(self.angles_mask[0], validate=self.validate)
+        backbone, rotations, translations = self.steps(self.residues)
+        self.tree_rot[self.size:self.size+self.length] = rotations
+        self.tree_trans[self.size:self.size+self.length] = translations
+        # build bottom-up, one level at a time
+        level = self.size // 2
+        while level:
+            nodes = torch.arange(level, 2 * level, device=self.residues.device)
+            self.tree_rot[nodes], self.tree_trans[nodes] = compose_transforms(
+                (self.tree_rot[2*nodes], self.tree_trans[2*nodes]),
+                (self.tree_rot[2*nodes+1], self.tree_trans[2*nodes+1])
+            )
+            level //= 2
+        self.coords = torch.zeros(self.length, 14, 3, dtype=self.bond_mask.dtype,
+                                  device=self.bond_mask.device)
+        self.place(self.residues, backbone, *self.prefix(self.residues))
+        return self.coords
+
+
+    @torch.no_grad()
+    def update(self, residues, angles):
+        """ Sets the angles of some residues and updates the coords.
+            Inputs:
+            * residues: int or (K,) idxs of the residues to change
+            * angles: (2, 14) or (2, K, 14). new thetas and dihedrals of the residues
+            Outputs: (L, 14, 3) coords
+        """
+        residues = torch.as_tensor(residues, device=self.bond_mask.device).view(-1)
+        residues, order = torch.sort(residues)
+        angles = angles.view(2, -1, 14)[:, order]
+        validate_thetas(angles[0], validate=self.validate)
+        self.angles_mask[:, residues] = angles.to(self.angles_mask)
+
+        # downstream of each changed residue moves rigidly: old frame -> new frame
+        after = (residues + 1).clamp(max=self.length - 1)
+        old_rot, old_trans = self.prefix(after)
+        backbone, rotations, translations = self.steps(residues)
+        self.set_steps(residues, rotations, translations)
+        new_rot, new_trans = self.prefix(torch.cat([after, residues]))
+        # (old)^-1 then new
+        delta_rot   = torch.matmul(old_rot.transpose(-1, -2), new_rot[:len(after)])
+        delta_trans = new_trans[:len(after)] - \
+                      torch.matmul(old_trans.unsqueeze(-2), delta_rot).squeeze(-2)
+
+        first   = residues[0].item()
+        segment = torch.bucketize(self.residues[first:], residues, right=True) - 1
+        # padding atoms stay in the origin
+        self.coords[first:] = (torch.matmul(self.coords[first:], delta_rot[segment]) + \
+                               delta_trans[segment].unsqueeze(-2)) * \
+                              self.cloud_mask[first:].unsqueeze(-1)
+        self.place(residues, backbone, new_rot[len(after):], new_trans[len(after):])
+        return self.coords
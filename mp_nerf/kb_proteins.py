@@ -25,6 +25,7 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
 # THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from collections.abc import Mapping
 import numpy as np
 
 #########################
@@ -735,12 +736,41 @@ FF = {"MIN_DISTS": {1: 1.180, # shortest =N or =O bond
       "MAX_DISTS": {i: 1.840*i for i in range(1, 5+1)} # 1.84 is longest -S bond found,
      } 
 
-ATOM_TOKEN_IDS = set(["", "N", "CA", "C", "O"])
-ATOM_TOKEN_IDS = {k: i for i,k in enumerate(sorted( 
-                    ATOM_TOKEN_IDS.union( set(
-                        [name for k,v in SC_BUILD_INFO.items() for name in v["atom-names"]]
-                    ) )
-                ))}
+class LazyTable(Mapping):
+    """ Read-only mapping whose contents are built by `builder` on first access,
+        so importing the module doesn't pay for tables that are never used.
+        Note SUPREME_INFO, SUPREME_TABLES and ATOM_TOKEN_IDS are LazyTables, 
+        not dicts: they can't be modified in place. `dict(table)` gives a copy.
+    """
+    def __init__(self, builder):
+        self.builder = builder
+        self.data    = None
+
+    def get_data(self):
+        if self.data is None:
+            self.data = self.builder()
+        return self.data
+
+    def __getitem__(self, key):
+        return self.get_data()[key]
+
+    def __iter__(self):
+        return iter(self.get_data())
+
+    def __len__(self):
+        return len(self.get_data())
+
+    def __repr__(self):
+        return "LazyTable({0})".format(self.builder.__name__ if self.data is None else self.data)
+
+
+def build_atom_token_ids():
+    """ Maps atom names to token ids (sorted names, "" is the padding). """
+    names = set(["", "N", "CA", "C", "O"])
+    names = names.union( set([name for k,v in SC_BUILD_INFO.items() for name in v["atom-names"]]) )
+    return {k: i for i,k in enumerate(sorted(names))}
+
+ATOM_TOKEN_IDS = LazyTable(build_atom_token_ids)
 
 #################
 ##### DOERS #####
@@ -837,14 +867,42 @@ def make_atom_token_mask(aa):
 ###################
 INDEX2AAS = "ACDEFGHIKLMNPQRSTVWY_"
 AAS2INDEX = {aa:i for i,aa in enumerate(INDEX2AAS)}
-SUPREME_INFO = {k: {"cloud_mask": make_cloud_mask(k),
-                    "bond_mask": make_bond_mask(k),
-                    "theta_mask": make_theta_mask(k),
-                    "torsion_mask": make_torsion_mask(k),
-                    "torsion_mask_filled": make_torsion_mask(k, fill=True),
-                    "idx_mask": make_idx_mask(k),
-                    "atom_token_mask": make_atom_token_mask(k),
-                    "rigid_idx_mask": SC_BUILD_INFO[k]['rigid-frames-idxs'],
-                    } 
-                for k in INDEX2AAS}
+
+
+def build_supreme_info():
+    """ Per-aa masks and idxs, for every aa in INDEX2AAS. """
+    return {k: {"cloud_mask": make_cloud_mask(k),
+                "bond_mask": make_bond_mask(k),
+                "theta_mask": make_theta_mask(k),
+                "torsion_mask": make_torsion_mask(k),
+                "torsion_mask_filled": make_torsion_mask(k, fill=True),
+                "idx_mask": make_idx_mask(k),
+                "atom_token_mask": make_atom_token_mask(k),
+                "rigid_idx_mask": SC_BUILD_INFO[k]['rigid-frames-idxs'],
+                } 
+            for k in INDEX2AAS}
+
+
+def build_supreme_tables():
+    """ Dense (21, ...) versions of SUPREME_INFO in INDEX2AAS order, for vectorized lookups. """
+    tables = {key: np.stack([SUPREME_INFO[aa][key] for aa in INDEX2AAS])
+              for key in ["cloud_mask", "bond_mask", "theta_mask", "torsion_mask",
+                          "torsion_mask_filled", "idx_mask", "atom_token_mask"]}
+    # (21, 6, 3) rigid frames idxs, padded with -1. and the number of frames of each aa
+    tables["rigid_idx_mask"] = np.full((len(INDEX2AAS), 6, 3), -1)
+    tables["rigid_groups"] = np.zeros(len(INDEX2AAS), dtype=np.int64)
+    for i, aa in enumerate(INDEX2AAS):
+        frames = np.array(SUPREME_INFO[aa]["rigid_idx_mask"]).reshape(-1, 3)
+        tables["rigid_idx_mask"][i, :len(frames)] = frames
+        tables["rigid_groups"][i] = len(frames)
+    return tables
+
+
+# built on 1st access
+SUPREME_INFO   = LazyTable(build_supreme_info)
+SUPREME_TABLES = LazyTable(build_supreme_tables)
+
+# ascii code -> idx in INDEX2AAS. -1 for unknown
+AAS2INDEX_TABLE = np.full(256, -1)
+AAS2INDEX_TABLE[np.frombuffer(INDEX2AAS.encode(), dtype=np.uint8)] = np.arange(len(INDEX2AAS))
 
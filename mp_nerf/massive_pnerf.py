@@ -1,10 +1,46 @@
 import time
+import math
+import warnings
 import numpy as np
 # diff ml
 import torch
 from einops import repeat
 
 
+# "strict" raises, "warn-once" warns the first time and stops checking,
+# "off" never checks (no host-device sync)
+VALIDATION = {"policy": "strict", "warned": False}
+
+def set_validation_policy(policy):
+    """ Sets the global policy for the input checks of the folding functions.
+        Inputs: 
+        * policy: one of ["strict", "warn-once", "off"]
+    """
+    if policy not in ("strict", "warn-once", "off"):
+        raise ValueError(f"policy must be one of 'strict', 'warn-once', 'off'. policy = {policy}")
+    VALIDATION["policy"] = policy
+    VALIDATION["warned"] = False
+
+
+def validate_thetas(theta, validate=None):
+    """ Checks that the angle(s) are in radians, in [-pi, pi]. 
+        Only place where a host-device sync happens, and only if checking.
+        Inputs: 
+        * theta: tensor (or np.ndarray) of angles
+        * validate: None or one of ["strict", "warn-once", "off"].
+                    None uses the global policy (see `set_validation_policy`)
+    """
+    policy = VALIDATION["policy"] if validate is None else validate
+    if policy == "off" or (policy == "warn-once" and VALIDATION["warned"]):
+        return
+    if not ( (-np.pi <= theta) * (theta <= np.pi) ).all().item():
+        msg = f"theta(s) must be in radians and in [-pi, pi]. theta(s) = {theta}"
+        if policy == "strict":
+            raise ValueError(msg)
+        VALIDATION["warned"] = True
+        warnings.warn(msg)
+
+
 def get_axis_matrix(a, b, c, norm=True):
     """ Gets an orthonomal basis as a matrix of [e1, e2, e3]. 
         Useful for constructing rotation matrices between planes
@@ -35,7 +71,7 @@ def get_axis_matrix(a, b, c, norm=True):
 
 
 
-def mp_nerf_torch(a, b, c, l, theta, chi):
+def mp_nerf_torch(a, b, c, l, theta, chi, validate=None, memory_efficient=False):
     """ Custom Natural extension of Reference Frame. 
         Inputs:
         * a: (batch, 3) or (3,). point(s) of the plane, not connected to d
@@ -43,11 +79,15 @@ def mp_nerf_torch(a, b, c, l, theta, chi):
         * c: (batch, 3) or (3,). point(s) of the plane, connected to d
         * theta: (batch,) or (float).  angle(s) between b-c-d
         * chi: (batch,) or float. dihedral angle(s) between the a-b-c and b-c-d planes
+        * validate: None or one of ["strict", "warn-once", "off"]. see `validate_thetas`
+        * memory_efficient: bool. whether to use `MpNerfFunction` (saves only the
+                            inputs for backward and recomputes the rest)
         Outputs: d (batch, 3) or (float). the next point in the sequence, linked to c
     """
     # safety check
-    if not ( (-np.pi <= theta) * (theta <= np.pi) ).all().item():
-        raise ValueError(f"theta(s) must be in radians and in [-pi, pi]. theta(s) = {theta}")
+    validate_thetas(theta, validate=validate)
+    if memory_efficient:
+        return MpNerfFunction.apply(a, b, c, l, theta, chi)
     # calc vecs
     ba = b-a
     cb = c-b
@@ -55,13 +95,318 @@ def mp_nerf_torch(a, b, c, l, theta, chi):
     n_plane  = torch.cross(ba, cb, dim=-1)
     n_plane_ = torch.cross(n_plane, cb, dim=-1)
     rotate   = torch.stack([cb, n_plane_, n_plane], dim=-1)
-    rotate  /= torch.norm(rotate, dim=-2, keepdim=True)
+    rotate   = rotate / torch.norm(rotate, dim=-2, keepdim=True)
     # calc proto point, rotate. add (-1 for sidechainnet convention)
     # https://github.com/jonathanking/sidechainnet/issues/14
     d = torch.stack([-torch.cos(theta),
                      torch.sin(theta) * torch.cos(chi),
                      torch.sin(theta) * torch.sin(chi)], dim=-1).unsqueeze(-1)
     # extend base point, set length
-    return c + l.unsqueeze(-1) * torch.matmul(rotate, d).squeeze()
+    return c + l.unsqueeze(-1) * torch.matmul(rotate, d).squeeze(-1)
+
+
+def rotate_frame(frame, chi):
+    """ Rotates frame(s) by the dihedral(s) chi around their first axis.
+        Inputs:
+        * frame: (batch, 3, 3) or (3, 3). rotation matrices (columns are the axes)
+        * chi: (batch,) or float. dihedral angle(s)
+        Outputs: (batch, 3, 3) or (3, 3). frame @ rot_x(chi)
+    """
+    chi = torch.as_tensor(chi, dtype=frame.dtype, device=frame.device)
+    cos, sin = torch.cos(chi).unsqueeze(-1), torch.sin(chi).unsqueeze(-1)
+    e1, e2, e3 = frame.unbind(dim=-1)
+    return torch.stack([e1, cos * e2 + sin * e3, cos * e3 - sin * e2], dim=-1)
+
+
+def get_nerf_frame(a, b, c, chi):
+    """ Frame in which `mp_nerf_torch` places the next point: 
+        d = c + l * frame @ [-cos(theta), sin(theta), 0]
+        Inputs: same as `mp_nerf_torch`.
+        Outputs: (batch, 3, 3) or (3, 3). rotation matrices (columns are the axes)
+    """
+    cb = c-b
+    n_plane  = torch.cross(b-a, cb, dim=-1)
+    n_plane_ = torch.cross(n_plane, cb, dim=-1)
+    frame    = torch.stack([v / torch.norm(v, dim=-1, keepdim=True) 
+                            for v in (cb, n_plane_, n_plane)], dim=-1)
+    return rotate_frame(frame, chi)
+
+
+class MpNerfFunction(torch.autograd.Function):
+    """ `mp_nerf_torch` with a hand-derived backward. Saves only the inputs
+        and recomputes the cheap intermediates (cross products, normalized
+        basis, trig terms) in the backward pass, so autograd memory per call
+        is that of the inputs. No input validation. Not twice differentiable.
+        Inputs: same as `mp_nerf_torch`.
+    """
+    @staticmethod
+    def basis(a, b, c):
+        """ Returns the unnormalized basis vectors, their norms and ba. """
+        ba = b-a
+        cb = c-b
+        n_plane  = torch.cross(ba, cb, dim=-1)
+        n_plane_ = torch.cross(n_plane, cb, dim=-1)
+        vecs  = [cb, n_plane_, n_plane]
+        norms = [torch.norm(v, dim=-1, keepdim=True) for v in vecs]
+        return ba, vecs, norms
+
+    @staticmethod
+    def forward(ctx, a, b, c, l, theta, chi):
+        ctx.save_for_backward(a, b, c, l, theta, chi)
+        _, vecs, norms = MpNerfFunction.basis(a, b, c)
+        d = [-torch.cos(theta),
+             torch.sin(theta) * torch.cos(chi),
+             torch.sin(theta) * torch.sin(chi)]
+        point = sum(d_k.unsqueeze(-1) * v / n for d_k, v, n in zip(d, vecs, norms))
+        return c + l.unsqueeze(-1) * point
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad):
+        # unpack once: checkpointing allows a single unpack per saved tensor
+        saved = ctx.saved_tensors
+        a, b, c, l, theta, chi = saved
+        ba, (cb, n_plane_, n_plane), norms = MpNerfFunction.basis(a, b, c)
+        units = [v / n for v, n in zip([cb, n_plane_, n_plane], norms)]
+        sin_t, cos_t, sin_c, cos_c = torch.sin(theta), torch.cos(theta), torch.sin(chi), torch.cos(chi)
+        d = [-cos_t, sin_t * cos_c, sin_t * sin_c]
+
+        # out = c + l * sum_k(d_k * u_k)
+        grad_point = l.unsqueeze(-1) * grad
+        grad_l = (grad * sum(d_k.unsqueeze(-1) * u for d_k, u in zip(d, units))).sum(dim=-1)
+        grad_d = [(grad_point * u).sum(dim=-1) for u in units]
+        grad_theta = grad_d[0] * sin_t + (grad_d[1] * cos_c + grad_d[2] * sin_c) * cos_t
+        grad_chi   = (grad_d[2] * cos_c - grad_d[1] * sin_c) * sin_t
+        # u = v / |v|  ->  grad_v = (grad_u - u (u . grad_u)) / |v|
+        grad_vecs = []
+        for d_k, u, n in zip(d, units, norms):
+            grad_u = d_k.unsqueeze(-1) * grad_point
+            grad_vecs.append( (grad_u - u * (u * grad_u).sum(dim=-1, keepdim=True)) / n )
+        grad_cb, grad_n_plane_, grad_n_plane = grad_vecs
+        # n_plane_ = n_plane x cb ; n_plane = ba x cb
+        grad_n_plane = grad_n_plane + torch.cross(cb, grad_n_plane_, dim=-1)
+        grad_cb = grad_cb + torch.cross(grad_n_plane_, n_plane, dim=-1) + \
+                            torch.cross(grad_n_plane, ba, dim=-1)
+        grad_ba = torch.cross(cb, grad_n_plane, dim=-1)
+        # ba = b - a ; cb = c - b
+        grads = [-grad_ba, grad_ba - grad_cb, grad + grad_cb, grad_l, grad_theta, grad_chi]
+        # undo broadcasting
+        return tuple( g.sum_to_size(x.shape) if ctx.needs_input_grad[i] else None
+                      for i, (g, x) in enumerate(zip(grads, saved)) )
+
+
+
+
+# below this length, the sequential loop beats the scan (see `chain_rotations`)
+SCAN_MIN_LENGTH = 8
+
+# deviation from orthonormal of the last chained frame of each protein in the batch,
+# a (B,) tensor (see `chain_rotations`).
+# opt-in: set "enabled" to True. kept as a detached tensor, so reading it 
+# is the only host-device sync and it doesn't keep the graph alive
+CHAIN_DIAGNOSTICS = {"enabled": False, "orthonormality_error": None}
+
+def record_orthonormality_error(rotations):
+    """ Stores the deviation from orthonormal of `rotations` in `CHAIN_DIAGNOSTICS`
+        if enabled. 
+        Inputs:
+        * rotations: (..., 3, 3). last chained frame(s)
+        Outputs: None
+    """
+    if CHAIN_DIAGNOSTICS["enabled"]:
+        CHAIN_DIAGNOSTICS["orthonormality_error"] = orthonormality_error(rotations.detach())
+
+def orthonormalize_rotations(rotations):
+    """ Projects near-rotation matrices back to rotations (Gram-Schmidt on the rows).
+        Inputs:
+        * rotations: (..., 3, 3). matrices to be orthonormalized
+        Outputs: (..., 3, 3). orthonormal matrices
+    """
+    e1 = rotations[..., 0, :] / torch.norm(rotations[..., 0, :], dim=-1, keepdim=True)
+    e3 = torch.cross(e1, rotations[..., 1, :], dim=-1)
+    e3 = e3 / torch.norm(e3, dim=-1, keepdim=True)
+    return torch.stack([e1, torch.cross(e3, e1, dim=-1), e3], dim=-2)
+
+
+def orthonormality_error(rotations):
+    """ Max abs deviation of R @ R^T from the identity.
+        Inputs:
+        * rotations: (..., 3, 3). rotation matrices
+        Outputs: (...,) deviation of each matrix
+    """
+    identity = torch.eye(3, dtype=rotations.dtype, device=rotations.device)
+    return (torch.matmul(rotations, rotations.transpose(-1, -2)) - identity).abs().amax(dim=(-1, -2))
+
+
+def scan_rotations(rotations, orthonormalize=None, resets=None):
+    """ Inclusive prefix product of rotation matrices by a 
+        Hillis-Steele parallel scan: O(log N) vectorized steps.
+        Inputs:
+        * rotations: (..., N, 3, 3). rotation matrices to be chained
+        * orthonormalize: optional int K. re-orthonormalize after every step
+                          whose products span K or more matrices
+        * resets: optional (..., N) bool. where the product restarts (segmented scan)
+        Outputs: (..., N, 3, 3). the i-th is rotations[i] @ ... @ rotations[0]
+                 (or down to the last reset)
+    """
+    offset = 1
+    length = rotations.shape[-3]
+    while offset < length:
+        prev = rotations[..., :-offset, :, :]
+        if resets is not None:
+            # products that already reached a reset are complete
+            prev = torch.where(resets[..., offset:, None, None], 
+                               torch.eye(3, device=prev.device, dtype=prev.dtype), prev)
+            resets = torch.cat([resets[..., :offset], 
+                                resets[..., offset:] | resets[..., :-offset]], dim=-1)
+        rotations = torch.cat([rotations[..., :offset, :, :],
+                               torch.matmul(rotations[..., offset:, :, :], prev)], dim=-3)
+        offset *= 2
+        if orthonormalize and offset >= orthonormalize:
+            rotations = orthonormalize_rotations(rotations)
+    return rotations
+
+
+def chain_rotations(rotations, scan=None, hybrid=False, orthonormalize=None, resets=None):
+    """ Chains rotation matrices sequentially: 
+        rotations[i] = rotations[i] @ rotations[i-1]
+        If `CHAIN_DIAGNOSTICS["enabled"]`, stores the deviation from orthonormal 
+        of the last chained frames, a (...,) tensor, in `CHAIN_DIAGNOSTICS["orthonormality_error"]`.
+        Inputs:
+        * rotations: (..., N, 3, 3). rotation matrices to be chained
+        * scan: bool or None. whether to use the parallel scan (`scan_rotations`)
+                instead of the sequential loop. None picks the scan for
+                N >= SCAN_MIN_LENGTH
+        * hybrid: bool. whether to do the sequential loop in cpu
+        * orthonormalize: optional int K. re-orthonormalize the running product 
+                          every K matrices, so rounding errors don't accumulate
+        * resets: optional (..., N) bool. where the chain restarts: 
+                  rotations[i] is kept as is (ex. at chain breaks)
+        Outputs: (..., N, 3, 3). chained rotation matrices
+    """
+    length = rotations.shape[-3]
+    if scan is None:
+        scan = length >= SCAN_MIN_LENGTH
+    if scan: 
+        rotations = scan_rotations(rotations, orthonormalize=orthonormalize, resets=resets)
+        record_orthonormality_error(rotations[..., -1, :, :])
+        return rotations
+
+    # do rotation concatenation - do for loop in cpu always - faster
+    device = rotations.device
+    rotations = rotations.cpu() if rotations.is_cuda and hybrid else rotations
+    resets = resets.to(rotations.device) if resets is not None else None
+    chained = [rotations[..., 0, :, :]]
+    for i in range(1, length):
+        chained.append( torch.matmul(rotations[..., i, :, :], chained[-1]) )
+        if resets is not None:
+            chained[-1] = torch.where(resets[..., i, None, None], rotations[..., i, :, :], 
+                                      chained[-1])
+        if orthonormalize and i % orthonormalize == 0:
+            chained[-1] = orthonormalize_rotations(chained[-1])
+    record_orthonormality_error(chained[-1].to(device))
+    return torch.stack(chained, dim=-3).to(device)
+
+
+####################
+### NUMPY ENGINE ###
+####################
+
+# for short chains on cpu, torch per-op dispatch costs more than the arithmetic
+
+def get_axis_matrix_numpy(a, b, c, norm=True):
+    """ NumPy version of `get_axis_matrix`. Same inputs and outputs. """
+    v1_ = c - b 
+    v2_ = b - a
+    v3_ = np.cross(v1_, v2_)
+    v2_ready = np.cross(v3_, v1_)
+    basis    = np.stack([v1_, v2_ready, v3_], axis=-2)
+    # normalize if needed
+    if norm:
+        return basis / np.linalg.norm(basis, axis=-1, keepdims=True) 
+    return basis
+
+
+def mp_nerf_numpy(a, b, c, l, theta, chi, validate=None):
+    """ NumPy version of `mp_nerf_torch`. Same inputs and outputs. """
+    # safety check
+    validate_thetas(theta, validate=validate)
+    # calc vecs
+    ba = b-a
+    cb = c-b
+    # calc rotation matrix. based on plane normals and normalized
+    n_plane  = np.cross(ba, cb)
+    n_plane_ = np.cross(n_plane, cb)
+    rotate   = np.stack([cb, n_plane_, n_plane], axis=-1)
+    rotate   = rotate / np.linalg.norm(rotate, axis=-2, keepdims=True)
+    # calc proto point, rotate. add (-1 for sidechainnet convention)
+    d = np.stack([-np.cos(theta),
+                  np.sin(theta) * np.cos(chi),
+                  np.sin(theta) * np.sin(chi)], axis=-1)[..., None]
+    # extend base point, set length
+    return c + l[..., None] * np.matmul(rotate, d)[..., 0]
 
 
+def chain_rotations_numpy(rotations, scan=None):
+    """ NumPy version of `chain_rotations`. Same inputs and outputs. """
+    length = rotations.shape[-3]
+    if scan is None:
+        scan = length >= SCAN_MIN_LENGTH
+    if scan: 
+        offset = 1
+        while offset < length:
+            rotations = np.concatenate([rotations[..., :offset, :, :],
+                                        np.matmul(rotations[..., offset:, :, :], 
+                                                  rotations[..., :-offset, :, :])], axis=-3)
+            offset *= 2
+        return rotations
+
+    rotations = rotations.copy()
+    for i in range(1, length):
+        rotations[..., i, :, :] = np.matmul(rotations[..., i, :, :], rotations[..., i-1, :, :])
+    return rotations
+
+
+###########################
+### COMPILE-FRIENDLY ######
+###########################
+
+# no numpy, no host syncs and no data-dependent shapes. 
+# can be passed to `torch.jit.script` or `torch.compile`
+
+def get_axis_matrix_static(a: torch.Tensor, b: torch.Tensor, c: torch.Tensor,
+                           norm: bool = True) -> torch.Tensor:
+    """ Compile-friendly version of `get_axis_matrix`. Same inputs and outputs.
+        Degenerate (zero) vectors give a zero basis instead of NaNs.
+    """
+    v1_ = c - b 
+    v2_ = b - a
+    v3_ = torch.cross(v1_, v2_, dim=-1)
+    v2_ready = torch.cross(v3_, v1_, dim=-1)
+    basis    = torch.stack([v1_, v2_ready, v3_], dim=-2)
+    # normalize if needed
+    if norm:
+        return basis / torch.norm(basis, dim=-1, keepdim=True).clamp_min(1e-12)
+    return basis
+
+
+def mp_nerf_torch_static(a: torch.Tensor, b: torch.Tensor, c: torch.Tensor, l: torch.Tensor,
+                         theta: torch.Tensor, chi: torch.Tensor) -> torch.Tensor:
+    """ Compile-friendly version of `mp_nerf_torch`: no input validation.
+        Same inputs and outputs. Degenerate (zero) references give d = c
+        instead of NaNs, so it's safe to run on padding.
+    """
+    # calc vecs
+    ba = b-a
+    cb = c-b
+    # calc rotation matrix. based on plane normals and normalized
+    n_plane  = torch.cross(ba, cb, dim=-1)
+    n_plane_ = torch.cross(n_plane, cb, dim=-1)
+    rotate   = torch.stack([cb, n_plane_, n_plane], dim=-1)
+    rotate   = rotate / torch.norm(rotate, dim=-2, keepdim=True).clamp_min(1e-12)
+    # calc proto point, rotate. add (-1 for sidechainnet convention)
+    d = torch.stack([-torch.cos(theta),
+                     torch.sin(theta) * torch.cos(chi),
+                     torch.sin(theta) * torch.sin(chi)], dim=-1).unsqueeze(-1)
+    # extend base point, set length
+    return c + l.unsqueeze(-1) * torch.matmul(rotate, d).squeeze(-1)
@@ -16,13 +16,8 @@ def scn_atom_embedd(seq_list):
         Inputs: 
         * seq_list: list of FASTA sequences. same length
     """
-    batch_tokens = []
-    # do loop in cpu
-    for i,seq in enumerate(seq_list):
-        batch_tokens.append( torch.tensor([SUPREME_INFO[aa]["atom_token_mask"] \
-                                           for aa in seq]) )
-    batch_tokens = torch.stack(batch_tokens, dim=0).long()
-    return batch_tokens
+    idxs = torch.stack([scn_seq_idxs(seq) for seq in seq_list], dim=0)
+    return get_kb_tables(idxs.device)["atom_token_mask"][idxs].long()
 
 
 def chain2atoms(x, mask=None, c=3):
@@ -99,36 +94,139 @@ def torsion_angle_loss(pred_torsions, true_torsions, coeff=2., angle_mask=None):
     return coeff * (1 - maxi)
 
 
+class FapeFunction(torch.autograd.Function):
+    """ `fape_torch_batch` (default clamped L2) with a hand-derived backward.
+        Streams over blocks of frames in both passes: saves only the inputs
+        and recomputes the (B, block, N, 3) aligned points in the backward,
+        so peak memory is O(B * block * N) instead of O(B * F * N). 
+        Not twice differentiable. 
+        Inputs: same as `fape_torch_batch`, masks required (no l_func).
+    """
+    @staticmethod
+    def errors(pred_points, true_points, rots, eps=1e-7):
+        """ Returns the (B, f, N, 3) differences and (B, f, N) distances to the frames. """
+        diff = torch.einsum('bnd,bfde->bfne', pred_points, rots) - true_points.unsqueeze(1)
+        return diff, ((diff**2).sum(dim=-1) + eps).sqrt()
+
+    @staticmethod
+    def forward(ctx, pred_points, true_points, rot_mats, point_mask, frame_mask, max_val, chunk_size):
+        ctx.save_for_backward(pred_points, true_points, rot_mats, point_mask, frame_mask)
+        ctx.max_val, ctx.chunk_size = max_val, chunk_size
+        fape = 0.
+        for start in range(0, rot_mats.shape[1], chunk_size):
+            _, dists = FapeFunction.errors(pred_points, true_points, rot_mats[:, start:start+chunk_size])
+            fape = fape + (dists.clamp(0, max_val) * frame_mask[:, start:start+chunk_size, None]).sum(dim=1)
+        fape = fape / frame_mask.sum(dim=-1, keepdim=True).clamp(min=1)
+        return (1/max_val) * fape * point_mask
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad):
+        pred_points, true_points, rot_mats, point_mask, frame_mask = ctx.saved_tensors
+        max_val, chunk_size = ctx.max_val, ctx.chunk_size
+        # d fape / d dist of each (frame, point). clamp: no grad outside [0, max_val]
+        grad = grad * point_mask / (max_val * frame_mask.sum(dim=-1, keepdim=True).clamp(min=1))
+        grad_pred, grad_true = torch.zeros_like(pred_points), torch.zeros_like(true_points)
+        grad_rots = torch.zeros_like(rot_mats)
+        for start in range(0, rot_mats.shape[1], chunk_size):
+            rots = rot_mats[:, start:start+chunk_size]
+            diff, dists = FapeFunction.errors(pred_points, true_points, rots)
+            scale = grad.unsqueeze(1) * frame_mask[:, start:start+chunk_size, None] * (dists <= max_val)
+            # dist = |p @ R - t|  ->  grad_diff = diff / dist
+            grad_diff = (scale / dists).unsqueeze(-1) * diff
+            grad_pred += torch.einsum('bfne,bfde->bnd', grad_diff, rots)
+            grad_true -= grad_diff.sum(dim=1)
+            if ctx.needs_input_grad[2]:
+                grad_rots[:, start:start+chunk_size] = torch.einsum('bnd,bfne->bfde', pred_points, grad_diff)
+        return (grad_pred if ctx.needs_input_grad[0] else None, 
+                grad_true if ctx.needs_input_grad[1] else None,
+                grad_rots if ctx.needs_input_grad[2] else None, None, None, None, None)
+
+
+def fape_torch_batch(pred_points, true_points, rot_mats, point_mask=None, frame_mask=None,
+                     max_val=10., l_func=None, chunk_size=None, memory_efficient=False):
+    """ Computes the Frame-Aligned Point Error of every point against every
+        frame of a batch at once. Scaled 0 <= FAPE <= 1
+        Inputs: 
+        * pred_points: (B, N, 3) predicted points. centered
+        * true_points: (B, N, 3) ground truth points. centered
+        * rot_mats: (B, F, 3, 3) rotations from the predicted to the true frames
+        * point_mask: optional. (B, N) bool. False for padding points (get 0)
+        * frame_mask: optional. (B, F) bool. False for padding frames (not averaged)
+        * max_val: maximum value (it's also the radius due to L1 usage)
+        * l_func: function. allow for options other than l1 (consider dRMSD)
+        * chunk_size: optional. int. max number of frames per step: bounds the 
+                      (B, F, N) intermediates to (B, chunk_size, N)
+        * memory_efficient: bool. whether to use the blockwise backward of `FapeFunction`
+                            (default l_func only). chunk_size defaults to 64 then
+        Outputs: (B, N) FAPE of each point averaged over its frames
+    """
+    if frame_mask is None: 
+        frame_mask = torch.ones(rot_mats.shape[:2], dtype=torch.bool, device=rot_mats.device)
+    if memory_efficient: 
+        if l_func is not None: 
+            raise ValueError("memory_efficient FAPE only supports the default l_func")
+        if point_mask is None: 
+            point_mask = torch.ones(pred_points.shape[:2], dtype=torch.bool, device=pred_points.device)
+        return FapeFunction.apply(pred_points, true_points, rot_mats, point_mask, frame_mask, 
+                                  max_val, 64 if chunk_size is None else chunk_size)
+
+    if l_func is None: 
+        l_func = lambda x,y,eps=1e-7,sup=max_val: (((x-y)**2).sum(dim=-1) + eps).sqrt() 
+    chunk_size = rot_mats.shape[1] if chunk_size is None else chunk_size
+
+    fape = 0.
+    for start in range(0, rot_mats.shape[1], chunk_size):
+        rots = rot_mats[:, start:start+chunk_size]
+        # (B, N, 3) x (B, f, 3, 3) -> (B, f, N, 3)
+        aligned = torch.einsum('bnd,bfde->bfne', pred_points, rots)
+        errors  = l_func(aligned, true_points.unsqueeze(1)).clamp(0, max_val)
+        fape    = fape + (errors * frame_mask[:, start:start+chunk_size, None]).sum(dim=1)
+
+    fape = fape / frame_mask.sum(dim=-1, keepdim=True).clamp(min=1)
+    if point_mask is not None: 
+        fape = fape * point_mask
+    return (1/max_val) * fape
+
+
 def fape_torch(pred_coords, true_coords, max_val=10., l_func=None,
-               c_alpha=False, seq_list=None, rot_mats_g=None): 
+               c_alpha=False, seq_list=None, rot_mats_g=None, cu_seqlens=None,
+               chunk_size=None, memory_efficient=False): 
     """ Computes the Frame-Aligned Point Error. Scaled 0 <= FAPE <= 1
         Inputs: 
         * pred_coords: (B, L, C, 3) predicted coordinates. 
         * true_coords: (B, L, C, 3) ground truth coordinates. 
         * max_val: maximum value (it's also the radius due to L1 usage)
         * l_func: function. allow for options other than l1 (consider dRMSD)
-        * c_alpha: bool. whether to only calculate frames and loss from c_alphas
+        * c_alpha: bool. whether to only calculate frames and loss from c_alphas
         * seq_list: list of strs (FASTA sequences). to calculate rigid bodies' indexs.
                     Defaults to C-alpha if not passed.
         * rot_mats_g: optional. List of n_seqs x (N_frames, 3, 3) rotation matrices.
-
-        Outputs: (B, N_atoms) 
+        * cu_seqlens: optional. (B+1,) long. if passed, coords are packed 
+                      (N, C, 3) and each segment is a structure. see `pack_tensors`
+        * chunk_size: optional. int. max number of frames per step. see `fape_torch_batch`
+        * memory_efficient: bool. whether to recompute the errors blockwise in the
+                            backward instead of storing them. see `FapeFunction`
+
+        Outputs: (B, N_atoms). padded with 0s if structures have different number 
+                 of atoms. or (N_atoms,) packed if cu_seqlens is passed
     """
-    fape_store = []
-    if l_func is None: 
-        l_func = lambda x,y,eps=1e-7,sup=max_val: (((x-y)**2).sum(dim=-1) + eps).sqrt() 
+    pred_store, true_store, rot_store = [], [], []
+    if cu_seqlens is not None:
+        # no padding: one structure per segment
+        pred_coords = unpack_tensors(pred_coords, cu_seqlens)
+        true_coords = unpack_tensors(true_coords, cu_seqlens)
     # for chain
-    for s in range(pred_coords.shape[0]):  
-        fape_store.append(0)
+    for s in range(len(pred_coords)):  
         cloud_mask = (torch.abs(true_coords[s]).sum(dim=-1) != 0)
-        # center both structures
-        pred_center = pred_coords[s] - pred_coords[s, cloud_mask].mean(dim=0, keepdim=True)
-        true_center = true_coords[s] - true_coords[s, cloud_mask].mean(dim=0, keepdim=True)
+        # center both structures
+        pred_center = pred_coords[s] - pred_coords[s][cloud_mask].mean(dim=0, keepdim=True)
+        true_center = true_coords[s] - true_coords[s][cloud_mask].mean(dim=0, keepdim=True)
         # convert to (B, L*C, 3)
         pred_center = rearrange(pred_center, 'l c d -> (l c) d')
         true_center = rearrange(true_center, 'l c d -> (l c) d')
         mask_center = rearrange(cloud_mask, 'l c -> (l c)')
-        # get frames and conversions - same scheme as in mp_nerf proteins' concat of monomers
+        # get frames and conversions - same scheme as in mp_nerf proteins' concat of monomers
         if rot_mats_g is None:
             rigid_idxs = scn_rigid_index_mask(seq_list[s], c_alpha=c_alpha)  
             true_frames = get_axis_matrix(*true_center[rigid_idxs].detach(), norm=True)
@@ -139,18 +237,43 @@ def fape_torch(pred_coords, true_coords, max_val=10., l_func=None,
 
         # calculate loss only on c_alphas
         if c_alpha:
-            mask_center[:] = False
+            # new mask: the cloud mask is needed for the backward of the centering
+            mask_center = torch.zeros_like(mask_center)
             mask_center[rigid_idxs[1]] = True
 
-        # measure errors - for residue
-        for i,rot_mat in enumerate(rot_mats): 
-            fape_store[s] += l_func( pred_center[s][mask_center[s]] @ rot_mat, 
-                                     true_center[s][mask_center[s]]
-                               ).clamp(0, max_val)
-        fape_store[s] /= rot_mats.shape[0]            
-
-    # stack and average
-    return (1/max_val) * torch.stack(fape_store, dim=0)
+        pred_store.append( pred_center[mask_center] )
+        true_store.append( true_center[mask_center] )
+        rot_store.append( rot_mats )
+
+    if cu_seqlens is not None:
+        # no padding: structures of the same size are measured together, 
+        # so the cost stays proportional to the real number of residues
+        groups, fape_store = {}, [None] * len(pred_store)
+        for s, (points, rot_mats) in enumerate(zip(pred_store, rot_store)):
+            groups.setdefault((len(points), len(rot_mats)), []).append(s)
+        for idxs in groups.values():
+            fape = fape_torch_batch(torch.stack([pred_store[s] for s in idxs], dim=0), 
+                                    torch.stack([true_store[s] for s in idxs], dim=0), 
+                                    torch.stack([rot_store[s] for s in idxs], dim=0), 
+                                    max_val=max_val, l_func=l_func, chunk_size=chunk_size, 
+                                    memory_efficient=memory_efficient)
+            for i, s in enumerate(idxs): 
+                fape_store[s] = fape[i]
+        # packed structures have different number of atoms
+        return torch.cat(fape_store, dim=0)
+
+    # measure errors - all structures, frames and atoms at once
+    pad = lambda x: torch.nn.utils.rnn.pad_sequence(x, batch_first=True)
+    n_points = torch.tensor([len(x) for x in pred_store], device=pred_store[0].device)
+    n_frames = torch.tensor([len(x) for x in rot_store], device=rot_store[0].device)
+    point_mask = torch.arange(n_points.max(), device=n_points.device) < n_points.unsqueeze(-1)
+    frame_mask = torch.arange(n_frames.max(), device=n_frames.device) < n_frames.unsqueeze(-1)
+    fape = fape_torch_batch(pad(pred_store), pad(true_store), pad(rot_store), 
+                            point_mask=point_mask, frame_mask=frame_mask, 
+                            max_val=max_val, l_func=l_func, chunk_size=chunk_size, 
+                            memory_efficient=memory_efficient)
+    # structures with fewer atoms are zero at the padding
+    return fape
 
 
 # custom
@@ -164,19 +287,22 @@ def atom_selector(scn_seq, x, option=None, discard_absent=True):
                   'all', 'backbone-with-oxygen', 'backbone-with-cbeta-and-oxygen']
         * discard_absent: bool. Whether to discard the points for which
                           there are no labels (bad recordings)
+        For packed batches (see `pack_tensors`), pass the concatenated 
+        sequences and x as a batch of one: [seq], x.unsqueeze(0)
     """
     
 
     # get mask
-    present = []
-    for i,seq in enumerate(scn_seq): 
-        pass_x = x[i] if discard_absent else None
-        if pass_x is None and isinstance(seq, torch.Tensor):
-            seq = "".join([INDEX2AAS[x] for x in seq.cpu().detach().tolist()])
+    if isinstance(scn_seq, torch.Tensor) and not discard_absent: 
+        # batched lookup in the KB tables, in the device of the tokens
+        present = scn_cloud_mask(scn_seq).bool()
+    else: 
+        present = []
+        for i,seq in enumerate(scn_seq): 
+            pass_x = x[i] if discard_absent else None
+            present.append( scn_cloud_mask(seq, coords=pass_x) )
 
-        present.append( scn_cloud_mask(seq, coords=pass_x) )
-
-    present = torch.stack(present, dim=0).bool()
+        present = torch.stack(present, dim=0).bool()
 
     
     # atom mask
@@ -204,6 +330,7 @@ def atom_selector(scn_seq, x, option=None, discard_absent=True):
     else:
         raise ValueError('option needs to be a valid string or a mask tensor of shape (14,) ')
     
+    atom_mask = atom_mask.to(present.device)
     mask = rearrange(present * atom_mask.unsqueeze(0).unsqueeze(0).bool(), 'b l c -> b (l c)')
     return x[mask], mask
 
@@ -211,7 +338,7 @@ def atom_selector(scn_seq, x, option=None, discard_absent=True):
 def noise_internals(seq, angles=None, coords=None, noise_scale=0.5, theta_scale=0.5, verbose=0):
     """ Noises the internal coordinates -> dihedral and bond angles. 
         Inputs: 
-        * seq: string. Sequence in FASTA format
+        * seq: string. Sequence in FASTA format (or (l,) int tensor of sidechainnet tokens)
         * angles: (l, 11) sidechainnet angles tensor
         * coords: (l, 14, 13)
         * noise_scale: float. std of noise gaussian.
@@ -266,7 +393,7 @@ def noise_internals(seq, angles=None, coords=None, noise_scale=0.5, theta_scale=
         scaffolds["angles_mask"][1] = noised_dihedrals
     
     # reconstruct
-    return protein_fold(**scaffolds)
+    return protein_fold(**scaffolds, device=scaffolds["bond_mask"].device)
 
 
 def combine_noise(true_coords, seq=None, int_seq=None, angles=None,
@@ -285,13 +412,13 @@ def combine_noise(true_coords, seq=None, int_seq=None, angles=None,
     """
     # get seqs right
     assert int_seq is not None or seq is not None, "Either int_seq or seq must be passed"
-    if int_seq is not None and seq is None: 
-    	seq = "".join([INDEX2AAS[x] for x in int_seq.cpu().detach().tolist()])
-    elif int_seq is None and seq is not None: 
-    	int_seq = torch.tensor([AAS2INDEX[x] for x in seq.upper()], device=true_coords.device)
+    # int tokens are used as is (scaffolds are built from them in their device)
+    if int_seq is None: 
+        int_seq = scn_seq_idxs(seq.upper(), device=true_coords.device)
+    int_seq = int_seq.to(true_coords.device)
 
     cloud_mask_flat = (true_coords == 0.).sum(dim=-1) != true_coords.shape[-1]
-    naive_cloud_mask = scn_cloud_mask(seq).bool()
+    naive_cloud_mask = scn_cloud_mask(int_seq).bool()
     
     if NOISE_INTERNALS: 
         assert cloud_mask_flat.sum().item() == naive_cloud_mask.sum().item(), \
@@ -306,7 +433,7 @@ def combine_noise(true_coords, seq=None, int_seq=None, angles=None,
     ###### SETP 1: internals #########
     if NOISE_INTERNALS:
         # create noised and masked noised coords        
-        noised_coords, cloud_mask = noise_internals(seq, angles = angles, 
+        noised_coords, cloud_mask = noise_internals(int_seq, angles = angles, 
                                                     coords = coords_scn.squeeze(),  
                                                     noise_scale = NOISE_INTERNALS, 
                                                     theta_scale = INTERNALS_SCN_SCALE,
@@ -317,11 +444,11 @@ def combine_noise(true_coords, seq=None, int_seq=None, angles=None,
     ###### SETP 2: build from backbone #########
     if SIDECHAIN_RECONSTRUCT: 
         bb, mask = atom_selector(int_seq.unsqueeze(0), noised_coords, option="backbone", discard_absent=False)
-        scaffolds = build_scaffolds_from_scn_angles(seq, angles=None, device="cpu")
+        scaffolds = build_scaffolds_from_scn_angles(int_seq, angles=None, device=true_coords.device)
         noised_coords[~mask] = 0.
         noised_coords = rearrange(noised_coords, '() (l c) d -> l c d', c=14)
-        noised_coords, _ = sidechain_fold(wrapper = noised_coords.cpu(), **scaffolds, c_beta = False)
-        noised_coords = rearrange(noised_coords, 'l c d -> () (l c) d').to(true_coords.device)
+        noised_coords, _ = sidechain_fold(wrapper = noised_coords, **scaffolds, c_beta = False)
+        noised_coords = rearrange(noised_coords, 'l c d -> () (l c) d')
 
 
     return noised_coords, cloud_mask_flat
@@ -1,7 +1,11 @@
 # science
+import math
 import numpy as np 
+from typing import Tuple
+from collections import OrderedDict
 # diff / ml
 import torch
+import torch.utils.checkpoint
 from einops import repeat
 # module
 from mp_nerf.massive_pnerf import *
@@ -9,10 +13,39 @@ from mp_nerf.utils import *
 from mp_nerf.kb_proteins import *
 
 
+# torch versions of SUPREME_TABLES, keyed by device
+KB_TABLES = {}
+
+def get_kb_tables(device=None):
+    """ Returns the dense KB tables (`SUPREME_TABLES`) as tensors in a device.
+        Cached, so each device only pays the transfer once.
+    """
+    device = torch.device("cpu") if device is None else torch.device(device)
+    if device not in KB_TABLES:
+        KB_TABLES[device] = {k: torch.from_numpy(v).to(device) for k, v in SUPREME_TABLES.items()}
+    return KB_TABLES[device]
+
+
+def scn_seq_idxs(seq, device=None):
+    """ Converts a sequence to idxs in INDEX2AAS, the row of each aa in the KB tables.
+        Inputs: 
+        * seq: (length). iterable of 1-letter aa codes or (length,) int tensor
+               of sidechainnet tokens (returned as is)
+        * device: optional. device of the output if seq is not a tensor
+        Outputs: (L,) long tensor
+    """
+    if isinstance(seq, torch.Tensor):
+        return seq.long()
+    idxs = AAS2INDEX_TABLE[np.frombuffer("".join(seq).encode(), dtype=np.uint8)]
+    if (idxs < 0).any():
+        raise KeyError(f"unknown aa(s) in seq: {set(seq) - set(INDEX2AAS)}")
+    return torch.from_numpy(idxs).to(device)
+
+
 def scn_cloud_mask(seq, coords=None, strict=False):
     """ Gets the boolean mask atom positions (not all aas have same atoms). 
         Inputs: 
-        * seqs: (length) iterable of 1-letter aa codes of a protein
+        * seqs: (length) iterable of 1-letter aa codes of a protein (or int tensor)
         * coords: optional .(batch, lc, 3). sidechainnet coords.
                   returns the true mask (solves potential atoms that might not be provided)
         * strict: bool. whther to discard the next points after a missing one 
@@ -22,97 +55,109 @@ def scn_cloud_mask(seq, coords=None, strict=False):
         start = (( rearrange(coords, 'b (l c) d -> b l c d', c=14) != 0 ).sum(dim=-1) != 0).float()
         # if a point is 0, the following are 0s as well
         if strict:
-            for b in range(start.shape[0]):
-                for pos in range(start.shape[1]):
-                    for chain in range(start.shape[2]):
-                        if start[b, pos, chain].item() == 0:
-                            start[b, pos, chain:] *= 0
+            start = torch.cumprod(start, dim=-1)
         return start
-    return torch.tensor([SUPREME_INFO[aa]['cloud_mask'] for aa in seq])
+    idxs = scn_seq_idxs(seq)
+    return get_kb_tables(idxs.device)["cloud_mask"][idxs]
 
 
 def scn_bond_mask(seq):
     """ Inputs: 
-        * seqs: (length). iterable of 1-letter aa codes of a protein
+        * seqs: (length). iterable of 1-letter aa codes of a protein (or int tensor)
         Outputs: (L, 14) maps point to bond length
     """ 
-    return torch.tensor([SUPREME_INFO[aa]['bond_mask'] for aa in seq])
+    idxs = scn_seq_idxs(seq)
+    return get_kb_tables(idxs.device)["bond_mask"][idxs]
 
 
 def scn_angle_mask(seq, angles=None, device=None):
     """ Inputs: 
-        * seq: (length). iterable of 1-letter aa codes of a protein
-        * angles: (length, 12). [phi, psi, omega, b_angle(n_ca_c), b_angle(ca_c_n), b_angle(c_n_ca), 6_scn_torsions]
-        Outputs: (L, 14) maps point to theta and dihedral.
+        * seq: (length). iterable of 1-letter aa codes of a protein (or int tensor).
+               a (batch, length) int tensor with padding token 20 ("_") works too
+        * angles: ((batch), length, 12). [phi, psi, omega, b_angle(n_ca_c), b_angle(ca_c_n), b_angle(c_n_ca), 6_scn_torsions]
+        Outputs: (2, (batch), L, 14) maps point to theta and dihedral.
                  first angle is theta, second is dihedral
     """ 
-    device = angles.device if angles is not None else torch.device("cpu")
+    if angles is not None:
+        device = angles.device
+    device = torch.device("cpu") if device is None else device
     precise = angles.dtype if angles is not None else torch.get_default_dtype()
     torsion_mask_use = "torsion_mask" if angles is not None else "torsion_mask_filled"
     # get masks
-    theta_mask   = torch.tensor([SUPREME_INFO[aa]['theta_mask'] for aa in seq], dtype=precise).to(device)
-    torsion_mask = torch.tensor([SUPREME_INFO[aa][torsion_mask_use] for aa in seq], dtype=precise).to(device)
+    tables = get_kb_tables(device)
+    idxs = scn_seq_idxs(seq, device=device).to(device)
+    theta_mask   = tables["theta_mask"][idxs].to(precise)
+    torsion_mask = tables[torsion_mask_use][idxs].to(precise)
     
     # adapt general to specific angles if passed
     if angles is not None: 
         # fill masks with angle values
-        theta_mask[:, 0] = angles[:, 4] # ca_c_n
-        theta_mask[1:, 1] = angles[:-1, 5] # c_n_ca
-        theta_mask[:, 2] = angles[:, 3] # n_ca_c
+        theta_mask[..., 0] = angles[..., 4] # ca_c_n
+        theta_mask[..., 1:, 1] = angles[..., :-1, 5] # c_n_ca
+        theta_mask[..., 2] = angles[..., 3] # n_ca_c
         # backbone_torsions
-        torsion_mask[:, 0] = angles[:, 1] # n determined by psi of previous
-        torsion_mask[1:, 1] = angles[:-1, 2] # ca determined by omega of previous
-        torsion_mask[:, 2] = angles[:, 0] # c determined by phi
+        torsion_mask[..., 0] = angles[..., 1] # n determined by psi of previous
+        torsion_mask[..., 1:, 1] = angles[..., :-1, 2] # ca determined by omega of previous
+        torsion_mask[..., 2] = angles[..., 0] # c determined by phi
         # https://github.com/jonathanking/sidechainnet/blob/master/sidechainnet/structure/StructureBuilder.py#L313
-        torsion_mask[:, 3] = angles[:, 1] - np.pi
+        torsion_mask[..., 3] = angles[..., 1] - np.pi
 
         # add torsions to sidechains - no need to modify indexes due to torsion modification
-        # since extra rigid modies are in terminal positions in sidechain
+        # since extra rigid modies are in terminal positions in sidechain
         to_fill = torsion_mask != torsion_mask # "p" fill with passed values
         to_pick = torsion_mask == 999          # "i" infer from previous one
-        for i,aa in enumerate(seq):
-            # check if any is nan -> fill the holes
-            number = to_fill[i].long().sum()
-            torsion_mask[i, to_fill[i]] = angles[i, 6:6+number]
-
-            # pick previous value for inferred torsions
-            for j, val in enumerate(to_pick[i]):
-                if val:
-                    torsion_mask[i, j] = torsion_mask[i, j-1] - np.pi # pick values from last one.
-
-            # special rigid bodies anomalies: 
-            if aa == "I": # scn_torsion(CG1) - scn_torsion(CG2) = 2.13 (see KB)
-                torsion_mask[i, 7] += torsion_mask[i, 5]
-            elif aa == "L": 
-                torsion_mask[i, 7] += torsion_mask[i, 6]
+        # the k-th hole of each residue takes its k-th sidechain angle
+        order = (torch.cumsum(to_fill, dim=-1) - 1).clamp(min=0, max=5)
+        torsion_mask = torch.where(to_fill, angles[..., 6:].gather(-1, order), torsion_mask)
+        # pick values from last one. (no aa infers a torsion from an inferred one)
+        torsion_mask = torch.where(to_pick, torsion_mask.roll(1, dims=-1) - np.pi, torsion_mask)
 
+        # special rigid bodies anomalies: 
+        # I: scn_torsion(CG1) - scn_torsion(CG2) = 2.13 (see KB)
+        torsion_mask[..., 7] += torch.where(idxs == AAS2INDEX["I"], torsion_mask[..., 5], 
+                                torch.where(idxs == AAS2INDEX["L"], torsion_mask[..., 6], 
+                                            torch.zeros_like(torsion_mask[..., 7])))
+        # padding stays empty
+        if idxs.dim() > 1:
+            present = (idxs != AAS2INDEX["_"]).unsqueeze(-1)
+            theta_mask, torsion_mask = theta_mask * present, torsion_mask * present
 
-    torsion_mask[-1, 3] += np.pi 
+    if idxs.dim() > 1:
+        # last real residue of each protein (padding at the end)
+        last = ((idxs != AAS2INDEX["_"]).sum(dim=-1, keepdim=True) - 1).clamp(min=0)
+        torsion_mask[..., 3].scatter_add_(-1, last, torch.full_like(last, np.pi, dtype=precise))
+    else: 
+        torsion_mask[-1, 3] += np.pi 
     return torch.stack([theta_mask, torsion_mask], dim=0)
 
 
 def scn_index_mask(seq):
     """ Inputs: 
-        * seq: (length). iterable of 1-letter aa codes of a protein
+        * seq: (length). iterable of 1-letter aa codes of a protein (or int tensor)
         Outputs: (L, 11, 3) maps point to theta and dihedral.
                  first angle is theta, second is dihedral
     """ 
-    idxs = torch.tensor([SUPREME_INFO[aa]['idx_mask'] for aa in seq])
-    return rearrange(idxs, 'l s d -> d l s')
+    idxs = scn_seq_idxs(seq)
+    return rearrange(get_kb_tables(idxs.device)["idx_mask"][idxs], '... l s d -> ... d l s')
 
 
 def scn_rigid_index_mask(seq, c_alpha=None): 
     """ Inputs: 
-        * seq: (length). iterable of 1-letter aa codes of a protein 
+        * seq: (length). iterable of 1-letter aa codes of a protein (or int tensor)
         * c_alpha: bool. whether to return only the c_alpha rigid group
         Outputs: (3, Length * Groups). indexes for 1st, 2nd and 3rd point 
                   to construct frames for each group. 
     """
+    idxs = scn_seq_idxs(seq)
+    tables = get_kb_tables(idxs.device)
+    offsets = 14 * torch.arange(idxs.shape[0], device=idxs.device).unsqueeze(-1)
     if c_alpha: 
-        return torch.cat([torch.tensor(SUPREME_INFO[aa]['rigid_idx_mask'])[:1] + 14*i \
-                          for i,aa in enumerate(seq)], dim=0).t()
-    return torch.cat([torch.tensor(SUPREME_INFO[aa]['rigid_idx_mask']) + 14*i \
-                      for i,aa in enumerate(seq)], dim=0).t()
+        return (tables["rigid_idx_mask"][idxs, 0] + offsets).t()
+    # (L, 6, 3) padded frames, then keep the real ones (residue-major order)
+    frames = tables["rigid_idx_mask"][idxs] + offsets.unsqueeze(-1)
+    present = torch.arange(frames.shape[1], device=idxs.device) < \
+              tables["rigid_groups"][idxs].unsqueeze(-1)
+    return frames[present].t()
 
 
 def build_scaffolds_from_scn_angles(seq, angles=None, coords=None, device="auto"):
@@ -136,7 +181,19 @@ def build_scaffolds_from_scn_angles(seq, angles=None, coords=None, device="auto"
     # auto infer device and precision
     precise = angles.dtype if angles is not None else torch.get_default_dtype()
     if device == "auto":
-        device = angles.device if angles is not None else device
+        device = angles.device if angles is not None else None
+
+    # sequence-only parts from the cache if enabled. see `set_scaffolds_cache`
+    if SCAFFOLDS_CACHE_INFO["maxsize"] and coords is None and isinstance(seq, str):
+        cached = get_cached_scaffolds(seq, dtype=precise, device=device)
+        if angles is None:
+            angles_mask = cached["angles_mask"].clone()
+        else: 
+            angles_mask = scn_angle_mask(seq, angles, device=device).to(device, precise)
+        return {"cloud_mask":     cached["cloud_mask"].clone(), 
+                "point_ref_mask": cached["point_ref_mask"].clone(),
+                "angles_mask":    angles_mask,
+                "bond_mask":      cached["bond_mask"].clone() }
 
     if coords is not None: 
         cloud_mask = scn_cloud_mask(seq, coords=coords)
@@ -157,6 +214,89 @@ def build_scaffolds_from_scn_angles(seq, angles=None, coords=None, device="auto"
             "bond_mask":      bond_mask }
 
 
+# LRU cache of the sequence-only scaffolds, keyed by (seq, dtype, device)
+SCAFFOLDS_CACHE = OrderedDict()
+SCAFFOLDS_CACHE_INFO = {"hits": 0, "misses": 0, "maxsize": 0}
+
+def set_scaffolds_cache(maxsize=1024):
+    """ Enables (maxsize > 0) or disables (maxsize=0) the scaffolds cache used
+        by `build_scaffolds_from_scn_angles` when no coords are passed.
+        Inputs: 
+        * maxsize: int. max number of (seq, dtype, device) entries kept.
+                   least recently used ones are evicted first.
+    """
+    SCAFFOLDS_CACHE_INFO["maxsize"] = max(int(maxsize), 0)
+    while len(SCAFFOLDS_CACHE) > SCAFFOLDS_CACHE_INFO["maxsize"]:
+        SCAFFOLDS_CACHE.popitem(last=False)
+
+
+def scaffolds_cache_info():
+    """ Returns a dict with the hits, misses, maxsize and currsize of the scaffolds cache. """
+    return {**SCAFFOLDS_CACHE_INFO, "currsize": len(SCAFFOLDS_CACHE)}
+
+
+def clear_scaffolds_cache():
+    """ Empties the scaffolds cache and resets its counters. Keeps the maxsize. """
+    SCAFFOLDS_CACHE.clear()
+    SCAFFOLDS_CACHE_INFO["hits"], SCAFFOLDS_CACHE_INFO["misses"] = 0, 0
+
+
+def get_cached_scaffolds(seq, dtype=None, device=None):
+    """ Returns the scaffolds of a sequence without angles (the default
+        `angles_mask`), building them on a miss. Entries are shared:
+        clone before modifying them in place.
+        Inputs: 
+        * seq: string of aas (1 letter code)
+        * dtype: float dtype of angles_mask and bond_mask. defaults to torch's default
+        * device: device of the scaffolds. defaults to cpu
+        Outputs: dict. as returned by `build_scaffolds_from_scn_angles`
+    """
+    dtype  = torch.get_default_dtype() if dtype is None else dtype
+    device = torch.device("cpu") if device is None else torch.device(device)
+    key = (seq, dtype, device)
+    if key in SCAFFOLDS_CACHE:
+        SCAFFOLDS_CACHE_INFO["hits"] += 1
+        SCAFFOLDS_CACHE.move_to_end(key)
+        return SCAFFOLDS_CACHE[key]
+
+    SCAFFOLDS_CACHE_INFO["misses"] += 1
+    scaffolds = {"cloud_mask":     scn_cloud_mask(seq).bool().to(device), 
+                 "point_ref_mask": scn_index_mask(seq).long().to(device),
+                 "angles_mask":    scn_angle_mask(seq, device=device).to(device, dtype),
+                 "bond_mask":      scn_bond_mask(seq).to(device, dtype) }
+    if SCAFFOLDS_CACHE_INFO["maxsize"]:
+        SCAFFOLDS_CACHE[key] = scaffolds
+        while len(SCAFFOLDS_CACHE) > SCAFFOLDS_CACHE_INFO["maxsize"]:
+            SCAFFOLDS_CACHE.popitem(last=False)
+    return scaffolds
+
+
+def build_scaffolds_from_scn_angles_batch(int_seq, angles=None):
+    """ Builds the scaffolds of a batch of proteins straight from tensors,
+        in the device of `int_seq` (no host transfer or python strings).
+        Inputs: 
+        * int_seq: (B, L) long tensor of sidechainnet aa tokens (see `INDEX2AAS`).
+                   padded at the end with 20 ("_")
+        * angles: (B, L, 12) tensor containing the internal angles.
+                  see `build_scaffolds_from_scn_angles`
+        Outputs: dict of batched scaffolds, as returned by `stack_scaffolds`:
+        * cloud_mask: (B, L, 14)
+        * point_ref_mask: (B, 3, L, 11)
+        * angles_mask: (B, 2, L, 14)
+        * bond_mask: (B, L, 14)
+        * padding_mask: (B, L) bool. True for padding positions
+    """
+    int_seq = int_seq.long()
+    if angles is not None:
+        angles = angles.to(int_seq.device)
+    precise = angles.dtype if angles is not None else torch.get_default_dtype()
+    return {"cloud_mask":     scn_cloud_mask(int_seq).bool(), 
+            "point_ref_mask": scn_index_mask(int_seq).long(),
+            "angles_mask":    scn_angle_mask(int_seq, angles, device=int_seq.device).to(precise).transpose(0, 1),
+            "bond_mask":      scn_bond_mask(int_seq).to(precise),
+            "padding_mask":   int_seq == AAS2INDEX["_"] }
+
+
 #############################
 ####### ENCODERS ############
 #############################
@@ -173,7 +313,7 @@ def modify_angles_mask_with_torsions(seq, angles_mask, torsions):
     c_beta = torsions.shape[-1] == 5 # whether c_beta torsion is passed as well
     start = 4 if c_beta else 5
     # get mask of to-fill values
-    torsion_mask = torch.tensor([SUPREME_INFO[aa]["torsion_mask"] for aa in seq]).to(torsions.device) # (L, 14)
+    torsion_mask = get_kb_tables(torsions.device)["torsion_mask"][scn_seq_idxs(seq).to(torsions.device)] # (L, 14)
     torsion_mask = torsion_mask != torsion_mask # values that are nan need replace
     # undesired outside of margins
     torsion_mask[:, :start] = torsion_mask[:, start+torsions.shape[-1]:] = False
@@ -189,50 +329,66 @@ def modify_scaffolds_with_coords(scaffolds, coords):
         * coords: (L, 14, 3). sidechainnet tensor. same device as scaffolds
         Outputs: corrected scaffolds
     """
+    # views with a batch dim of 1: filled in place
+    batch = {key: scaffolds[key].unsqueeze(0) 
+             for key in ["cloud_mask", "point_ref_mask", "angles_mask", "bond_mask"]}
+    modify_scaffolds_with_coords_batch(batch, coords.unsqueeze(0))
+    return scaffolds
 
 
-    # calculate distances and update: 
-    # N, CA, C
-    scaffolds["bond_mask"][1:, 0] = torch.norm(coords[1:, 0] - coords[:-1, 2], dim=-1) # N
-    scaffolds["bond_mask"][ :, 1] = torch.norm(coords[ :, 1] - coords[:  , 0], dim=-1) # CA
-    scaffolds["bond_mask"][ :, 2] = torch.norm(coords[ :, 2] - coords[:  , 1], dim=-1) # C
-    # O, CB, side chain
-    selector = np.arange(len(coords))
-    for i in range(3, 14):
-        # get indexes
-        idx_a, idx_b, idx_c = scaffolds["point_ref_mask"][:, :, i-3] # (3, L, 11) -> 3 * (L, 11)
-        # correct distances
-        scaffolds["bond_mask"][:, i] = torch.norm(coords[:, i] - coords[selector, idx_c], dim=-1)
-        # get angles
-        scaffolds["angles_mask"][0, :, i] = get_angle(coords[selector, idx_b], 
-                                                      coords[selector, idx_c], 
-                                                      coords[:, i])
-        # handle C-beta, where the C requested is from the previous aa
-        if i == 4:
-            # for 1st residue, use position of the second residue's N
-            first_next_n     = coords[1, :1] # 1, 3
-            # the c requested is from the previous residue
-            main_c_prev_idxs = coords[selector[:-1], idx_a[1:]]# (L-1), 3
-            # concat
-            coords_a = torch.cat([first_next_n, main_c_prev_idxs])
-        else:
-            coords_a = coords[selector, idx_a]
-        # get dihedrals
-        scaffolds["angles_mask"][1, :, i] = get_dihedral(coords_a,
-                                                         coords[selector, idx_b], 
-                                                         coords[selector, idx_c], 
-                                                         coords[:, i])
+def modify_scaffolds_with_coords_batch(scaffolds, coords):
+    """ Fills batched scaffolds with the bond lengths, bond angles and dihedrals
+        measured in the coords, in one pass. Only the atoms in the cloud mask
+        are modified (padding and missing atoms keep their values).
+        Inputs: 
+        * scaffolds: dict. as returned by `stack_scaffolds` or 
+                     `build_scaffolds_from_scn_angles_batch`
+        * coords: (B, L, 14, 3). sidechainnet tensor. same device as scaffolds
+        Outputs: corrected scaffolds
+    """
+    cloud_mask  = scaffolds["cloud_mask"].bool()
+    bond_mask   = scaffolds["bond_mask"]
+    angles_mask = scaffolds["angles_mask"]
+    batch, length = cloud_mask.shape[:2]
+
+    def fill(target, value, mask):
+        target.copy_( torch.where(mask, value.to(target.dtype), target) )
+
+    # O, CB, side chain: every (a, b, c, point) quadruple at once
+    # (B, 3, L, 11) -> (B, L, 11 * 3) -> (B, L, 11, 3, 3)
+    idxs = rearrange(scaffolds["point_ref_mask"], 'b p l s -> b l (s p)')
+    refs = coords.gather(2, idxs.unsqueeze(-1).expand(-1, -1, -1, 3)).view(batch, length, 11, 3, 3)
+    point_a, point_b, point_c = refs.unbind(dim=-2)
+    # C-beta: the c requested is from the previous aa. 
+    # for 1st residue, use position of the second residue's N
+    prev_a = coords.roll(1, dims=1).gather(2, idxs[..., 3:4].unsqueeze(-1).expand(-1, -1, -1, 3))
+    prev_a[:, 0] = coords[:, 1, :1]
+    point_a = torch.cat([point_a[:, :, :1], prev_a, point_a[:, :, 2:]], dim=-2)
+    points  = coords[:, :, 3:]
+
+    mask = cloud_mask[..., 3:]
+    fill(bond_mask[..., 3:], torch.norm(points - point_c, dim=-1), mask)
+    fill(angles_mask[:, 0, :, 3:], get_angle(point_b, point_c, points), mask)
+    fill(angles_mask[:, 1, :, 3:], get_dihedral(point_a, point_b, point_c, points), mask)
+
+    # N, CA, C. (the N is the one of the next residue for the N slot angles)
+    n, ca, c = coords[:, :, 0], coords[:, :, 1], coords[:, :, 2]
+    fill(bond_mask[:, 1:, 0], torch.norm(n[:, 1:] - c[:, :-1], dim=-1), cloud_mask[:, 1:, 0]) # N
+    fill(bond_mask[:,  :, 1], torch.norm(ca - n, dim=-1), cloud_mask[..., 1]) # CA
+    fill(bond_mask[:,  :, 2], torch.norm(c - ca, dim=-1), cloud_mask[..., 2]) # C
     # correct angles and dihedrals for backbone 
-    scaffolds["angles_mask"][0, :-1, 0] = get_angle(coords[:-1, 1], coords[:-1, 2], coords[1: , 0]) # ca_c_n
-    scaffolds["angles_mask"][0, 1:,  1] = get_angle(coords[:-1, 2], coords[1:,  0], coords[1: , 1]) # c_n_ca
-    scaffolds["angles_mask"][0,  :,  2] = get_angle(coords[:,   0], coords[ :,  1], coords[ : , 2]) # n_ca_c
-    
+    fill(angles_mask[:, 0, :-1, 0], get_angle(ca[:, :-1], c[:, :-1], n[:, 1:]), cloud_mask[:, 1:, 0]) # ca_c_n
+    fill(angles_mask[:, 0, 1:,  1], get_angle(c[:, :-1], n[:, 1:], ca[:, 1:]), cloud_mask[:, 1:, 1]) # c_n_ca
+    fill(angles_mask[:, 0,  :,  2], get_angle(n, ca, c), cloud_mask[..., 2]) # n_ca_c
     # N determined by previous psi = f(n, ca, c, n+1)
-    scaffolds["angles_mask"][1, :-1, 0] = get_dihedral(coords[:-1, 0], coords[:-1, 1], coords[:-1, 2], coords[1:, 0])
+    fill(angles_mask[:, 1, :-1, 0], get_dihedral(n[:, :-1], ca[:, :-1], c[:, :-1], n[:, 1:]), 
+         cloud_mask[:, 1:, 0])
     # CA determined by omega = f(ca, c, n+1, ca+1)
-    scaffolds["angles_mask"][1,  1:, 1] = get_dihedral(coords[:-1, 1], coords[:-1, 2], coords[1:, 0], coords[1:, 1])
+    fill(angles_mask[:, 1, 1:, 1], get_dihedral(ca[:, :-1], c[:, :-1], n[:, 1:], ca[:, 1:]), 
+         cloud_mask[:, 1:, 1])
     # C determined by phi = f(c-1, n, ca, c)
-    scaffolds["angles_mask"][1,  1:, 2] = get_dihedral(coords[:-1, 2], coords[1:, 0], coords[1:, 1], coords[1:, 2])
+    fill(angles_mask[:, 1, 1:, 2], get_dihedral(c[:, :-1], n[:, 1:], ca[:, 1:], c[:, 1:]), 
+         cloud_mask[:, 1:, 2])
 
     return scaffolds
 
@@ -242,112 +398,849 @@ def modify_scaffolds_with_coords(scaffolds, coords):
 ##################################
 
 
-def protein_fold(cloud_mask, point_ref_mask, angles_mask, bond_mask,
-                 device=torch.device("cpu"), hybrid=False):
-    """ Calcs coords of a protein given it's
-        sequence and internal angles.
+def stack_scaffolds(scaffolds_list):
+    """ Pads and stacks the scaffolds of several proteins into a batch.
         Inputs: 
-        * cloud_mask: (L, 14) mask of points that should be converted to coords 
-        * point_ref_mask: (3, L, 11) maps point (except n-ca-c) to idxs of
-                                     previous 3 points in the coords array
-        * angles_mask: (2, 14, L) maps point to theta and dihedral
-        * bond_mask: (L, 14) gives the length of the bond originating that atom
+        * scaffolds_list: list of dicts. as returned by `build_scaffolds_from_scn_angles`
+        Outputs: dict of batched scaffolds plus the padding mask:
+        * cloud_mask: (B, L, 14)
+        * point_ref_mask: (B, 3, L, 11)
+        * angles_mask: (B, 2, L, 14)
+        * bond_mask: (B, L, 14)
+        * padding_mask: (B, L) bool. True for padding positions
+    """
+    max_len = max(scaffolds["cloud_mask"].shape[0] for scaffolds in scaffolds_list)
+    batch = {}
+    for key, dim in [("cloud_mask", 0), ("point_ref_mask", 1), ("angles_mask", 1), ("bond_mask", 0)]:
+        padded = []
+        for scaffolds in scaffolds_list:
+            x = scaffolds[key]
+            pad = [0, 0] * (x.dim() - dim - 1) + [0, max_len - x.shape[dim]]
+            padded.append( torch.nn.functional.pad(x, pad) )
+        batch[key] = torch.stack(padded, dim=0)
 
-        Output: (L, 14, 3) and (L, 14) coordinates and cloud_mask
+    lengths = torch.tensor([scaffolds["cloud_mask"].shape[0] for scaffolds in scaffolds_list],
+                           device=batch["cloud_mask"].device)
+    batch["padding_mask"] = torch.arange(max_len, device=lengths.device).unsqueeze(0) >= lengths.unsqueeze(-1)
+    return batch
+
+
+def pack_scaffolds(scaffolds_list):
+    """ Concatenates the scaffolds of several proteins along the length 
+        dim (no padding), so the cost of folding is proportional to the
+        real number of residues. see `protein_fold_packed`
+        Inputs: 
+        * scaffolds_list: list of dicts. as returned by `build_scaffolds_from_scn_angles`
+        Outputs: dict of packed scaffolds (N = sum of lengths) plus the offsets:
+        * cloud_mask: (N, 14)
+        * point_ref_mask: (3, N, 11)
+        * angles_mask: (2, N, 14)
+        * bond_mask: (N, 14)
+        * cu_seqlens: (B+1,) long. start of each protein in the packed dim (and N)
     """
-    # automatic type (float, mixed, double) and size detection
-    precise = bond_mask.dtype
-    length  = cloud_mask.shape[0]
-    # create coord wrapper
-    coords = torch.zeros(length, 14, 3, device=device, dtype=precise)
+    batch = {}
+    for key, dim in [("cloud_mask", 0), ("point_ref_mask", 1), ("angles_mask", 1), ("bond_mask", 0)]:
+        batch[key], batch["cu_seqlens"] = pack_tensors([scaffolds[key] for scaffolds in scaffolds_list],
+                                                       dim=dim)
+    return batch
+
+
+def pack_tensors(tensors, dim=0):
+    """ Concatenates tensors of different lengths along `dim`.
+        Inputs: 
+        * tensors: list of B tensors. same shape except for `dim`
+        * dim: int. the length dim
+        Outputs: packed tensor and (B+1,) long cu_seqlens
+    """
+    lengths = torch.tensor([0] + [x.shape[dim] for x in tensors], device=tensors[0].device)
+    return torch.cat(tensors, dim=dim), torch.cumsum(lengths, dim=0)
+
+
+def unpack_tensors(x, cu_seqlens, dim=0, padding_value=None):
+    """ Inverse of `pack_tensors`.
+        Inputs: 
+        * x: packed tensor
+        * cu_seqlens: (B+1,) long. as returned by `pack_tensors`
+        * dim: int. the length dim
+        * padding_value: optional. if passed, returns a (B, ...) padded batch instead
+        Outputs: list of B tensors or the padded batch
+    """
+    lengths = torch.diff(cu_seqlens).tolist()
+    tensors = list(torch.split(x, lengths, dim=dim))
+    if padding_value is None:
+        return tensors
+    max_len = max(lengths)
+    padded  = []
+    for t in tensors:
+        pad = [0, 0] * (t.dim() - dim - 1) + [0, max_len - t.shape[dim]]
+        padded.append( torch.nn.functional.pad(t, pad, value=padding_value) )
+    return torch.stack(padded, dim=0)
+
+
+def packed_chain_ids(cu_seqlens):
+    """ Inputs: 
+        * cu_seqlens: (B+1,) long. as returned by `pack_tensors`
+        Outputs: (N,) long. idx of the protein each packed residue belongs to
+    """
+    return torch.repeat_interleave(torch.arange(cu_seqlens.shape[0] - 1, device=cu_seqlens.device),
+                                   torch.diff(cu_seqlens))
+
+
+def chain_starts(breaks):
+    """ Marks the residues that start a chain (or a segment after a break).
+        Inputs: 
+        * breaks: (..., L) bool, True at the 1st residue of each chain. 
+                  or (..., L) int chain ids
+        Outputs: (..., L) bool. always True for the 1st residue
+    """
+    starts = torch.ones_like(breaks, dtype=torch.bool)
+    if breaks.dtype == torch.bool:
+        starts[..., 1:] = breaks[..., 1:]
+    else:
+        starts[..., 1:] = breaks[..., 1:] != breaks[..., :-1]
+    return starts
+
+
+def backbone_fragments(angles_mask, bond_mask, first=True, memory_efficient=False):
+    """ Builds the backbone of each residue in its local frame: N in the origin
+        and the previous (CA, C) in [1,0,0], [1,1,0]. 
+        Inputs: 
+        * angles_mask: (B, 2, L, 14) maps point to theta and dihedral
+        * bond_mask: (B, L, 14) gives the length of the bond originating that atom
+        * first: bool. whether the 1st residue starts the chain (placed in the 
+                 x,y plane since it has no previous residue). or (B, L) bool
+                 tensor: True for every residue that starts a chain
+        * memory_efficient: bool. whether to use the custom backward of `MpNerfFunction`
+        Output: (B, L, 4, 3) local coords of N, CA, C and the N of the next residue
+    """
+    device = bond_mask.device
+    batch, length = bond_mask.shape[:2]
 
-    # do first AA
-    coords[0, 1] = coords[0, 0] + torch.tensor([1, 0, 0], device=device, dtype=precise) * BB_BUILD_INFO["BONDLENS"]["n-ca"] 
-    coords[0, 2] = coords[0, 1] + torch.tensor([torch.cos(np.pi - angles_mask[0, 0, 2]),
-                                                torch.sin(np.pi - angles_mask[0, 0, 2]),
-                                                0.], device=device, dtype=precise) * BB_BUILD_INFO["BONDLENS"]["ca-c"]
-    
     # starting positions (in the x,y plane) and normal vector [0,0,1]
-    init_a = repeat(torch.tensor([1., 0., 0.], device=device, dtype=precise), 'd -> l d', l=length)
-    init_b = repeat(torch.tensor([1., 1., 0.], device=device, dtype=precise), 'd -> l d', l=length)
-    # do N -> CA. don't do 1st since its done already
-    thetas, dihedrals = angles_mask[:, :, 1]
-    coords[1:, 1] = mp_nerf_torch(init_a,
-                                   init_b, 
-                                   coords[:, 0], 
-                                   bond_mask[:, 1], 
-                                   thetas, dihedrals)[1:]
-    # do CA -> C. don't do 1st since its done already
-    thetas, dihedrals = angles_mask[:, :, 2]
-    coords[1:, 2] = mp_nerf_torch(init_b,
-                                   coords[:, 0],
-                                   coords[:, 1],
-                                   bond_mask[:, 2],
-                                   thetas, dihedrals)[1:]
+    origin = torch.zeros(batch, length, 3, device=device, dtype=bond_mask.dtype)
+    init_a = origin + torch.tensor([1., 0., 0.], device=device, dtype=bond_mask.dtype)
+    init_b = origin + torch.tensor([1., 1., 0.], device=device, dtype=bond_mask.dtype)
+
+    # do N -> CA
+    thetas, dihedrals = angles_mask[:, :, :, 1].unbind(dim=1)
+    ca = mp_nerf_torch(init_a, init_b, origin, bond_mask[..., 1], thetas, dihedrals, 
+                       validate="off", memory_efficient=memory_efficient)
+    # do first AA: N in the origin, CA in the x axis and C in the x,y plane
+    starts = first if torch.is_tensor(first) else None
+    if starts is not None or first:
+        first_theta = np.pi - angles_mask[:, 0, :, 2] if starts is not None else \
+                      np.pi - angles_mask[:, 0, :1, 2]
+        first_ca = init_a[:, :first_theta.shape[1]] * BB_BUILD_INFO["BONDLENS"]["n-ca"]
+        first_c  = first_ca + BB_BUILD_INFO["BONDLENS"]["ca-c"] * \
+                              torch.stack([torch.cos(first_theta),
+                                           torch.sin(first_theta),
+                                           torch.zeros_like(first_theta)], dim=-1)
+    if starts is not None:
+        ca = torch.where(starts.unsqueeze(-1), first_ca, ca)
+    elif first:
+        ca = torch.cat([first_ca, ca[:, 1:]], dim=1)
+    # do CA -> C
+    thetas, dihedrals = angles_mask[:, :, :, 2].unbind(dim=1)
+    c = mp_nerf_torch(init_b, origin, ca, bond_mask[..., 2], thetas, dihedrals, 
+                      validate="off", memory_efficient=memory_efficient)
+    if starts is not None:
+        c = torch.where(starts.unsqueeze(-1), first_c, c)
+    elif first:
+        c = torch.cat([first_c, c[:, 1:]], dim=1)
     # do C -> N
-    thetas, dihedrals = angles_mask[:, :, 0]
-    coords[:, 3] = mp_nerf_torch(coords[:, 0],
-                                   coords[:, 1],
-                                   coords[:, 2],
-                                   bond_mask[:, 0],
-                                   thetas, dihedrals)
+    thetas, dihedrals = angles_mask[:, :, :, 0].unbind(dim=1)
+    n_next = mp_nerf_torch(origin, ca, c, bond_mask[..., 0], thetas, dihedrals, 
+                           validate="off", memory_efficient=memory_efficient)
+    return torch.stack([origin, ca, c, n_next], dim=-2)
 
-    #########
-    # sequential pass to join fragments
-    #########
+
+def backbone_rotations(backbone):
+    """ Rotation that takes the local frame of the next residue to the frame
+        of each residue, as given by its (CA, C, N+1).
+        Inputs: 
+        * backbone: (B, L, 4, 3) as returned by `backbone_fragments`
+        Output: (B, L, 3, 3) rotation matrices
+    """
+    origin = torch.zeros(3, device=backbone.device, dtype=backbone.dtype)
+    init_a = origin + torch.tensor([1., 0., 0.], device=backbone.device, dtype=backbone.dtype)
+    init_b = origin + torch.tensor([1., 1., 0.], device=backbone.device, dtype=backbone.dtype)
     # part of rotation mat corresponding to origin - 3 orthogonals
-    mat_origin  = get_axis_matrix(init_a[0], init_b[0], coords[0, 0], norm=False)
+    mat_origin  = get_axis_matrix(init_a, init_b, origin, norm=False)
     # part of rotation mat corresponding to destins || a, b, c = CA, C, N+1
-    # (L-1) since the first is in the origin already 
-    mat_destins = get_axis_matrix(coords[:-1, 1], coords[:-1, 2], coords[:-1, 3])
+    mat_destins = get_axis_matrix(backbone[:, :, 1], backbone[:, :, 2], backbone[:, :, 3])
 
     # get rotation matrices from origins
     # https://math.stackexchange.com/questions/1876615/rotation-matrix-from-plane-a-to-b
-    rotations  = torch.matmul(mat_origin.t(), mat_destins)
-    rotations /= torch.norm(rotations, dim=-1, keepdim=True)
-
-    # do rotation concatenation - do for loop in cpu always - faster
-    rotations = rotations.cpu() if coords.is_cuda and hybrid else rotations
-    for i in range(1, length-1):
-        rotations[i] = torch.matmul(rotations[i], rotations[i-1])
-    rotations = rotations.to(device) if coords.is_cuda and hybrid else rotations
+    rotations = torch.matmul(mat_origin.t(), mat_destins)
+    return rotations / torch.norm(rotations, dim=-1, keepdim=True)
+
+
+def backbone_fold_batch(angles_mask, bond_mask, hybrid=False, scan=None, validate=None,
+                        memory_efficient=False, backbone_dtype=None, orthonormalize=None,
+                        breaks=None, break_frames=None):
+    """ Calcs the backbone (N, CA, C) of a batch of proteins.
+        Inputs: 
+        * angles_mask: (B, 2, L, 14) maps point to theta and dihedral
+        * bond_mask: (B, L, 14) gives the length of the bond originating that atom
+        * hybrid: bool. whether to do the sequential rotation concatenation in cpu
+        * scan: bool or None. whether to chain rotations with a parallel scan.
+                None picks it automatically by length (see `chain_rotations`)
+        * validate: None or one of ["strict", "warn-once", "off"]. see `validate_thetas`
+        * memory_efficient: bool. whether to use the custom backward of `MpNerfFunction`
+        * backbone_dtype: optional. dtype of the computation. the output is cast
+                          back to the dtype of bond_mask
+        * orthonormalize: optional int K. re-orthonormalize the chained rotations
+                          every K residues. see `chain_rotations`
+        * breaks: optional. (B, L) bool (True at the 1st residue of each chain) or 
+                  int chain ids. each chain starts in the origin instead of being 
+                  joined to the previous residue
+        * break_frames: optional. tuple of (B, S, 3, 3) rotations and (B, S, 3)
+                        translations of the S chains: x -> x @ R + t
+        Output: (B, L, 4, 3) coords of N, CA, C and the N of the next residue
+    """
+    validate_thetas(angles_mask[:, 0, :, :3], validate=validate)
+    precise = bond_mask.dtype
+    if backbone_dtype is not None:
+        angles_mask, bond_mask = angles_mask.to(backbone_dtype), bond_mask.to(backbone_dtype)
+    length = bond_mask.shape[1]
+
+    starts = None if breaks is None else chain_starts(breaks.to(bond_mask.device))
+    backbone = backbone_fragments(angles_mask, bond_mask, first=True if starts is None else starts,
+                                  memory_efficient=memory_efficient)
+
+    if length < 2:
+        return break_transform(backbone, starts, break_frames).to(precise)
+
+    #########
+    # sequential pass to join fragments
+    #########
+    # (L-1) since the first is in the origin already 
+    rotations = backbone_rotations(backbone[:, :-1])
+    resets = None
+    if starts is not None:
+        # chains start in the origin: restart the product with the identity
+        resets = starts[:, 1:]
+        rotations = torch.where(resets[..., None, None], 
+                                torch.eye(3, device=rotations.device, dtype=rotations.dtype),
+                                rotations)
+
+    # do rotation concatenation - parallel scan or sequential loop
+    rotations = chain_rotations(rotations, scan=scan, hybrid=hybrid, orthonormalize=orthonormalize,
+                                resets=resets)
+
     # rotate all
-    coords[1:, :4] = torch.matmul(coords[1:, :4], rotations)
+    rotated = torch.matmul(backbone[:, 1:], rotations)
     # offset each position by cumulative sum at that position
-    coords[1:, :4] += torch.cumsum(coords[:-1, 3], dim=0).unsqueeze(-2)
+    offsets = torch.cat([backbone[:, :1, 3], rotated[:, :-1, 3]], dim=1)
+    offsets = torch.cumsum(offsets, dim=1)
+    if starts is not None:
+        # minus the cumulative sum at the start of each chain
+        steps = torch.arange(length-1, device=offsets.device).expand_as(resets)
+        last  = torch.where(resets, steps, -1).cummax(dim=-1)[0]
+        base  = offsets.gather(1, last.clamp(min=0).unsqueeze(-1).expand(-1, -1, 3))
+        offsets = offsets - base * (last >= 0).unsqueeze(-1)
+    rotated = rotated + offsets.unsqueeze(-2)
 
+    backbone = torch.cat([backbone[:, :1], rotated], dim=1)
+    return break_transform(backbone, starts, break_frames).to(precise)
+
+
+def break_transform(coords, starts, break_frames=None):
+    """ Moves each chain to its frame. 
+        Inputs: 
+        * coords: (B, L, N, 3) coords of each chain in its own frame
+        * starts: (B, L) bool or None. as returned by `chain_starts`
+        * break_frames: optional. tuple of (B, S, 3, 3) rotations and (B, S, 3)
+                        translations of the S chains: x -> x @ R + t
+        Outputs: (B, L, N, 3) coords
+    """
+    if starts is None or break_frames is None:
+        return coords
+    rotations, translations = break_frames
+    chain = torch.cumsum(starts, dim=-1) - 1
+    rotations = rotations.to(coords).gather(1, chain[..., None, None].expand(-1, -1, 3, 3))
+    translations = translations.to(coords).gather(1, chain[..., None].expand(-1, -1, 3))
+    return torch.matmul(coords, rotations) + translations.unsqueeze(-2)
+
+
+def sidechain_level_idxs(cloud_mask):
+    """ Precomputes the gather indexes of the sidechain levels, 
+        so no `nonzero()` (host-device sync) is needed while folding.
+        Inputs: 
+        * cloud_mask: (..., L, 14) mask of points that should be converted to coords 
+        Outputs: list of 11 (N_i,) long tensors. flat (batch * L) indexes of the
+                 residues that have an atom at each level (3, ..., 13)
+    """
+    cloud_mask = cloud_mask.reshape(-1, 14)[:, 3:].bool()
+    counts = cloud_mask.sum(dim=0).tolist()
+    # sorted by level, then by residue
+    idxs = cloud_mask.t().nonzero()[:, 1]
+    return list(torch.split(idxs, counts))
+
+
+def check_lone_c_betas(idxs, length, starts=None):
+    """ Raises if a c-beta is in a 1-residue chain: it's placed from the 2nd residue's CA.
+        Inputs: 
+        * idxs: (N,) long tensor. flat (batch * L) idxs of the 1st residues with c-beta
+        * length: int. L, to find the last residue of each chain
+        * starts: optional. (B*L,) bool. residues that start a chain (see `chain_starts`)
+    """
+    if starts is None:
+        last = (idxs + 1) % length == 0
+    else:
+        after = (idxs + 1).clamp(max=starts.shape[0] - 1)
+        last  = (idxs + 1 == starts.shape[0]) | starts[after]
+    if last.any():
+        raise ValueError("The c-beta of the 1st residue is placed from the 2nd one's CA: "
+                         "1-residue chains (or segments) can't have a c-beta")
+
+
+def sidechain_gathers(idxs, atoms, point_ref_mask, length, starts=None, check=False):
+    """ Flat gather indexes (in the (B*L*14, 3) coords) of the atoms to place
+        and of their 3 reference points.
+        Inputs: 
+        * idxs: (N,) long tensor. flat (batch * L) idxs of the residues
+        * atoms: (N,) long tensor or int. atom idx (3, ..., 13) placed in each residue
+        * point_ref_mask: (3, B*L, 11) flattened `point_ref_mask`
+        * length: int. L, to find the 1st residue of each chain
+        * starts: optional. (B*L,) bool. residues that start a chain (see `chain_starts`)
+        * check: bool. whether to raise for the c-beta of 1-residue chains. it's a 
+                 host-device sync, so only done where the idxs are precomputed
+        Outputs: (4, N) long tensor. flat idxs of (d, a, b, c)
+    """
+    atoms = torch.as_tensor(atoms, device=idxs.device).expand_as(idxs)
+    idx_a, idx_b, idx_c = point_ref_mask[:, idxs, atoms-3]
+    # to place C-beta, we need the carbons from prev res. for the 1st residue
+    # of each chain, use position of the second residue's CA
+    c_beta = atoms == 4
+    first  = c_beta & ((idxs % length == 0) if starts is None else starts[idxs])
+    # the 2nd residue must be in the same chain
+    if check:
+        check_lone_c_betas(idxs[first], length, starts=starts)
+    rows_a = torch.where(c_beta, torch.where(first, idxs + 1, idxs - 1), idxs)
+    idx_a  = torch.where(first, torch.ones_like(idx_a), idx_a)
+    return torch.stack([idxs*14 + atoms, rows_a*14 + idx_a, 
+                        idxs*14 + idx_b, idxs*14 + idx_c], dim=0)
+
+
+def sidechain_dag_idxs(cloud_mask, point_ref_mask, c_beta=True, breaks=None):
+    """ Schedules the sidechain atoms by their depth in the dependency DAG
+        given by `point_ref_mask`: the oxygen and c-beta only need the backbone,
+        and branches (ex. CG1/CG2 of Ile/Val) share their parents. All atoms
+        at the same depth are placed in a single `mp_nerf_torch` call.
+        Inputs: 
+        * cloud_mask: (..., L, 14) mask of points that should be converted to coords 
+        * point_ref_mask: (..., 3, L, 11) maps point (except n-ca-c) to idxs of
+                                          previous 3 points in the coords array
+        * c_beta: whether to place cbeta. otherwise it's taken as given
+        * breaks: optional. (..., L) chain breaks or ids. see `chain_starts`
+        Outputs: list of (4, N_d) long tensors, one per depth. flat idxs of 
+                 (d, a, b, c) as returned by `sidechain_gathers`
+    """
+    length = cloud_mask.shape[-2]
+    cloud_mask = cloud_mask.reshape(-1, 14).bool()
+    point_ref_mask = point_ref_mask.reshape(-1, 3, length, 11).transpose(0, 1).reshape(3, -1, 11)
+    rows = torch.arange(cloud_mask.shape[0], device=cloud_mask.device).unsqueeze(-1)
+
+    # backbone (and given c-beta) at depth 0. others go after their deepest reference
+    depth = torch.zeros(cloud_mask.shape, dtype=torch.long, device=cloud_mask.device)
+    place = cloud_mask.clone()
+    place[:, :3] = False
+    for i in range(3, 14):
+        if i == 4 and not c_beta:
+            place[:, 4] = False
+            continue
+        depth[:, i] = depth[rows, point_ref_mask[:, :, i-3].t()].amax(dim=-1) + 1
+
+    # sorted by depth, then by residue
+    idxs, atoms = place.nonzero().unbind(dim=-1)
+    levels = depth[idxs, atoms]
+    order  = torch.argsort(levels, stable=True)
+    counts = torch.bincount(levels)[1:].tolist()
+    if not counts:
+        return []
+    starts  = None if breaks is None else chain_starts(breaks.to(idxs.device)).reshape(-1)
+    gathers = sidechain_gathers(idxs[order], atoms[order], point_ref_mask, length, starts=starts,
+                                check=True)
+    return list(torch.split(gathers, counts, dim=1))
+
+
+def sidechain_fold_batch(wrapper, cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                         c_beta=True, level_idxs=None, validate=None, memory_efficient=False,
+                         checkpoint=False, breaks=None):
+    """ Places the oxygen, c-beta and side chain atoms of a batch of proteins.
+        Works inplace on the wrapper.
+        Inputs: 
+        * wrapper: (B, L, 14, 3). coords container with backbone ([..., :3])
+        * cloud_mask: (B, L, 14) mask of points that should be converted to coords 
+        * point_ref_mask: (B, 3, L, 11) maps point (except n-ca-c) to idxs of
+                                        previous 3 points in the coords array
+        * angles_mask: (B, 2, L, 14) maps point to theta and dihedral
+        * bond_mask: (B, L, 14) gives the length of the bond originating that atom
+        * c_beta: whether to place cbeta
+        * level_idxs: optional. as returned by `sidechain_dag_idxs` (must match c_beta)
+                      or `sidechain_level_idxs` (one level per atom). 
+                      defaults to the dependency DAG of `sidechain_dag_idxs`
+        * validate: None or one of ["strict", "warn-once", "off"]. see `validate_thetas`
+        * memory_efficient: bool. whether to use the custom backward of `MpNerfFunction`
+        * checkpoint: bool or int. whether to recompute groups of levels in the
+                      backward pass (`torch.utils.checkpoint`) instead of storing
+                      their activations. an int sets the levels per group (default 4)
+        * breaks: optional. (B, L) chain breaks or ids (see `chain_starts`). the
+                  c-beta of the 1st residue of each chain is placed as the 1st one's
+        Output: (B, L, 14, 3) the wrapper
+    """
+    validate_thetas(angles_mask[:, 0, :, 3:], validate=validate)
+    batch, length = wrapper.shape[:2]
+    if level_idxs is None:
+        level_idxs = sidechain_dag_idxs(cloud_mask, point_ref_mask, c_beta=c_beta, breaks=breaks)
+    elif len(level_idxs) and level_idxs[0].dim() == 1:
+        # one level per atom, as given by `sidechain_level_idxs`
+        flat_ref_mask = point_ref_mask.transpose(0, 1).reshape(3, batch*length, 11)
+        starts = None if breaks is None else chain_starts(breaks.to(wrapper.device)).reshape(-1)
+        check = (VALIDATION["policy"] if validate is None else validate) != "off"
+        level_idxs = [sidechain_gathers(idxs, i, flat_ref_mask, length, starts=starts,
+                                        check=check and i == 4)
+                      for i, idxs in enumerate(level_idxs, start=3) if i != 4 or c_beta]
+
+    if checkpoint and torch.is_grad_enabled():
+        group = 4 if checkpoint is True else int(checkpoint)
+        # each group works on a copy, so only its input coords are kept for backward
+        def fold_group(coords, angles_mask, bond_mask, level_idxs):
+            return sidechain_fold_batch(coords.clone(), cloud_mask, point_ref_mask, angles_mask,
+                                        bond_mask, level_idxs=level_idxs, validate="off",
+                                        memory_efficient=memory_efficient)
+        # the wrapper is written at the end, so it can't be a saved input
+        coords = wrapper.clone()
+        for k in range(0, len(level_idxs), group):
+            coords = torch.utils.checkpoint.checkpoint(fold_group, coords, angles_mask, bond_mask,
+                                                       level_idxs[k:k+group], use_reentrant=False)
+        return wrapper.copy_(coords)
+
+    # flatten the batch so every level is a single call
+    coords = wrapper.view(batch*length*14, 3)
+    thetas, dihedrals = angles_mask.transpose(0, 1).reshape(2, batch*length*14)
+    bonds = bond_mask.reshape(batch*length*14)
+
+    # parallel sidechain - do the oxygen, c-beta and side chain
+    for gather in level_idxs:
+        coords[gather[0]] = mp_nerf_torch(coords[gather[1]], 
+                                          coords[gather[2]],
+                                          coords[gather[3]],
+                                          bonds[gather[0]], 
+                                          thetas[gather[0]], dihedrals[gather[0]], 
+                                          validate="off", memory_efficient=memory_efficient)
+    return wrapper
+
+
+def protein_fold_batch(cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                       padding_mask=None, lengths=None, device=None, hybrid=False,
+                       scan=None, level_idxs=None, validate=None, memory_efficient=False,
+                       checkpoint=False, backbone_dtype=None, orthonormalize=None,
+                       breaks=None, break_frames=None):
+    """ Calcs coords of a batch of (padded) proteins given their 
+        sequences and internal angles.
+        Inputs: 
+        * cloud_mask: (B, L, 14) mask of points that should be converted to coords 
+        * point_ref_mask: (B, 3, L, 11) maps point (except n-ca-c) to idxs of
+                                        previous 3 points in the coords array
+        * angles_mask: (B, 2, L, 14) maps point to theta and dihedral
+        * bond_mask: (B, L, 14) gives the length of the bond originating that atom
+        * padding_mask: optional. (B, L) bool. True for padding positions
+        * lengths: optional. (B,) int. length of each chain (alternative to padding_mask)
+        * device: optional. device of the output. defaults to the scaffolds' one
+        * hybrid: bool. whether to do the sequential rotation concatenation in cpu
+        * scan: bool or None. whether to chain rotations with a parallel scan.
+                None picks it automatically by length (see `chain_rotations`)
+        * level_idxs: optional. as returned by `sidechain_dag_idxs` or
+                      `sidechain_level_idxs`. must account for the padding_mask if passed
+        * validate: None or one of ["strict", "warn-once", "off"]. see `validate_thetas`
+        * memory_efficient: bool. whether to use the custom backward of `MpNerfFunction`
+        * checkpoint: bool or int. whether to recompute the backbone and groups of
+                      sidechain levels in the backward pass instead of storing
+                      their activations. see `sidechain_fold_batch`
+        * backbone_dtype: optional. dtype of the backbone. ex: torch.float64 with
+                          float32 scaffolds keeps float64 accuracy along long chains
+                          while the sidechains run in float32
+        * orthonormalize: optional int K. re-orthonormalize the chained rotations
+                          every K residues. see `chain_rotations`
+        * breaks: optional. (B, L) bool, True at the 1st residue of each chain 
+                  (or segment after missing residues), or (B, L) int chain ids.
+                  chains are folded in the same call but not joined by a peptide bond
+        * break_frames: optional. tuple of (B, S, 3, 3) rotations and (B, S, 3)
+                        translations placing each of the S chains: x -> x @ R + t.
+                        by default every chain starts in the origin
+
+        Output: (B, L, 14, 3) and (B, L, 14) coordinates and cloud_mask
+    """
+    # check all angles at once - single sync
+    validate_thetas(angles_mask[:, 0], validate=validate)
+    device = bond_mask.device if device is None else device
+    cloud_mask, point_ref_mask, angles_mask, bond_mask = [
+        x.to(device) for x in (cloud_mask, point_ref_mask, angles_mask, bond_mask)
+    ]
+    batch, length = cloud_mask.shape[:2]
+    if padding_mask is None and lengths is not None:
+        padding_mask = torch.arange(length, device=device).unsqueeze(0) >= \
+                       torch.as_tensor(lengths, device=device).unsqueeze(-1)
+
+    sidechain_breaks = breaks
+    if padding_mask is not None:
+        padding_mask = padding_mask.to(device)
+        cloud_mask = cloud_mask * ~padding_mask.unsqueeze(-1)
+        # fill padding with glycine geometry so the backbone stays finite
+        fill   = padding_mask.unsqueeze(-1)
+        tables = get_kb_tables(device)
+        glycine = AAS2INDEX["G"]
+        angles_mask = torch.where(fill.unsqueeze(1), 
+                                  torch.stack([tables["theta_mask"][glycine],
+                                               tables["torsion_mask_filled"][glycine]], 
+                                              dim=0).to(angles_mask.dtype).unsqueeze(1), 
+                                  angles_mask)
+        bond_mask = torch.where(fill, tables["bond_mask"][glycine].to(bond_mask.dtype), bond_mask)
+        # padding starts a chain for the sidechains: the c-beta of a 1-residue 
+        # protein raises as in `protein_fold_packed` instead of using a padding CA
+        sidechain_breaks = padding_mask if breaks is None else \
+                           padding_mask | chain_starts(breaks.to(device))
+
+    # create coord wrapper
+    coords = torch.zeros(batch, length, 14, 3, device=device, dtype=bond_mask.dtype)
+    if checkpoint and torch.is_grad_enabled():
+        coords[:, :, :4] = torch.utils.checkpoint.checkpoint(
+            backbone_fold_batch, angles_mask, bond_mask, hybrid=hybrid, scan=scan,
+            validate="off", memory_efficient=memory_efficient, backbone_dtype=backbone_dtype,
+            orthonormalize=orthonormalize, breaks=breaks, break_frames=break_frames,
+            use_reentrant=False
+        )
+    else:
+        coords[:, :, :4] = backbone_fold_batch(angles_mask, bond_mask, hybrid=hybrid, scan=scan,
+                                               validate="off", memory_efficient=memory_efficient,
+                                               backbone_dtype=backbone_dtype,
+                                               orthonormalize=orthonormalize,
+                                               breaks=breaks, break_frames=break_frames)
+    # parallel sidechain - do the oxygen, c-beta and side chain
+    coords = sidechain_fold_batch(coords, cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                                  level_idxs=level_idxs, validate="off",
+                                  memory_efficient=memory_efficient, checkpoint=checkpoint,
+                                  breaks=sidechain_breaks)
+
+    if padding_mask is not None:
+        coords = coords.masked_fill(padding_mask.unsqueeze(-1).unsqueeze(-1), 0.)
+    return coords, cloud_mask
+
+
+def protein_fold_chunked(cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                         chunk_size=1024, out=None, scan=None, validate=None,
+                         memory_efficient=False, backbone_dtype=None, orthonormalize=None):
+    """ Folds a protein in segments of `chunk_size` residues, carrying the 
+        chained rotation and the offset of the last residue to the next segment.
+        Each segment (backbone and sidechains) is written into `out` before 
+        the next one is built, so besides `out` memory is O(chunk_size) 
+        instead of O(L). Meant for inference on huge assemblies.
+        Inputs: 
+        * cloud_mask: (L, 14) mask of points that should be converted to coords 
+        * point_ref_mask: (3, L, 11) maps point (except n-ca-c) to idxs of
+                                     previous 3 points in the coords array
+        * angles_mask: (2, L, 14) maps point to theta and dihedral
+        * bond_mask: (L, 14) gives the length of the bond originating that atom
+        * chunk_size: int >= 2. residues per segment
+        * out: optional. (L, 14, 3) tensor where to write the coords
+        * scan: bool or None. see `chain_rotations`
+        * validate: None or one of ["strict", "warn-once", "off"]. see `validate_thetas`
+        * memory_efficient: bool. whether to use the custom backward of `MpNerfFunction`
+        * backbone_dtype: optional. dtype of the backbone. see `protein_fold_batch`
+        * orthonormalize: optional int K. re-orthonormalize the chained rotations
+                          every K residues and at every segment boundary
+
+        Output: (L, 14, 3) and (L, 14) coordinates and cloud_mask
+    """
+    assert chunk_size >= 2, "chunk_size must be >= 2: c-beta needs the previous residue"
+    validate_thetas(angles_mask[0], validate=validate)
+    device = bond_mask.device
+    dtype  = bond_mask.dtype if backbone_dtype is None else backbone_dtype
+    length = cloud_mask.shape[0]
+    if out is None:
+        out = torch.zeros(length, 14, 3, device=device, dtype=bond_mask.dtype)
+    else:
+        out.zero_()
+
+    # chained rotation of the previous residue and position of the next N
+    rotation = torch.eye(3, device=device, dtype=dtype).expand(1, 1, 3, 3)
+    offset   = torch.zeros(1, 1, 3, device=device, dtype=dtype)
+    for start in range(0, length, chunk_size):
+        end = min(start + chunk_size, length)
+
+        # local fragments of the segment, joined to the carried frame
+        backbone  = backbone_fragments(angles_mask[:, start:end].unsqueeze(0).to(dtype),
+                                       bond_mask[start:end].unsqueeze(0).to(dtype),
+                                       first=start == 0, memory_efficient=memory_efficient)
+        rotations = chain_rotations(backbone_rotations(backbone), scan=scan,
+                                    orthonormalize=orthonormalize)
+        rotations = torch.matmul(rotations, rotation)
+        rotated   = torch.matmul(backbone, torch.cat([rotation, rotations[:, :-1]], dim=1))
+        # offset each position by cumulative sum at that position
+        offsets   = torch.cat([offset, rotated[:, :-1, 3]], dim=1)
+        rotated   = rotated + torch.cumsum(offsets, dim=1).unsqueeze(-2)
+        out[start:end, :4] = rotated[0]
+
+        rotation = rotations[:, -1:]
+        if orthonormalize:
+            rotation = orthonormalize_rotations(rotation)
+        offset = rotated[:, -1, 3:]
+
+        # sidechains of the segment. the previous residue is kept (but not placed)
+        # so the c-beta of the 1st one finds its carbon
+        prev = max(start - 1, 0)
+        chunk_mask = cloud_mask[prev:end].clone()
+        chunk_mask[:start-prev, 3:] = False
+        sidechain_fold_batch(out[prev:end].unsqueeze(0), chunk_mask.unsqueeze(0),
+                             point_ref_mask[:, prev:end].unsqueeze(0),
+                             angles_mask[:, prev:end].unsqueeze(0), bond_mask[prev:end].unsqueeze(0),
+                             validate="off", memory_efficient=memory_efficient)
+    # report the carried global frame, not the local product of the last segment
+    record_orthonormality_error(rotation[:, 0])
+    return out, cloud_mask
+
+
+def protein_fold_packed(cloud_mask, point_ref_mask, angles_mask, bond_mask, cu_seqlens, 
+                        **kwargs):
+    """ Folds a packed batch of proteins (as returned by `pack_scaffolds`) in
+        a single call: every protein is a chain (see `breaks` in `protein_fold`), 
+        so no compute is spent on padding.
+        Inputs: 
+        * cloud_mask: (N, 14) mask of points that should be converted to coords 
+        * point_ref_mask: (3, N, 11) maps point (except n-ca-c) to idxs of
+                                     previous 3 points in the coords array
+        * angles_mask: (2, N, 14) maps point to theta and dihedral
+        * bond_mask: (N, 14) gives the length of the bond originating that atom
+        * cu_seqlens: (B+1,) long. start of each protein in the packed dim
+        * kwargs: passed to `protein_fold`
+
+        Output: (N, 14, 3) and (N, 14) packed coordinates and cloud_mask.
+                see `unpack_tensors`
+    """
+    return protein_fold(cloud_mask, point_ref_mask, angles_mask, bond_mask, 
+                        breaks=packed_chain_ids(cu_seqlens.to(bond_mask.device)), **kwargs)
+
+
+def to_numpy(x):
+    """ Returns a numpy view (cpu) or copy (other devices) of a tensor. """
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def sidechain_fold_numpy(wrapper, cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                         c_beta=True, level_idxs=None, validate=None):
+    """ NumPy engine for `sidechain_fold`. Works inplace on the wrapper.
+        Inputs: same as `sidechain_fold`, as np.ndarrays or cpu tensors.
+        * wrapper: (L, 14, 3) np.ndarray
+        Output: (L, 14, 3) the wrapper
+    """
+    cloud_mask, point_ref_mask, angles_mask, bond_mask = [
+        to_numpy(x) for x in (cloud_mask, point_ref_mask, angles_mask, bond_mask)
+    ]
+    validate_thetas(angles_mask[0, :, 3:], validate=validate)
+    if level_idxs is None:
+        level_idxs = [np.nonzero(cloud_mask[:, i])[0] for i in range(3, 14)]
 
-    #########
     # parallel sidechain - do the oxygen, c-beta and side chain
-    #########
     for i in range(3,14):
-        level_mask = cloud_mask[:, i]
-        thetas, dihedrals = angles_mask[:, level_mask, i]
-        idx_a, idx_b, idx_c = point_ref_mask[:, level_mask, i-3]
+        # skip cbeta if arg is set
+        if i == 4 and not c_beta:
+            continue
+        # prepare inputs
+        idxs = to_numpy(level_idxs[i-3])
+        thetas, dihedrals = angles_mask[:, idxs, i]
+        idx_a, idx_b, idx_c = point_ref_mask[:, idxs, i-3]
 
         # to place C-beta, we need the carbons from prev res - not available for the 1st res
         if i == 4:
-            # the c requested is from the previous residue - offset boolean mask by one
-            # can't be done with slicing bc glycines are inside chain (dont have cb)
-            coords_a = coords[(level_mask.nonzero().view(-1) - 1), idx_a] # (L-1), 3
-            # if first residue is not glycine, 
-            # for 1st residue, use position of the second residue's N (1,3)
-            if level_mask[0].item():
-                coords_a[0] = coords[1, 1]
+            # for 1st residue, use position of the second residue's CA
+            first = idxs == 0
+            coords_a = wrapper[np.where(first, idxs + 1, idxs - 1), np.where(first, 1, idx_a)]
         else:
-            coords_a = coords[level_mask, idx_a]
+            coords_a = wrapper[idxs, idx_a]
 
-        coords[level_mask, i] = mp_nerf_torch(coords_a, 
-                                              coords[level_mask, idx_b],
-                                              coords[level_mask, idx_c],
-                                              bond_mask[level_mask, i], 
-                                              thetas, dihedrals)
-    
+        wrapper[idxs, i] = mp_nerf_numpy(coords_a, 
+                                         wrapper[idxs, idx_b],
+                                         wrapper[idxs, idx_c],
+                                         bond_mask[idxs, i], 
+                                         thetas, dihedrals, validate="off")
+    return wrapper
+
+
+def protein_fold_numpy(cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                       scan=None, level_idxs=None, validate=None):
+    """ NumPy engine for `protein_fold`. Faster for short chains in cpu.
+        Inputs: same as `protein_fold`, as np.ndarrays or cpu tensors.
+        Output: (L, 14, 3) and (L, 14) np.ndarrays. coordinates and cloud_mask
+    """
+    cloud_mask, point_ref_mask, angles_mask, bond_mask = [
+        to_numpy(x) for x in (cloud_mask, point_ref_mask, angles_mask, bond_mask)
+    ]
+    # check all angles at once
+    validate_thetas(angles_mask[0], validate=validate)
+    length = cloud_mask.shape[0]
+    # create coord wrapper
+    coords = np.zeros((length, 14, 3), dtype=bond_mask.dtype)
+
+    # starting positions (in the x,y plane) and normal vector [0,0,1]
+    origin = np.zeros((length, 3), dtype=bond_mask.dtype)
+    init_a = origin + np.array([1., 0., 0.], dtype=bond_mask.dtype)
+    init_b = origin + np.array([1., 1., 0.], dtype=bond_mask.dtype)
+
+    # do first AA
+    first_theta = np.pi - angles_mask[0, 0, 2]
+    coords[0, 1] = init_a[0] * BB_BUILD_INFO["BONDLENS"]["n-ca"]
+    coords[0, 2] = coords[0, 1] + BB_BUILD_INFO["BONDLENS"]["ca-c"] * \
+                                  np.array([np.cos(first_theta), np.sin(first_theta), 0.])
+    # do N -> CA. don't do 1st since its done already
+    thetas, dihedrals = angles_mask[:, :, 1]
+    coords[1:, 1] = mp_nerf_numpy(init_a, init_b, origin, bond_mask[:, 1], 
+                                  thetas, dihedrals, validate="off")[1:]
+    # do CA -> C. don't do 1st since its done already
+    thetas, dihedrals = angles_mask[:, :, 2]
+    coords[1:, 2] = mp_nerf_numpy(init_b, origin, coords[:, 1], bond_mask[:, 2], 
+                                  thetas, dihedrals, validate="off")[1:]
+    # do C -> N
+    thetas, dihedrals = angles_mask[:, :, 0]
+    coords[:, 3] = mp_nerf_numpy(origin, coords[:, 1], coords[:, 2], bond_mask[:, 0], 
+                                 thetas, dihedrals, validate="off")
+
+    if length > 1:
+        # sequential pass to join fragments
+        mat_origin  = get_axis_matrix_numpy(init_a[0], init_b[0], origin[0], norm=False)
+        mat_destins = get_axis_matrix_numpy(coords[:-1, 1], coords[:-1, 2], coords[:-1, 3])
+        rotations = np.matmul(mat_origin.T, mat_destins)
+        rotations = rotations / np.linalg.norm(rotations, axis=-1, keepdims=True)
+        rotations = chain_rotations_numpy(rotations, scan=scan)
+        # rotate all
+        coords[1:, :4] = np.matmul(coords[1:, :4], rotations)
+        # offset each position by cumulative sum at that position
+        coords[1:, :4] += np.cumsum(coords[:-1, 3], axis=0)[:, None]
+
+    # parallel sidechain - do the oxygen, c-beta and side chain
+    coords = sidechain_fold_numpy(coords, cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                                  level_idxs=level_idxs, validate="off")
     return coords, cloud_mask
 
 
+def check_unsupported(path, options):
+    """ Raises for the options a folding path would silently drop.
+        Inputs: 
+        * path: str. name of the path (ex. "workspace") for the error message
+        * options: dict of option name -> whether it was given
+    """
+    dropped = [k for k, v in options.items() if v]
+    if dropped:
+        raise ValueError(f"{', '.join(dropped)} not supported with {path}")
+
+
+def check_no_grad(path, *tensors):
+    """ Raises if gradients would be silently lost by a path outside autograd. """
+    if torch.is_grad_enabled() and any(x.requires_grad for x in tensors):
+        raise ValueError(f"{path} doesn't support autograd. use the torch backend")
+
+
+def protein_fold(cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                 device=torch.device("cpu"), hybrid=False, scan=None, level_idxs=None,
+                 validate=None, backend="torch", workspace=None, out=None,
+                 memory_efficient=False, checkpoint=False, backbone_dtype=None,
+                 orthonormalize=None, chunk_size=None, breaks=None, break_frames=None):
+    """ Calcs coords of a protein given it's
+        sequence and internal angles.
+        Inputs: 
+        * cloud_mask: (L, 14) mask of points that should be converted to coords 
+        * point_ref_mask: (3, L, 11) maps point (except n-ca-c) to idxs of
+                                     previous 3 points in the coords array
+        * angles_mask: (2, 14, L) maps point to theta and dihedral
+        * bond_mask: (L, 14) gives the length of the bond originating that atom
+        * hybrid: bool. whether to do the sequential rotation concatenation in cpu
+        * scan: bool or None. whether to chain rotations with a parallel scan.
+                None picks it automatically by length (see `chain_rotations`)
+        * level_idxs: optional. as returned by `sidechain_dag_idxs` or 
+                      `sidechain_level_idxs` (only the latter for the numpy backend)
+        * validate: None or one of ["strict", "warn-once", "off"]. see `validate_thetas`
+        * backend: one of ["torch", "numpy"]. "numpy" runs `protein_fold_numpy`
+                   (faster for short chains in cpu) and returns a zero-copy tensor
+        * workspace: optional. `FoldWorkspace` whose buffers are reused (inference only)
+        * out: optional. (L, 14, 3) tensor where to write the coords
+        * memory_efficient: bool. whether to use the custom backward of `MpNerfFunction`
+        * checkpoint: bool or int. whether to trade compute for memory in the
+                      backward pass. see `protein_fold_batch`
+        * backbone_dtype: optional. dtype of the backbone (accuracy along the chain).
+                          see `protein_fold_batch`
+        * orthonormalize: optional int K. re-orthonormalize the chained rotations
+                          every K residues. see `chain_rotations`
+        * chunk_size: optional int. fold in segments of chunk_size residues
+                      streamed into `out` (bounded memory). see `protein_fold_chunked`
+        * breaks: optional. (L,) bool, True at the 1st residue of each chain, or 
+                  (L,) int chain ids. see `protein_fold_batch`. torch backend only
+        * break_frames: optional. tuple of (S, 3, 3) rotations and (S, 3) 
+                        translations of the S chains. see `protein_fold_batch`
+        Options a path doesn't support (ex. `checkpoint` with `chunk_size`, or 
+        `orthonormalize` with `workspace` or the numpy backend) raise a ValueError.
+
+        Output: (L, 14, 3) and (L, 14) coordinates and cloud_mask
+    """
+    # options the chunked, workspace and numpy paths would silently drop
+    given = {"hybrid": hybrid, "level_idxs": level_idxs is not None, 
+             "memory_efficient": memory_efficient, "checkpoint": checkpoint, 
+             "backbone_dtype": backbone_dtype is not None, "orthonormalize": orthonormalize, 
+             "breaks": breaks is not None, "break_frames": break_frames is not None}
+    if chunk_size is not None:
+        path, unsupported = "chunk_size", ["hybrid", "level_idxs", "checkpoint", 
+                                           "breaks", "break_frames"]
+    elif workspace is not None:
+        path, unsupported = "workspace", [k for k in given]
+    elif backend == "numpy":
+        path, unsupported = "the numpy backend", [k for k in given if k != "level_idxs"]
+    else:
+        path, unsupported = None, []
+    if (chunk_size is not None or workspace is not None) and backend != "torch":
+        raise ValueError("chunk_size and workspace are only supported by the torch backend")
+    if chunk_size is not None and workspace is not None:
+        raise ValueError("chunk_size and workspace can't be combined")
+    check_unsupported(path, {k: given[k] for k in unsupported})
+    if backend == "numpy":
+        check_no_grad("the numpy backend", angles_mask, bond_mask)
+
+    if chunk_size is not None and cloud_mask.shape[0] > chunk_size:
+        return protein_fold_chunked(cloud_mask.to(device), point_ref_mask.to(device),
+                                    angles_mask.to(device), bond_mask.to(device),
+                                    chunk_size=chunk_size, out=out, scan=scan, validate=validate,
+                                    memory_efficient=memory_efficient,
+                                    backbone_dtype=backbone_dtype, orthonormalize=orthonormalize)
+
+    if workspace is not None:
+        return workspace.fold(cloud_mask, point_ref_mask, angles_mask, bond_mask, out=out,
+                              scan=scan, validate=validate)
+
+    if backend == "numpy":
+        coords, _ = protein_fold_numpy(cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                                       scan=scan, level_idxs=level_idxs, validate=validate)
+        if out is not None:
+            return out.copy_(torch.from_numpy(coords)), cloud_mask
+        return torch.from_numpy(coords), cloud_mask
+
+    coords, _ = protein_fold_batch(cloud_mask.unsqueeze(0), point_ref_mask.unsqueeze(0),
+                                   angles_mask.unsqueeze(0), bond_mask.unsqueeze(0),
+                                   device=device, hybrid=hybrid, scan=scan,
+                                   level_idxs=level_idxs, validate=validate,
+                                   memory_efficient=memory_efficient, checkpoint=checkpoint,
+                                   backbone_dtype=backbone_dtype, orthonormalize=orthonormalize,
+                                   breaks=None if breaks is None else breaks.unsqueeze(0),
+                                   break_frames=None if break_frames is None else 
+                                                [x.unsqueeze(0) for x in break_frames])
+    if out is not None:
+        return out.copy_(coords[0]), cloud_mask
+    return coords[0], cloud_mask
+
+
 def sidechain_fold(wrapper, cloud_mask, point_ref_mask, angles_mask, bond_mask,
-                   device=torch.device("cpu"), c_beta=False):
+                   device=torch.device("cpu"), c_beta=False, level_idxs=None, validate=None,
+                   backend="torch", workspace=None, memory_efficient=False, checkpoint=False):
     """ Calcs coords of a protein given it's sequence and internal angles.
         Inputs: 
         * wrapper: (L, 14, 3). coords container with backbone ([:, :3]) and optionally
@@ -358,37 +1251,346 @@ def sidechain_fold(wrapper, cloud_mask, point_ref_mask, angles_mask, bond_mask,
         * angles_mask: (2, 14, L) maps point to theta and dihedral
         * bond_mask: (L, 14) gives the length of the bond originating that atom
         * c_beta: whether to place cbeta
+        * level_idxs: optional. as returned by `sidechain_dag_idxs` (must match c_beta) or 
+                      `sidechain_level_idxs` (only the latter for the numpy backend)
+        * validate: None or one of ["strict", "warn-once", "off"]. see `validate_thetas`
+        * backend: one of ["torch", "numpy"]. "numpy" runs `sidechain_fold_numpy`
+                   on a view of the (cpu) wrapper
+        * workspace: optional. `FoldWorkspace` whose buffers are reused (inference only)
+        * memory_efficient: bool. whether to use the custom backward of `MpNerfFunction`
+        * checkpoint: bool or int. whether to trade compute for memory in the
+                      backward pass. see `sidechain_fold_batch`
+
+        Options a path doesn't support (ex. `checkpoint` with `workspace` or 
+        the numpy backend) raise a ValueError, as do inputs that require grad
+        with the numpy backend.
 
         Output: (L, 14, 3) and (L, 14) coordinates and cloud_mask
     """
-    precise = wrapper.dtype
+    given = {"level_idxs": level_idxs is not None, "memory_efficient": memory_efficient, 
+             "checkpoint": checkpoint}
+    if workspace is not None:
+        if backend != "torch":
+            raise ValueError("workspace is only supported by the torch backend")
+        check_unsupported("workspace", given)
+        workspace.sidechain_fold(wrapper, cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                                 c_beta=c_beta, validate=validate)
+        return wrapper, cloud_mask
 
-    # parallel sidechain - do the oxygen, c-beta and side chain
-    for i in range(3,14):
-        # skip cbeta if arg is set
-        if i == 4 and not c_beta:
+    if backend == "numpy":
+        check_unsupported("the numpy backend", {k: given[k] for k in ["memory_efficient", "checkpoint"]})
+        check_no_grad("the numpy backend", wrapper, angles_mask, bond_mask)
+        sidechain_fold_numpy(wrapper.detach().numpy(), cloud_mask, point_ref_mask, angles_mask,
+                             bond_mask, c_beta=c_beta, level_idxs=level_idxs, validate=validate)
+        return wrapper, cloud_mask
+
+    sidechain_fold_batch(wrapper.unsqueeze(0), cloud_mask.unsqueeze(0), point_ref_mask.unsqueeze(0),
+                         angles_mask.unsqueeze(0), bond_mask.unsqueeze(0), c_beta=c_beta,
+                         level_idxs=level_idxs, validate=validate,
+                         memory_efficient=memory_efficient, checkpoint=checkpoint)
+    return wrapper, cloud_mask
+
+
+##################################
+####### RIGID GROUPS #############
+##################################
+
+
+def build_rigid_groups(aa):
+    """ Idealized rigid groups of an aa, from the KB geometry. Every atom whose
+        dihedral is free (oxygen, c-beta and the "p" sidechain torsions) starts 
+        a group: the `get_nerf_frame` of its 3 reference points. Every other atom 
+        has a fixed dihedral, so it's rigid in every frame where its 3 reference
+        points are: it belongs to the first such group. Groups are derived from
+        the KB's `torsion_mask` and `idx_mask`; coords from one placement of the aa.
+        Inputs: 
+        * aa: str. 1-letter aa code
+        Outputs: dict of np.ndarrays
+        * starts: (14,) bool. whether each atom starts a group
+        * group: (14,) idx of the atom starting the group of each atom
+        * local: (14, 3) coords of each atom in the frame of its group
+        * parent: (14,) for starting atoms, idx of the atom starting the group where
+                  its reference points are rigid. -1 if they are backbone atoms
+        * depth: (14,) number of groups between each group and the backbone
+        * rot, trans: (14, 3, 3), (14, 3). frame (with chi=0) and origin of the
+                      reference points of each starting atom, in its parent frame
+    """
+    info = {"starts": np.zeros(14, dtype=bool), "group": np.zeros(14, dtype=np.int64),
+            "local": np.zeros((14, 3)), "parent": np.full(14, -1, dtype=np.int64),
+            "depth": np.zeros(14, dtype=np.int64), "rot": np.zeros((14, 3, 3)),
+            "trans": np.zeros((14, 3))}
+    row = INDEX2AAS.index(aa)
+    idx_mask = SUPREME_TABLES["idx_mask"][row].astype(np.int64)
+    torsion_mask = SUPREME_TABLES["torsion_mask"][row]
+    atoms  = [i for i in range(3, 14) if SUPREME_TABLES["cloud_mask"][row, i]]
+    starts = [i for i in atoms if i == 3 or np.isnan(torsion_mask[i])]
+    # dihedrals that are a constant offset of another atom's: the "i" ones of the 
+    # previous atom and the I, L anomalies (see `scn_angle_mask`). with its same refs
+    tied = {i: i - 1 for i in atoms if torsion_mask[i] == 999}
+    if aa in ["I", "L"]:
+        tied[7] = 5 if aa == "I" else 6
+
+    # points constant in the frame of each group: its axis (b, c), the atom and 
+    # (in order) every other atom whose dihedral is fixed and its 3 reference points
+    # are constant, or whose dihedral is tied to a constant atom's
+    rigid = {}
+    for g in starts:
+        rigid[g] = {*idx_mask[g-3, 1:], g}
+        for i in atoms:
+            if i <= g or i in starts:
+                continue
+            if (tied[i] in rigid[g]) if i in tied else (set(idx_mask[i-3]) <= rigid[g]):
+                rigid[g].add(i)
+
+    # place the aa after a fixed backbone from the KB: N in the origin and CA, C 
+    # as the 1st residue of `protein_fold`. position 14 is the C of the previous residue.
+    # local coords don't depend on the (free) torsions, so any placement works
+    bonds, angs = BB_BUILD_INFO["BONDLENS"], BB_BUILD_INFO["BONDANGS"]
+    coords = torch.zeros(15, 3, dtype=torch.float64)
+    coords[[1, 2, 14]] = torch.tensor([[bonds["n-ca"], 0., 0.],
+                                       [bonds["n-ca"] - bonds["ca-c"] * np.cos(angs["n-ca-c"]),
+                                        bonds["ca-c"] * np.sin(angs["n-ca-c"]), 0.],
+                                       [bonds["c-n"] * np.cos(angs["c-n-ca"]), 
+                                        bonds["c-n"] * np.sin(angs["c-n-ca"]), 0.]], dtype=torch.float64)
+    bond_mask  = torch.from_numpy(SUPREME_TABLES["bond_mask"][row])
+    theta_mask = torch.from_numpy(SUPREME_TABLES["theta_mask"][row])
+    torsions   = scn_angle_mask(aa, torch.zeros(1, 12, dtype=torch.float64))[1, 0]
+    frames, origins = torch.zeros(14, 3, 3, dtype=torch.float64), torch.zeros(14, 3, dtype=torch.float64)
+    for i in atoms:
+        idx_a, idx_b, idx_c = idx_mask[i-3]
+        idx_a = 14 if i == 4 else idx_a
+        frames[i]  = get_nerf_frame(coords[idx_a], coords[idx_b], coords[idx_c], torsions[i])
+        origins[i] = coords[idx_c]
+        coords[i]  = mp_nerf_torch(coords[idx_a], coords[idx_b], coords[idx_c], bond_mask[i],
+                                   theta_mask[i], torsions[i], validate="off")
+    local = lambda points, g: (frames[g].t() @ (coords[points] - origins[g]).t()).t().numpy()
+
+    for i in atoms:
+        candidates = [g for g in starts if g <= i and i in rigid[g]]
+        if not candidates:
+            raise ValueError(f"atom {i} of aa {aa} is not rigid in any group")
+        info["group"][i], info["local"][i] = candidates[0], local([i], candidates[0])[0]
+        if i not in starts:
             continue
-        # prepare inputs
-        level_mask = cloud_mask[:, i]
-        thetas, dihedrals = angles_mask[:, level_mask, i]
-        idx_a, idx_b, idx_c = point_ref_mask[:, level_mask, i-3]
 
-        # to place C-beta, we need the carbons from prev res - not available for the 1st res
+        info["starts"][i] = True
+        idx_a, idx_b, idx_c = idx_mask[i-3]
+        if max(idx_a, idx_b, idx_c) < 3:
+            continue
+        # child of the first group where its 3 reference points are rigid
+        parents = [g for g in starts if g < i and set(idx_mask[i-3]) <= rigid[g]]
+        if not parents:
+            raise ValueError(f"reference points of atom {i} of aa {aa} are not rigid in any group")
+        g = parents[0]
+        info["parent"][i], info["depth"][i] = g, info["depth"][g] + 1
+        info["rot"][i]   = (frames[g].t() @ get_nerf_frame(coords[idx_a], coords[idx_b],
+                                                          coords[idx_c], 0.)).numpy()
+        info["trans"][i] = (frames[g].t() @ (coords[idx_c] - origins[g])).numpy()
+    return info
+
+
+def build_rigid_tables():
+    """ `build_rigid_groups` of all aas, stacked in INDEX2AAS order. """
+    infos = [build_rigid_groups(aa) for aa in INDEX2AAS]
+    return {k: np.stack([info[k] for info in infos]) for k in infos[0]}
+
+
+# built on 1st access
+RIGID_TABLES = LazyTable(build_rigid_tables)
+
+# rigid groups of all aas, keyed by (dtype, device)
+RIGID_GROUPS = {}
+
+def get_rigid_groups(dtype=None, device=None):
+    """ Returns the `RIGID_TABLES` as tensors in a dtype and device, along with
+        the cloud and idx masks of the KB tables (see `get_kb_tables`). Cached.
+    """
+    dtype  = torch.get_default_dtype() if dtype is None else dtype
+    device = torch.device("cpu") if device is None else torch.device(device)
+    key = (dtype, device)
+    if key not in RIGID_GROUPS:
+        kb_tables = get_kb_tables(device)
+        RIGID_GROUPS[key] = {
+            k: torch.from_numpy(v).to(device, dtype if v.dtype == np.float64 else None)
+            for k, v in RIGID_TABLES.items()
+        }
+        RIGID_GROUPS[key]["cloud_mask"] = kb_tables["cloud_mask"].bool()
+        RIGID_GROUPS[key]["idx_mask"] = kb_tables["idx_mask"].long()
+    return RIGID_GROUPS[key]
+
+
+def sidechain_rigid_idxs(seq, c_beta=True, dtype=None, device=None):
+    """ Precomputes the gather indexes and constants of `sidechain_fold_rigid`,
+        so they can be reused for every fold of the same sequence.
+        Inputs: 
+        * seq: str of aas (1 letter code) or (L,) long tensor of `AAS2INDEX` idxs
+        * c_beta: whether to place cbeta
+        * dtype, device: of the coords to fold
+        Outputs: dict. all idxs are flat (L*14) idxs of (residue, atom)
+        * roots: (N,) idxs and (4, N) `sidechain_gathers` of the groups whose frame
+                 comes from the coords (attached to the backbone or the given c-beta)
+        * levels: list of (idxs, parent idxs, rot, trans) of the rest of the groups
+        * atoms: (idxs, group idxs, local coords) of the atoms to place
+    """
+    tables = get_rigid_groups(dtype, device)
+    if isinstance(seq, str):
+        seq = [AAS2INDEX[aa] for aa in seq]
+    seq = torch.as_tensor(seq, device=tables["starts"].device)
+    length = seq.shape[0]
+    starts, group, local, parent, depth, rot, trans, cloud_mask, idx_mask = [
+        tables[key][seq] for key in ["starts", "group", "local", "parent", "depth", 
+                                     "rot", "trans", "cloud_mask", "idx_mask"]
+    ]
+    place = cloud_mask.clone()
+    place[:, :3] = False
+    if not c_beta:
+        # keep the given c-beta. the groups attached to it get their frames from the coords
+        starts[:, 4] = place[:, 4] = False
+        parent = torch.where(parent == 4, -torch.ones_like(parent), parent)
+    rows = torch.arange(length, device=seq.device).unsqueeze(-1) * 14
+
+    roots = starts & (parent == -1)
+    res, atoms = roots.nonzero().unbind(dim=-1)
+    rigid_idxs = {"roots":  (res*14 + atoms,
+                             sidechain_gathers(res, atoms, idx_mask.permute(2, 0, 1), length,
+                                               check=True)),
+                  "levels": []}
+    for level in range(1, int(depth.max()) + 1):
+        mask = starts & ~roots & (depth == level)
+        rigid_idxs["levels"].append( ((rows + torch.arange(14, device=seq.device))[mask],
+                                      (rows + parent)[mask], rot[mask], trans[mask]) )
+    rigid_idxs["atoms"] = ((rows + torch.arange(14, device=seq.device))[place],
+                           (rows + group)[place], local[place])
+    return rigid_idxs
+
+
+def sidechain_fold_rigid(wrapper, seq, angles_mask, c_beta=True, rigid_idxs=None):
+    """ Alternative to `sidechain_fold` that places whole rigid groups at once,
+        with the idealized geometry of the KB (see `build_rigid_groups`). Each
+        free torsion is one frame composition, instead of one NeRF step per atom.
+        Works inplace on the wrapper.
+        Inputs: 
+        * wrapper: (L, 14, 3). coords container with backbone ([:, :3]) and optionally
+                               c_beta ([:, 4])
+        * seq: str of aas (1 letter code) or (L,) long tensor of `AAS2INDEX` idxs
+        * angles_mask: (2, L, 14) maps point to theta and dihedral. only the 
+                       dihedrals of the atoms that start a group are used
+        * c_beta: whether to place cbeta. otherwise the given one is used
+        * rigid_idxs: optional. as returned by `sidechain_rigid_idxs` (must match c_beta)
+        Output: (L, 14, 3) the wrapper
+    """
+    if rigid_idxs is None:
+        rigid_idxs = sidechain_rigid_idxs(seq, c_beta=c_beta, dtype=wrapper.dtype,
+                                          device=wrapper.device)
+    length = wrapper.shape[0]
+    coords = wrapper.view(length*14, 3)
+    chis = angles_mask[1].reshape(length*14)
+    frames  = wrapper.new_zeros(length*14, 3, 3)
+    origins = wrapper.new_zeros(length*14, 3)
+
+    # groups attached to the backbone: frames from the coords
+    idxs, gather = rigid_idxs["roots"]
+    frames[idxs]  = get_nerf_frame(coords[gather[1]], coords[gather[2]], coords[gather[3]], 
+                                   chis[idxs])
+    origins[idxs] = coords[gather[3]]
+    # the rest of the groups, composed with the frame of their parent
+    for idxs, parents, rot, trans in rigid_idxs["levels"]:
+        parent_frames = frames[parents]
+        frames[idxs]  = rotate_frame(parent_frames @ rot, chis[idxs])
+        origins[idxs] = origins[parents] + (parent_frames @ trans.unsqueeze(-1)).squeeze(-1)
+    # place all atoms in the frame of their group
+    idxs, groups, local = rigid_idxs["atoms"]
+    coords[idxs] = origins[groups] + (frames[groups] @ local.unsqueeze(-1)).squeeze(-1)
+    return wrapper
+
+
+##################################
+####### COMPILE-FRIENDLY #########
+##################################
+
+# backbone bonds of the 1st residue. torch.jit.script can't read float globals,
+# so they're bound as default args of `protein_fold_static`
+N_CA_BOND_LEN = float(BB_BUILD_INFO["BONDLENS"]["n-ca"])
+CA_C_BOND_LEN = float(BB_BUILD_INFO["BONDLENS"]["ca-c"])
+
+
+def protein_fold_static(cloud_mask: torch.Tensor, point_ref_mask: torch.Tensor,
+                        angles_mask: torch.Tensor, bond_mask: torch.Tensor,
+                        scan: bool = True, n_ca_bond_len: float = N_CA_BOND_LEN, 
+                        ca_c_bond_len: float = CA_C_BOND_LEN) -> Tuple[torch.Tensor, torch.Tensor]:
+    """ Compile-friendly version of `protein_fold`: static shapes and 
+        tensor-only control flow, so it can be passed to `torch.jit.script`
+        or `torch.compile` without graph breaks. No input validation.
+        Sidechain levels are computed for all residues and masked.
+        Inputs: same as `protein_fold`. Needs L >= 2.
+        * scan: bool. whether to chain rotations with a parallel scan
+        * n_ca_bond_len, ca_c_bond_len: float. bonds of the 1st residue
+        Output: (L, 14, 3) and (L, 14) coordinates and cloud_mask
+    """
+    length = bond_mask.shape[0]
+    # starting positions (in the x,y plane) and normal vector [0,0,1]
+    origin = torch.zeros_like(bond_mask[:, :3])
+    init_a = origin.clone()
+    init_a[:, 0] = 1.
+    init_b = origin.clone()
+    init_b[:, :2] = 1.
+
+    # do first AA
+    first_theta = math.pi - angles_mask[0, :1, 2]
+    first_ca = init_a[:1] * n_ca_bond_len
+    first_c  = first_ca + ca_c_bond_len * torch.stack([torch.cos(first_theta),
+                                                       torch.sin(first_theta),
+                                                       torch.zeros_like(first_theta)], dim=-1)
+    # do N -> CA. don't do 1st since its done already
+    ca = mp_nerf_torch_static(init_a, init_b, origin, bond_mask[:, 1], 
+                              angles_mask[0, :, 1], angles_mask[1, :, 1])
+    ca = torch.cat([first_ca, ca[1:]], dim=0)
+    # do CA -> C. don't do 1st since its done already
+    c = mp_nerf_torch_static(init_b, origin, ca, bond_mask[:, 2], 
+                             angles_mask[0, :, 2], angles_mask[1, :, 2])
+    c = torch.cat([first_c, c[1:]], dim=0)
+    # do C -> N
+    n_next = mp_nerf_torch_static(origin, ca, c, bond_mask[:, 0], 
+                                  angles_mask[0, :, 0], angles_mask[1, :, 0])
+    backbone = torch.stack([origin, ca, c, n_next], dim=-2)
+
+    # sequential pass to join fragments
+    mat_origin  = get_axis_matrix_static(init_a[0], init_b[0], origin[0], norm=False)
+    mat_destins = get_axis_matrix_static(ca[:-1], c[:-1], n_next[:-1], norm=True)
+    rotations = torch.matmul(mat_origin.t(), mat_destins)
+    rotations = rotations / torch.norm(rotations, dim=-1, keepdim=True)
+    if scan:
+        offset = 1
+        while offset < length - 1:
+            rotations = torch.cat([rotations[:offset],
+                                   torch.matmul(rotations[offset:], rotations[:-offset])], dim=0)
+            offset *= 2
+    else:
+        chained = [rotations[0]]
+        for i in range(1, length-1):
+            chained.append( torch.matmul(rotations[i], chained[-1]) )
+        rotations = torch.stack(chained, dim=0)
+    # rotate all, offset each position by cumulative sum at that position
+    rotated = torch.matmul(backbone[1:], rotations)
+    offsets = torch.cat([backbone[:1, 3], rotated[:-1, 3]], dim=0)
+    rotated = rotated + torch.cumsum(offsets, dim=0).unsqueeze(-2)
+    backbone = torch.cat([backbone[:1], rotated], dim=0)
+
+    # parallel sidechain - all residues, then keep the ones present
+    coords = torch.cat([backbone, torch.zeros_like(backbone[:, :1]).expand(-1, 10, -1)], dim=1)
+    rows = torch.arange(length, device=coords.device)
+    first = rows == 0
+    for i in range(3, 14):
+        idx_a = point_ref_mask[0, :, i-3]
+        rows_a = rows
+        # C-beta needs the C from prev res. for the 1st residue, use the second residue's CA
         if i == 4:
-            # the c requested is from the previous residue - offset boolean mask by one
-            # can't be done with slicing bc glycines are inside chain (dont have cb)
-            coords_a = wrapper[(level_mask.nonzero().view(-1) - 1), idx_a] # (L-1), 3
-            # if first residue is not glycine, 
-            # for 1st residue, use position of the second residue's N (1,3)
-            if level_mask[0].item():
-                coords_a[0] = wrapper[1, 1]
-        else:
-            coords_a = wrapper[level_mask, idx_a]
+            rows_a = torch.where(first, rows + 1, rows - 1)
+            idx_a  = torch.where(first, torch.ones_like(idx_a), idx_a)
+        level = mp_nerf_torch_static(coords[rows_a, idx_a], 
+                                     coords[rows, point_ref_mask[1, :, i-3]],
+                                     coords[rows, point_ref_mask[2, :, i-3]],
+                                     bond_mask[:, i], angles_mask[0, :, i], angles_mask[1, :, i])
+        coords[:, i] = torch.where(cloud_mask[:, i].unsqueeze(-1), level, coords[:, i])
 
-        wrapper[level_mask, i] = mp_nerf_torch(coords_a, 
-                                               wrapper[level_mask, idx_b],
-                                               wrapper[level_mask, idx_c],
-                                               bond_mask[level_mask, i], 
-                                               thetas, dihedrals)
-    
-    return wrapper, cloud_mask
+    return coords, cloud_mask
@@ -0,0 +1,241 @@
+import numpy as np
+# diff / ml
+import torch
+# module
+from mp_nerf.massive_pnerf import *
+from mp_nerf.kb_proteins import *
+
+
+class FoldWorkspace(object):
+    """ Preallocated buffers for repeated folds of proteins of up to `max_len`
+        residues. Folding through a workspace reuses the same memory every call,
+        so repeated folds make close to zero new allocations. Inference only
+        (buffers are overwritten, so no autograd).
+        Inputs:
+        * max_len: int. maximum number of residues of the folded proteins
+        * dtype: torch dtype. defaults to torch's default dtype
+        * device: torch device. defaults to cpu
+    """
+    def __init__(self, max_len, dtype=None, device=None):
+        self.max_len = max_len
+        self.dtype   = torch.get_default_dtype() if dtype is None else dtype
+        self.device  = torch.device("cpu") if device is None else torch.device(device)
+        self.key     = (self.max_len, self.dtype, self.device)
+        kwargs = {"dtype": self.dtype, "device": self.device}
+        # coords wrapper
+        self.coords  = torch.zeros(max_len, 14, 3, **kwargs)
+        # starting positions (in the x,y plane) and normal vector [0,0,1]
+        self.origin  = torch.zeros(max_len, 3, **kwargs)
+        self.init_a  = self.origin + torch.tensor([1., 0., 0.], **kwargs)
+        self.init_b  = self.origin + torch.tensor([1., 1., 0.], **kwargs)
+        self.mat_origin_t = get_axis_matrix(self.init_a[0], self.init_b[0], self.origin[0],
+                                            norm=False).t().contiguous()
+        # nerf scratch: gathered points, rotation basis (as rows), proto point
+        self.abc     = torch.zeros(3, max_len, 3, **kwargs)
+        self.ba      = torch.zeros(max_len, 3, **kwargs)
+        self.basis   = torch.zeros(max_len, 3, 3, **kwargs)
+        self.norms   = torch.zeros(max_len, 3, 1, **kwargs)
+        self.d       = torch.zeros(max_len, 1, 3, **kwargs)
+        self.trig    = torch.zeros(max_len, **kwargs)
+        self.internals = torch.zeros(3, max_len, **kwargs) # bond, theta, dihedral
+        self.result  = torch.zeros(max_len, 1, 3, **kwargs)
+        self.points  = torch.zeros(max_len, 3, **kwargs)
+        # backbone join: rotations (ping-pong for the scan), rotated backbone, offsets
+        self.rotations = torch.zeros(2, max_len, 3, 3, **kwargs)
+        self.rot_tmp   = torch.zeros(3, 3, **kwargs)
+        self.backbone  = torch.zeros(max_len, 4, 3, **kwargs)
+        self.offsets   = torch.zeros(max_len, 3, **kwargs)
+        # sidechain gather indexes of the last scaffolds seen
+        self.scaffolds = (None, None)
+        self.gathers   = None
+
+
+    def check(self, length, dtype, device):
+        """ Ensures a protein can be folded with this workspace. """
+        if length > self.max_len:
+            raise ValueError(f"protein of length {length} exceeds workspace max_len {self.max_len}")
+        if dtype != self.dtype or torch.device(device) != self.device:
+            raise ValueError(f"scaffolds ({dtype}, {device}) don't match workspace {self.key}")
+
+
+    def prepare(self, cloud_mask, point_ref_mask):
+        """ Precomputes the flat gather indexes of the sidechain levels.
+            Cached for the last scaffolds passed (compared by identity).
+            Inputs:
+            * cloud_mask: (L, 14) mask of points that should be converted to coords
+            * point_ref_mask: (3, L, 11) maps point (except n-ca-c) to idxs of
+                                         previous 3 points in the coords array
+            Outputs: list of 11 (4, N_i) long tensors. flat idxs of (d, a, b, c)
+        """
+        if self.scaffolds[0] is cloud_mask and self.scaffolds[1] is point_ref_mask:
+            return self.gathers
+
+        self.gathers = []
+        for i in range(3, 14):
+            idxs = cloud_mask[:, i].nonzero().view(-1)
+            idx_a, idx_b, idx_c = point_ref_mask[:, idxs, i-3]
+            rows_a = idxs
+            # to place C-beta, we need the carbons from prev res - for the 1st res,
+            # use position of the second residue's CA
+            if i == 4:
+                first  = idxs == 0
+                rows_a = torch.where(first, idxs + 1, idxs - 1)
+                idx_a  = torch.where(first, torch.ones_like(idx_a), idx_a)
+            self.gathers.append( torch.stack([idxs*14 + i, rows_a*14 + idx_a,
+                                              idxs*14 + idx_b, idxs*14 + idx_c], dim=0) )
+        self.scaffolds = (cloud_mask, point_ref_mask)
+        return self.gathers
+
+
+    def nerf(self, a, b, c, l, theta, chi, out):
+        """ Inplace version of `mp_nerf_torch` over the workspace buffers.
+            Inputs: same as `mp_nerf_torch` (batched).
+            * out: (N, 3). where to write the new points
+        """
+        n = theta.shape[0]
+        ba, basis, norms, d, trig = self.ba[:n], self.basis[:n], self.norms[:n], self.d[:n], self.trig[:n]
+        # calc vecs, plane normals. rows of the basis are: cb, n_plane_, n_plane
+        torch.sub(b, a, out=ba)
+        torch.sub(c, b, out=basis[:, 0])
+        torch.linalg.cross(ba, basis[:, 0], out=basis[:, 2])
+        torch.linalg.cross(basis[:, 2], basis[:, 0], out=basis[:, 1])
+        torch.linalg.vector_norm(basis, dim=-1, keepdim=True, out=norms)
+        basis.div_(norms)
+        # calc proto point (-1 for sidechainnet convention)
+        torch.cos(theta, out=d[:, 0, 0]).neg_()
+        torch.sin(theta, out=d[:, 0, 1])
+        d[:, 0, 2].copy_(d[:, 0, 1])
+        d[:, 0, 1].mul_(torch.cos(chi, out=trig))
+        d[:, 0, 2].mul_(torch.sin(chi, out=trig))
+        # rotate, extend base point, set length
+        torch.matmul(d, basis, out=self.result[:n])
+        return torch.addcmul(c, l.unsqueeze(-1), self.result[:n, 0], out=out)
+
+
+    def chain_rotations(self, n, scan=None):
+        """ Inplace version of `chain_rotations` for the first `n` rotations
+            in the workspace. Returns the buffer with the chained rotations.
+        """
+        if scan is None:
+            scan = n >= SCAN_MIN_LENGTH
+        src, dst = self.rotations[0, :n], self.rotations[1, :n]
+        if not scan:
+            for i in range(1, n):
+                src[i].copy_( torch.matmul(src[i], src[i-1], out=self.rot_tmp) )
+            return src
+
+        offset = 1
+        while offset < n:
+            dst[:offset].copy_(src[:offset])
+            torch.matmul(src[offset:], src[:-offset], out=dst[offset:])
+            src, dst = dst, src
+            offset *= 2
+        return src
+
+
+    def sidechain_fold(self, wrapper, cloud_mask, point_ref_mask, angles_mask, bond_mask,
+                       c_beta=True, validate=None):
+        """ Places the oxygen, c-beta and side chain atoms. Inplace on the wrapper.
+            Inputs: same as `sidechain_fold`.
+            Outputs: (L, 14, 3) the wrapper
+        """
+        if torch.is_grad_enabled() and (wrapper.requires_grad or angles_mask.requires_grad or
+                                        bond_mask.requires_grad):
+            raise ValueError("workspaces are for inference only. use sidechain_fold without it")
+        validate_thetas(angles_mask[0, :, 3:], validate=validate)
+        flat = wrapper.view(-1, 3)
+        bond_flat, theta_flat, chi_flat = bond_mask.reshape(-1), angles_mask[0].reshape(-1), \
+                                          angles_mask[1].reshape(-1)
+        for i, gather in enumerate(self.prepare(cloud_mask, point_ref_mask), start=3):
+            # skip cbeta if arg is set
+            n = gather.shape[1]
+            if (i == 4 and not c_beta) or n == 0:
+                continue
+            a, b, c = self.abc[:, :n]
+            l, theta, chi = self.internals[:, :n]
+            for src, idx, dst in [(flat, gather[1], a), (flat, gather[2], b), (flat, gather[3], c),
+                                  (bond_flat, gather[0], l), (theta_flat, gather[0], theta),
+                                  (chi_flat, gather[0], chi)]:
+                torch.index_select(src, 0, idx, out=dst)
+            flat.index_copy_(0, gather[0], self.nerf(a, b, c, l, theta, chi, out=self.points[:n]))
+        return wrapper
+
+
+    def fold(self, cloud_mask, point_ref_mask, angles_mask, bond_mask, out=None,
+             scan=None, validate=None):
+        """ Calcs coords of a protein as `protein_fold` does, but reusing the
+            workspace buffers.
+            Inputs: same as `protein_fold`.
+            * out: optional. (L, 14, 3) where to write the coords. if not passed,
+                   the returned coords are a view of the workspace buffer,
+                   overwritten by the next fold
+            Outputs: (L, 14, 3) and (L, 14) coordinates and cloud_mask
+        """
+        if torch.is_grad_enabled() and (angles_mask.requires_grad or bond_mask.requires_grad):
+            raise ValueError("workspaces are for inference only. use protein_fold without it")
+        length = cloud_mask.shape[0]
+        self.check(length, bond_mask.dtype, bond_mask.device)
+        # check all angles at once
+        validate_thetas(angles_mask[0], validate=validate)
+
+        coords = self.coords[:length] if out is None else out
+        coords.zero_()
+        init_a, init_b, origin = self.init_a[:length], self.init_b[:length], self.origin[:length]
+
+        # do first AA
+        coords[0, 1, 0] = BB_BUILD_INFO["BONDLENS"]["n-ca"]
+        first_theta = torch.neg(angles_mask[0, 0, 2:3], out=self.trig[:1]).add_(np.pi)
+        torch.cos(first_theta, out=coords[0, 2, 0:1])
+        torch.sin(first_theta, out=coords[0, 2, 1:2])
+        coords[0, 2].mul_(BB_BUILD_INFO["BONDLENS"]["ca-c"]).add_(coords[0, 1])
+        # do N -> CA. don't do 1st since its done already
+        thetas, dihedrals = angles_mask[:, 1:, 1]
+        self.nerf(init_a[1:], init_b[1:], origin[1:], bond_mask[1:, 1], thetas, dihedrals,
+                  out=coords[1:, 1])
+        # do CA -> C. don't do 1st since its done already
+        thetas, dihedrals = angles_mask[:, 1:, 2]
+        self.nerf(init_b[1:], origin[1:], coords[1:, 1], bond_mask[1:, 2], thetas, dihedrals,
+                  out=coords[1:, 2])
+        # do C -> N
+        thetas, dihedrals = angles_mask[:, :, 0]
+        self.nerf(origin, coords[:, 1], coords[:, 2], bond_mask[:, 0], thetas, dihedrals,
+                  out=coords[:, 3])
+
+        if length > 1:
+            n = length - 1
+            # part of rotation mat corresponding to destins || a, b, c = CA, C, N+1
+            basis = self.basis[:n]
+            torch.sub(coords[:-1, 3], coords[:-1, 2], out=basis[:, 0])
+            torch.sub(coords[:-1, 2], coords[:-1, 1], out=self.ba[:n])
+            torch.linalg.cross(basis[:, 0], self.ba[:n], out=basis[:, 2])
+            torch.linalg.cross(basis[:, 2], basis[:, 0], out=basis[:, 1])
+            basis.div_(torch.linalg.vector_norm(basis, dim=-1, keepdim=True, out=self.norms[:n]))
+            # get rotation matrices from origins
+            rotations = torch.matmul(self.mat_origin_t, basis, out=self.rotations[0, :n])
+            rotations.div_(torch.linalg.vector_norm(rotations, dim=-1, keepdim=True,
+                                                    out=self.norms[:n]))
+            rotations = self.chain_rotations(n, scan=scan)
+            # rotate all
+            coords[1:, :4] = torch.matmul(coords[1:, :4], rotations, out=self.backbone[:n])
+            # offset each position by cumulative sum at that position
+            coords[1:, :4] += torch.cumsum(coords[:-1, 3], dim=0, out=self.offsets[:n]).unsqueeze(-2)
+
+        # parallel sidechain - do the oxygen, c-beta and side chain
+        self.sidechain_fold(coords, cloud_mask, point_ref_mask, angles_mask, bond_mask, 
+                            validate="off")
+        return coords, cloud_mask
+
+
+# workspaces keyed by (max_len, dtype, device)
+WORKSPACES = {}
+
+def get_workspace(max_len, dtype=None, device=None):
+    """ Returns a shared `FoldWorkspace` for (max_len, dtype, device),
+        creating it if needed.
+    """
+    dtype  = torch.get_default_dtype() if dtype is None else dtype
+    device = torch.device("cpu") if device is None else torch.device(device)
+    key = (max_len, dtype, device)
+    if key not in WORKSPACES:
+        WORKSPACES[key] = FoldWorkspace(max_len, dtype=dtype, device=device)
+    return WORKSPACES[key]
@@ -0,0 +1,50 @@
+# CPU memory of backpropagating through protein_fold with and without
+# activation checkpointing (checkpoint=True / int levels per group).
+# run: python notebooks/benchmarks/benchmark_checkpoint_memory.py (no install needed, see benchmark_utils)
+
+import timeit
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+from benchmark_utils import *
+import mp_nerf
+from mp_nerf.proteins import *
+
+
+def memory_trace(fn):
+    """ Runs `fn` under the profiler and replays its cpu allocations / frees.
+        Outputs: bytes still allocated when `fn` returns and peak bytes while running
+    """
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    current, peak = 0, 0
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return current, peak
+
+
+if __name__ == "__main__":
+    lengths = [100, 250, 500, 1000, 2000]
+    configs = [False, True, 2]
+
+    for length in lengths:
+        seq, angles, scaffolds = random_scaffolds(length)
+        angles.requires_grad_()
+
+        for checkpoint in configs:
+            def forward():
+                # scaffolds depend on the angles, so they're part of the graph
+                scaffolds["angles_mask"] = build_scaffolds_from_scn_angles(seq, angles)["angles_mask"]
+                return protein_fold(**scaffolds, checkpoint=checkpoint)[0]
+
+            # memory held for backward: what the forward leaves allocated
+            outs = []
+            held, _ = memory_trace(lambda: outs.append(forward()))
+            del outs
+            # peak over a full forward + backward
+            _, peak = memory_trace(lambda: forward().sum().backward())
+            t = timeit.timeit(lambda: forward().sum().backward(), number=3) / 3
+            print(f"length {length:5d} | checkpoint={str(checkpoint):5s} | "
+                  f"held after fwd {held / 2**20:7.2f} MB | fwd+bwd peak {peak / 2**20:7.2f} MB | "
+                  f"fwd+bwd {t*1e3:8.2f} ms")
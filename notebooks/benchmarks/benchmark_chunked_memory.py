@@ -0,0 +1,29 @@
+# Peak CPU memory and latency of protein_fold (inference) with and without
+# chunked folding (chunk_size=N), streaming into a preallocated output.
+# run: python notebooks/benchmarks/benchmark_chunked_memory.py (no install needed, see benchmark_utils)
+
+import timeit
+
+import torch
+from benchmark_utils import *
+import mp_nerf
+from mp_nerf.proteins import *
+from benchmark_checkpoint_memory import memory_trace
+
+
+if __name__ == "__main__":
+    lengths = [1000, 5000, 20000]
+    configs = [None, 256, 1024]
+
+    for length in lengths:
+        seq, angles, scaffolds = random_scaffolds(length)
+        out = torch.empty(length, 14, 3)
+
+        with torch.no_grad():
+            for chunk_size in configs:
+                run = lambda: protein_fold(**scaffolds, out=out, chunk_size=chunk_size)
+                run() # warmup
+                _, peak = memory_trace(run)
+                t = timeit.timeit(run, number=3) / 3
+                print(f"length {length:6d} | chunk_size={str(chunk_size):5s} | "
+                      f"peak {peak / 2**20:8.2f} MB | {t*1e3:8.2f} ms")
@@ -0,0 +1,39 @@
+# Latency of the eager, scripted and compiled folding kernels (cpu).
+# run: python notebooks/benchmarks/benchmark_compile.py (no install needed, see benchmark_utils)
+
+import timeit
+
+import torch
+from benchmark_utils import *
+import mp_nerf
+from mp_nerf.proteins import *
+
+
+if __name__ == "__main__":
+    lengths = [100, 300, 500, 1000]
+    number  = 50
+
+    scripted = torch.jit.script(protein_fold_static)
+    try: 
+        compiled = torch.compile(protein_fold_static, dynamic=False)
+    except Exception as e: 
+        print("torch.compile not available:", e)
+        compiled = None
+
+    for length in lengths:
+        seq, angles, scaffolds = random_scaffolds(length)
+
+        runs = {"eager": lambda: protein_fold(**scaffolds),
+                "eager static": lambda: protein_fold_static(**scaffolds),
+                "torch.jit.script": lambda: scripted(**scaffolds)}
+        if compiled is not None:
+            runs["torch.compile"] = lambda: compiled(**scaffolds)
+
+        with torch.no_grad():
+            for name, run in runs.items():
+                try:
+                    run() ; run() # warmup
+                    t = timeit.timeit(run, number=number) / number
+                    print(f"length {length:5d} | {name:16s} | {t*1e3:7.2f} ms")
+                except Exception as e:
+                    print(f"length {length:5d} | {name:16s} | failed: {type(e).__name__}")
@@ -0,0 +1,52 @@
+# Peak CPU memory and latency of fape_torch (forward + backward, all-atom frames)
+# storing the frame x atom errors vs recomputing them blockwise (memory_efficient=True).
+# Each run is a fresh process: peak memory is the growth of its max RSS
+# (the profiler doesn't see the allocations inside custom autograd functions).
+# large allocations are mmap-ed so freed blocks don't stay in the RSS (glibc).
+# run: python notebooks/benchmarks/benchmark_fape_memory.py (no install needed, see benchmark_utils)
+
+import sys
+import json
+import timeit
+import resource
+import subprocess
+
+import torch
+from benchmark_utils import *
+import mp_nerf
+from mp_nerf.proteins import *
+from mp_nerf.ml_utils import *
+
+
+LENGTHS = [256, 512, 1024]
+CONFIGS = [{}, {"chunk_size": 64}, {"memory_efficient": True, "chunk_size": 64}]
+
+
+def run(length, config):
+    """ Peak RSS growth (bytes) and time (s) of one forward + backward. """
+    seq, angles, scaffolds = random_scaffolds(length)
+    true_coords = protein_fold(**scaffolds)[0].unsqueeze(0) + 1.
+    true_coords = true_coords * scn_cloud_mask(seq).unsqueeze(-1)
+    pred_coords = (true_coords + torch.randn_like(true_coords)).requires_grad_()
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = timeit.timeit(lambda: fape_torch(pred_coords, true_coords, seq_list=[seq], 
+                                         **config).mean().backward(), number=1)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (after - before) * 1024, t # ru_maxrss in KB (linux)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        print(json.dumps(run(int(sys.argv[1]), json.loads(sys.argv[2]))))
+        sys.exit()
+
+    for length in LENGTHS:
+        for config in CONFIGS:
+            out = subprocess.run([sys.executable, __file__, str(length), json.dumps(config)],
+                                 capture_output=True, text=True, 
+                                 env=benchmark_env(MALLOC_MMAP_THRESHOLD_="65536"))
+            peak, t = json.loads(out.stdout.splitlines()[-1])
+            name = ", ".join(f"{k}={v}" for k, v in config.items()) or "default"
+            print(f"length {length:5d} | {name:40s} | fwd+bwd peak {peak / 2**20:8.2f} MB | "
+                  f"fwd+bwd {t*1e3:9.2f} ms")
@@ -0,0 +1,55 @@
+# Import time of mp_nerf in fresh interpreters (as short-lived workers see it)
+# and cost of the 1st access to the (lazy) KB tables.
+# run: python notebooks/benchmarks/benchmark_import_time.py (no install needed, see benchmark_utils)
+
+import sys
+import subprocess
+import tempfile
+
+import numpy as np
+from benchmark_utils import benchmark_env
+
+
+ACCESS = """
+import time
+from mp_nerf.kb_proteins import SUPREME_TABLES
+t = time.perf_counter()
+len(SUPREME_TABLES)
+print(time.perf_counter() - t)
+"""
+
+
+def import_times(module, env=None):
+    """ Self and cumulative import time (us) of each mp_nerf module. """
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                         capture_output=True, text=True, env=env).stderr
+    times = {}
+    for line in out.splitlines():
+        if "mp_nerf" in line:
+            self_us, cumulative_us, name = [x.strip() for x in line.split(":", 1)[1].split("|")]
+            times[name] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def access_time(env=None):
+    """ Time (s) of the 1st access to SUPREME_TABLES (after the import). """
+    out = subprocess.run([sys.executable, "-c", ACCESS], capture_output=True, text=True, env=env)
+    return float(out.stdout.split()[-1])
+
+
+if __name__ == "__main__":
+    runs = 5
+    with tempfile.TemporaryDirectory() as tmp:
+        # bytecode cached as in a normal install
+        env = benchmark_env(PYTHONPYCACHEPREFIX=tmp)
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        import_times("mp_nerf", env=env) # warmup, writes the bytecode
+
+        times = [import_times("mp_nerf", env=env) for _ in range(runs)]
+        for name in times[0]:
+            self_us = np.median([t[name][0] for t in times])
+            cumulative_us = np.median([t[name][1] for t in times])
+            print(f"{name:24s} | self {self_us/1e3:8.2f} ms | cumulative {cumulative_us/1e3:8.2f} ms")
+
+        t = np.median([access_time(env=env) for _ in range(runs)])
+        print(f"1st SUPREME_TABLES access | {t*1e3:7.2f} ms")
@@ -0,0 +1,29 @@
+# Latency of refolding from scratch vs updating an IncrementalFold
+# after changing the torsions of a single residue (cpu, inference).
+# run: python notebooks/benchmarks/benchmark_incremental.py (no install needed, see benchmark_utils)
+
+import timeit
+
+import torch
+from benchmark_utils import *
+import mp_nerf
+from mp_nerf.proteins import *
+from mp_nerf.incremental import *
+
+
+if __name__ == "__main__":
+    lengths = [100, 500, 2000, 10000]
+    number  = 50
+
+    for length in lengths:
+        seq, angles, scaffolds = random_scaffolds(length)
+        folded = IncrementalFold(**scaffolds)
+        residue = length // 2
+        new_angles = scaffolds["angles_mask"][:, residue]
+
+        with torch.no_grad():
+            full = timeit.timeit(lambda: protein_fold(**scaffolds), number=number) / number
+            incremental = timeit.timeit(lambda: folded.update(residue, new_angles),
+                                        number=number) / number
+        print(f"length {length:6d} | protein_fold {full*1e3:8.2f} ms | "
+              f"IncrementalFold.update {incremental*1e3:6.2f} ms | x{full / incremental:5.1f}")
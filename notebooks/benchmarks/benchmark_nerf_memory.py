@@ -0,0 +1,41 @@
+# Activation memory kept by autograd when backpropagating through protein_fold,
+# with and without the custom backward of `MpNerfFunction` (memory_efficient=True).
+# run: python notebooks/benchmarks/benchmark_nerf_memory.py (no install needed, see benchmark_utils)
+
+import timeit
+
+import torch
+from benchmark_utils import *
+import mp_nerf
+from mp_nerf.proteins import *
+
+
+def saved_bytes(fn):
+    """ Returns the bytes of the (unique) tensors saved for backward by `fn`. """
+    storages = {}
+    def pack(x):
+        storages[x.untyped_storage().data_ptr()] = x.untyped_storage().nbytes()
+        return x
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        out = fn()
+    return sum(storages.values()), out
+
+
+if __name__ == "__main__":
+    lengths = [100, 250, 500, 1000, 2000]
+
+    for length in lengths:
+        seq, angles = random_protein(length)
+        angles.requires_grad_()
+
+        for memory_efficient in [False, True]:
+            scaffolds = build_scaffolds_from_scn_angles(seq, angles)
+            fold = lambda: protein_fold(**scaffolds, memory_efficient=memory_efficient)[0]
+            nbytes, coords = saved_bytes(fold)
+
+            def run():
+                scaffolds = build_scaffolds_from_scn_angles(seq, angles)
+                protein_fold(**scaffolds, memory_efficient=memory_efficient)[0].sum().backward()
+            t = timeit.timeit(run, number=5) / 5
+            print(f"length {length:5d} | memory_efficient={str(memory_efficient):5s} | "
+                  f"saved for backward {nbytes / 2**20:7.2f} MB | fwd+bwd {t*1e3:7.2f} ms")
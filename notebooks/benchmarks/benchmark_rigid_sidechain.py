@@ -0,0 +1,33 @@
+# Latency of placing the sidechains with NeRF (one level per DAG depth) and
+# with rigid groups (one frame composition per free torsion), as in a rotamer
+# search: same sequence and backbone, new torsions every call (cpu).
+# run: python notebooks/benchmarks/benchmark_rigid_sidechain.py (no install needed, see benchmark_utils)
+
+import timeit
+
+import torch
+from benchmark_utils import *
+import mp_nerf
+from mp_nerf.proteins import *
+
+
+if __name__ == "__main__":
+    lengths = [100, 300, 500, 1000]
+    number  = 50
+
+    for length in lengths:
+        seq, angles, scaffolds = random_scaffolds(length)
+        coords, _ = protein_fold(**scaffolds)
+        # indexes only depend on the sequence, so they're computed once
+        level_idxs = sidechain_dag_idxs(scaffolds["cloud_mask"], scaffolds["point_ref_mask"])
+        rigid_idxs = sidechain_rigid_idxs(seq, dtype=coords.dtype)
+
+        runs = {"nerf": lambda: sidechain_fold(coords, **scaffolds, c_beta=True,
+                                               level_idxs=level_idxs),
+                "rigid groups": lambda: sidechain_fold_rigid(coords, seq, scaffolds["angles_mask"],
+                                                             rigid_idxs=rigid_idxs)}
+        with torch.no_grad():
+            for name, run in runs.items():
+                run() ; run() # warmup
+                t = timeit.timeit(run, number=number) / number
+                print(f"length {length:5d} | {name:12s} | {t*1e3:7.2f} ms")
@@ -0,0 +1,33 @@
+# Shared setup of the benchmarks. Importing it makes the repo importable, so the
+# scripts run as files without installing the package:
+# python notebooks/benchmarks/<benchmark>.py (from any directory)
+
+import os
+import sys
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+import torch
+from mp_nerf.proteins import build_scaffolds_from_scn_angles
+
+
+SEQ_BASE = "AGHHKLHRTVNMSTILWYFDEPQC"
+
+
+def random_protein(length):
+    """ Sequence of `length` residues (repeats of SEQ_BASE) and random angles in (-3, 3). """
+    seq = (SEQ_BASE * (length // len(SEQ_BASE) + 1))[:length]
+    return seq, (torch.rand(length, 12) * 2 - 1) * 3.
+
+
+def random_scaffolds(length):
+    """ `random_protein` and its scaffolds. """
+    seq, angles = random_protein(length)
+    return seq, angles, build_scaffolds_from_scn_angles(seq, angles)
+
+
+def benchmark_env(**kwargs):
+    """ Environment for the benchmark subprocesses, with the repo importable. """
+    return {**os.environ, "PYTHONPATH": REPO_ROOT, **kwargs}
@@ -1,3 +1,6 @@
+import os
+import sys
+import subprocess
 import numpy as np
 import torch
 
@@ -6,6 +9,28 @@ from mp_nerf.utils import *
 from mp_nerf.kb_proteins import *
 from mp_nerf.proteins import *
 
+
+def random_angles(length, seed=0):
+    """ Seeded random angles in (-3, 3), with realistic bond angles 
+        so long chains stay well conditioned.
+    """
+    angles = (torch.rand(length, 12, generator=torch.Generator().manual_seed(seed)) * 2 - 1) * 3
+    angles[:, 3:6] = torch.tensor([1.94, 2.03, 2.12]) # bond angles
+    return angles
+
+
+def random_protein(length, seed=0):
+    """ Sequence of `length` residues and its `random_angles`. """
+    seq_base = "AGHHKLHRTVNMSTILWYFDEPQC"
+    seq = (seq_base * (length // len(seq_base) + 1))[:length]
+    return seq, random_angles(length, seed=seed)
+
+
+def random_scaffolds(length, seed=0, dtype=torch.float32):
+    """ Scaffolds of `random_protein`. """
+    seq, angles = random_protein(length, seed=seed)
+    return build_scaffolds_from_scn_angles(seq, angles.to(dtype))
+
 def test_nerf_and_dihedral():
     # create points
     a = torch.tensor([1,2,3]).float()
@@ -42,4 +67,407 @@ def test_modify_angles_mask_with_torsions():
     torsions = torch.ones(16, 4)
     # ensure shape
     assert modify_angles_mask_with_torsions(seq, angles_mask, torsions).shape == angles_mask.shape, \
-           "Shapes don't match"
\ No newline at end of file
+           "Shapes don't match"
+
+
+def test_protein_fold_batch():
+    # create inputs
+    seqs = ["AGHHKLHRTVNMSTIL", "WERTQLIT"]
+    scaffolds_list = [build_scaffolds_from_scn_angles(seq, torch.randn(len(seq), 12).double().clamp(-3, 3))
+                      for seq in seqs]
+    batch = stack_scaffolds(scaffolds_list)
+    coords, cloud_mask = protein_fold_batch(**batch)
+    # ensure shape and same results as folding one by one
+    assert coords.shape == torch.Size([2, 16, 14, 3]), "Shapes don't match"
+    for i, scaffolds in enumerate(scaffolds_list):
+        single, _ = protein_fold(**scaffolds)
+        assert torch.allclose(coords[i, :len(seqs[i])], single, atol=1e-8)
+    assert (coords[1, len(seqs[1]):] == 0).all()
+
+
+def test_protein_fold_scan():
+    seq = "AGHHKLHRTVNMSTIL" * 4
+    scaffolds = build_scaffolds_from_scn_angles(seq, torch.randn(len(seq), 12).double().clamp(-3, 3))
+    coords_loop, _ = protein_fold(**scaffolds, scan=False)
+    coords_scan, _ = protein_fold(**scaffolds, scan=True)
+    assert torch.allclose(coords_loop, coords_scan, atol=1e-8)
+
+
+def test_validation_policy():
+    seq = "AGHHKLHRTVNMSTIL"
+    scaffolds = build_scaffolds_from_scn_angles(seq, torch.randn(len(seq), 12).clamp(-3, 3))
+    scaffolds["angles_mask"][0, 3, 5] = 4.
+    try:
+        protein_fold(**scaffolds)
+        assert False, "out of range thetas should raise in strict mode"
+    except ValueError:
+        pass
+    # per-call policy
+    coords, _ = protein_fold(**scaffolds, validate="off")
+    assert coords.shape == torch.Size([16, 14, 3])
+    # global policy
+    set_validation_policy("off")
+    coords_global, _ = protein_fold(**scaffolds, level_idxs=sidechain_level_idxs(scaffolds["cloud_mask"]))
+    set_validation_policy("strict")
+    assert torch.allclose(coords, coords_global)
+
+
+def test_protein_fold_numpy():
+    seq = "AGHHKLHRTVNMSTIL"
+    scaffolds = build_scaffolds_from_scn_angles(seq, torch.randn(len(seq), 12).double().clamp(-3, 3))
+    coords_torch, _ = protein_fold(**scaffolds)
+    coords_numpy, _ = protein_fold_numpy(**scaffolds)
+    assert isinstance(coords_numpy, np.ndarray)
+    assert np.allclose(coords_torch.numpy(), coords_numpy)
+    assert torch.allclose(protein_fold(**scaffolds, backend="numpy")[0], coords_torch)
+
+
+def test_protein_fold_unsupported_options():
+    seq = "AGHHKLHRTVNMSTIL"
+    scaffolds = build_scaffolds_from_scn_angles(seq, torch.randn(len(seq), 12).double().clamp(-3, 3))
+    workspace = get_workspace(32, dtype=torch.float64)
+    for options in [{"backend": "numpy", "orthonormalize": 8}, {"backend": "numpy", "checkpoint": True},
+                    {"workspace": workspace, "backbone_dtype": torch.float64},
+                    {"workspace": workspace, "memory_efficient": True},
+                    {"chunk_size": 4, "checkpoint": True}, {"chunk_size": 4, "scan": True, "hybrid": True},
+                    {"chunk_size": 4, "backend": "numpy"}, {"chunk_size": 4, "workspace": workspace}]:
+        try:
+            protein_fold(**scaffolds, **options)
+            assert False, f"{options} should raise"
+        except ValueError:
+            pass
+    # sidechains. numpy can't backprop
+    coords = protein_fold(**scaffolds)[0]
+    for wrapper, options in [(coords, {"workspace": workspace, "checkpoint": True}),
+                             (coords, {"workspace": workspace, "level_idxs": []}),
+                             (coords, {"backend": "numpy", "memory_efficient": True}),
+                             (coords.clone().requires_grad_(), {"backend": "numpy"})]:
+        try:
+            sidechain_fold(wrapper.clone(), **scaffolds, **options)
+            assert False, f"{options} should raise"
+        except ValueError:
+            pass
+
+
+def test_protein_fold_workspace():
+    seq = "AGHHKLHRTVNMSTIL"
+    # double: float32 rounding differs between the two paths near-degenerate angles
+    scaffolds = build_scaffolds_from_scn_angles(seq, torch.randn(len(seq), 12).double().clamp(-3, 3))
+    coords, _ = protein_fold(**scaffolds)
+    workspace = get_workspace(32, dtype=coords.dtype, device=coords.device)
+    out = torch.zeros_like(coords)
+    with torch.no_grad():
+        for i in range(2):
+            coords_ws, _ = protein_fold(**scaffolds, workspace=workspace, out=out)
+    assert coords_ws is out
+    assert torch.allclose(coords, out, atol=1e-8)
+
+
+def test_protein_fold_static_scripted():
+    seq = "AGHHKLHRTVNMSTIL"
+    scaffolds = build_scaffolds_from_scn_angles(seq, random_angles(len(seq)))
+    coords, _ = protein_fold(**scaffolds)
+    scripted = torch.jit.script(protein_fold_static)
+    coords_scripted, _ = scripted(**scaffolds)
+    assert torch.allclose(coords, coords_scripted, atol=1e-5)
+
+
+def test_mp_nerf_custom_backward():
+    # gradcheck of the hand-derived backward
+    inputs = [torch.randn(5, 3).double().requires_grad_() for _ in range(3)] + \
+             [torch.rand(5).double().add(1.).requires_grad_(),
+              torch.rand(5).double().mul(3.).requires_grad_(),
+              torch.rand(5).double().mul(6.).sub(3.).requires_grad_()]
+    assert torch.autograd.gradcheck(MpNerfFunction.apply, inputs)
+    # same gradients through a whole fold
+    seq = "AGHHKLHRTVNMSTIL"
+    grads = []
+    for memory_efficient in [False, True]:
+        angles = torch.randn(len(seq), 12, generator=torch.Generator().manual_seed(0)).double()
+        angles = angles.clamp(-3, 3).requires_grad_()
+        scaffolds = build_scaffolds_from_scn_angles(seq, angles)
+        coords, _ = protein_fold(**scaffolds, memory_efficient=memory_efficient)
+        coords.sum().backward()
+        grads.append(angles.grad)
+    assert torch.allclose(*grads)
+
+
+def test_protein_fold_checkpoint():
+    seq = "AGHHKLHRTVNMSTILWERTQ"
+    grads, folds = [], []
+    for checkpoint, memory_efficient in [(False, False), (True, False), (2, False), (True, True)]:
+        angles = torch.randn(len(seq), 12, generator=torch.Generator().manual_seed(0)).double()
+        angles = angles.clamp(-3, 3).requires_grad_()
+        scaffolds = build_scaffolds_from_scn_angles(seq, angles)
+        coords, _ = protein_fold(**scaffolds, checkpoint=checkpoint, memory_efficient=memory_efficient)
+        coords.pow(2).sum().backward()
+        folds.append(coords.detach())
+        grads.append(angles.grad)
+    for coords, grad in zip(folds[1:], grads[1:]):
+        assert torch.allclose(folds[0], coords)
+        assert torch.allclose(grads[0], grad)
+
+
+def test_sidechain_dag_idxs():
+    seq = "AGHHKLHRTVNMSTILFY"
+    scaffolds = build_scaffolds_from_scn_angles(seq, random_angles(len(seq)).double())
+    dag_idxs = sidechain_dag_idxs(scaffolds["cloud_mask"], scaffolds["point_ref_mask"])
+    # no Trp: at most 7 sequential levels instead of 11
+    assert len(dag_idxs) == 7
+    coords_dag, _ = protein_fold(**scaffolds, level_idxs=dag_idxs)
+    coords_atom, _ = protein_fold(**scaffolds, level_idxs=sidechain_level_idxs(scaffolds["cloud_mask"]))
+    assert torch.allclose(coords_dag, coords_atom)
+
+
+def test_sidechain_fold_rigid():
+    seq = "ACDEFGHIKLMNPQRSTVWY"
+    scaffolds = build_scaffolds_from_scn_angles(seq, random_angles(len(seq)).double())
+    coords, _ = protein_fold(**scaffolds)
+    # same as NeRF with the KB geometry, with or without placing the c-beta
+    for c_beta in [True, False]:
+        wrapper = coords.clone()
+        wrapper[:, 3:] = 0.
+        if not c_beta:
+            wrapper[:, 4] = coords[:, 4]
+        sidechain_fold_rigid(wrapper, seq, scaffolds["angles_mask"], c_beta=c_beta)
+        assert torch.allclose(wrapper, coords)
+
+
+def test_protein_fold_mixed_precision():
+    # float32 backbones drift along the chain. a float64 backbone keeps the
+    # error at the float32 rounding of the coords, whatever the length
+    for length in [100, 1000, 4000]:
+        scaffolds = random_scaffolds(length)
+        scaffolds_64 = {k: v.double() if v.is_floating_point() else v for k, v in scaffolds.items()}
+        coords_64, _ = protein_fold(**scaffolds_64)
+        coords, _ = protein_fold(**scaffolds, backbone_dtype=torch.float64)
+        assert coords.dtype == torch.float32
+        error = (coords - coords_64).abs()
+        assert error[:, :3].max() <= torch.finfo(torch.float32).eps * coords_64.abs().max()
+        assert error.max() < 1e-3
+
+
+def test_chain_rotations_orthonormalize():
+    scaffolds = random_scaffolds(5000)
+    scaffolds_64 = {k: v.double() if v.is_floating_point() else v for k, v in scaffolds.items()}
+    coords_64, _ = protein_fold(**scaffolds_64)
+    CHAIN_DIAGNOSTICS["enabled"] = True
+    try:
+        for scan in [False, True]:
+            coords, _ = protein_fold(**scaffolds, scan=scan)
+            drift, error = (coords - coords_64).abs().max(), CHAIN_DIAGNOSTICS["orthonormality_error"]
+            coords, _ = protein_fold(**scaffolds, scan=scan, orthonormalize=64)
+            assert (coords - coords_64).abs().max() < drift / 4
+            assert CHAIN_DIAGNOSTICS["orthonormality_error"] < error / 10
+        # chunked folds report the carried global frame, detached from the graph
+        angles_mask = scaffolds["angles_mask"].clone().requires_grad_()
+        protein_fold_chunked(scaffolds["cloud_mask"], scaffolds["point_ref_mask"], angles_mask,
+                             scaffolds["bond_mask"], chunk_size=1024)
+        assert not CHAIN_DIAGNOSTICS["orthonormality_error"].requires_grad
+        assert CHAIN_DIAGNOSTICS["orthonormality_error"] > error / 2
+    finally:
+        CHAIN_DIAGNOSTICS["enabled"] = False
+        CHAIN_DIAGNOSTICS["orthonormality_error"] = None
+
+
+def test_protein_fold_chunked():
+    scaffolds = random_scaffolds(300, dtype=torch.float64)
+    coords, _ = protein_fold(**scaffolds)
+    for chunk_size in [2, 7, 64, 299]:
+        out = torch.empty_like(coords)
+        coords_chunked, _ = protein_fold(**scaffolds, chunk_size=chunk_size, out=out)
+        assert coords_chunked is out
+        assert torch.allclose(coords, coords_chunked)
+
+
+def test_incremental_fold():
+    length = 200
+    seq, angles = random_protein(length)
+    scaffolds = build_scaffolds_from_scn_angles(seq, angles.double())
+    folded = IncrementalFold(**scaffolds)
+    assert torch.allclose(folded.coords, protein_fold(**scaffolds)[0])
+    for residues in [[0], [57], [length-1], [3, 100, 101, 150]]:
+        angles[residues, :3] = (torch.rand(len(residues), 3) * 2 - 1) * 3
+        angles[residues, 6:] = (torch.rand(len(residues), 6) * 2 - 1) * 3
+        new_scaffolds = build_scaffolds_from_scn_angles(seq, angles.double())
+        # a torsion also sets angles of the next residue's fragment
+        changed = (new_scaffolds["angles_mask"] != scaffolds["angles_mask"]).any(0).any(-1)
+        changed = changed.nonzero().view(-1)
+        folded.update(changed, new_scaffolds["angles_mask"][:, changed])
+        scaffolds = new_scaffolds
+        assert torch.allclose(folded.coords, protein_fold(**scaffolds)[0])
+
+
+def test_protein_fold_breaks():
+    seqs = ["AGHHKLHRTVNMSTILWYFDEPQC", "MSTILWYFDEPQCAGHHKLHRTVNMSTILW", "WK"]
+    scaffolds_list, folds = [], []
+    for i, seq in enumerate(seqs):
+        scaffolds_list.append(build_scaffolds_from_scn_angles(seq, random_angles(len(seq), seed=i).double()))
+        folds.append(protein_fold(**scaffolds_list[-1])[0])
+    # concat along the length dim
+    scaffolds = {k: torch.cat([x[k] for x in scaffolds_list], dim=v.dim() - 2)
+                 for k, v in scaffolds_list[0].items()}
+    chain_ids = torch.cat([torch.full((len(seq),), i) for i, seq in enumerate(seqs)])
+    rotations = torch.linalg.qr(torch.randn(len(seqs), 3, 3).double())[0]
+    translations = torch.randn(len(seqs), 3).double() * 10
+    for scan in [False, True]:
+        for breaks in [chain_ids, chain_starts(chain_ids)]:
+            coords, _ = protein_fold(**scaffolds, breaks=breaks, scan=scan)
+            for fold, chain in zip(folds, coords.split([len(seq) for seq in seqs])):
+                assert torch.allclose(fold, chain)
+    coords, cloud_mask = protein_fold(**scaffolds, breaks=chain_ids, 
+                                      break_frames=(rotations, translations))
+    for fold, chain, mask, rot, trans in zip(folds, coords.split([len(seq) for seq in seqs]), 
+                                             cloud_mask.split([len(seq) for seq in seqs]),
+                                             rotations, translations):
+        assert torch.allclose((fold @ rot + trans)[mask], chain[mask])
+
+
+def test_protein_fold_packed():
+    seqs = ["AGHHKLHRTVNMSTILWYFDEPQC", "MSTILWYFDEPQCAGHHKLHRTVNMSTILW", "WK"]
+    scaffolds_list = [build_scaffolds_from_scn_angles(seq, torch.randn(len(seq), 12).double().clamp(-3, 3))
+                      for seq in seqs]
+    packed = pack_scaffolds(scaffolds_list)
+    assert packed["cu_seqlens"].tolist() == [0, 24, 54, 56]
+    coords, cloud_mask = protein_fold_packed(**packed)
+    assert coords.shape == (56, 14, 3)
+    for chain, scaffolds in zip(unpack_tensors(coords, packed["cu_seqlens"]), scaffolds_list):
+        assert torch.allclose(chain, protein_fold(**scaffolds)[0])
+    # same as the padded batch
+    batch = stack_scaffolds(scaffolds_list)
+    padded = unpack_tensors(coords, packed["cu_seqlens"], padding_value=0.)
+    assert torch.allclose(padded, protein_fold_batch(**batch)[0])
+    # 1-residue chains: fine without c-beta, an error with it. packed or padded
+    for seqs in [["GAGHK", "G", "GG", "WK"], ["GAGHK", "A", "GG", "WK"], ["GAGHK", "A"], ["A", "GAGHK"]]:
+        scaffolds_list = [build_scaffolds_from_scn_angles(seq, random_angles(len(seq), seed=i).double())
+                          for i, seq in enumerate(seqs)]
+        for fold, batch in [(protein_fold_packed, pack_scaffolds(scaffolds_list)), 
+                            (protein_fold_batch, stack_scaffolds(scaffolds_list))]:
+            try:
+                assert torch.isfinite(fold(**batch)[0]).all()
+                assert "A" not in seqs, "1-residue chains with c-beta should raise"
+            except ValueError:
+                assert "A" in seqs
+
+
+def test_scn_masks_from_kb_tables():
+    seq = "AGHHKLHRTVNMSTILWYFDEPQC"
+    int_seq = torch.tensor([AAS2INDEX[aa] for aa in seq])
+    # same as the per-residue lookups
+    assert torch.equal(scn_cloud_mask(seq), torch.tensor([SUPREME_INFO[aa]["cloud_mask"] for aa in seq]))
+    assert torch.equal(scn_bond_mask(seq), torch.tensor([SUPREME_INFO[aa]["bond_mask"] for aa in seq]))
+    assert torch.equal(scn_rigid_index_mask(seq), 
+                       torch.cat([torch.tensor(SUPREME_INFO[aa]["rigid_idx_mask"]) + 14*i
+                                  for i, aa in enumerate(seq)], dim=0).t())
+    # int sequences give the same scaffolds
+    for fn in [scn_cloud_mask, scn_bond_mask, scn_index_mask, scn_angle_mask, scn_rigid_index_mask]:
+        assert torch.equal(fn(seq), fn(int_seq))
+    angles = torch.randn(len(seq), 12).clamp(-3, 3)
+    assert torch.equal(scn_angle_mask(seq, angles), scn_angle_mask(int_seq, angles))
+
+
+def test_scaffolds_cache():
+    seqs = ["AGHHKLHRTVNMSTILWYFDEPQC", "MSTILWYFDEPQC", "WK"]
+    reference = [build_scaffolds_from_scn_angles(seq, device="cpu") for seq in seqs]
+    set_scaffolds_cache(maxsize=2)
+    try:
+        clear_scaffolds_cache()
+        for _ in range(2):
+            for seq, ref in zip(seqs[:2], reference):
+                scaffolds = build_scaffolds_from_scn_angles(seq, device="cpu")
+                for k, v in ref.items():
+                    assert torch.equal(scaffolds[k], v)
+                # in-place changes don't reach the cache
+                scaffolds["bond_mask"] += 1.
+        info = scaffolds_cache_info()
+        assert (info["hits"], info["misses"], info["currsize"]) == (2, 2, 2)
+        # dtype is part of the key. lru evicts the 1st seq
+        build_scaffolds_from_scn_angles(seqs[1], torch.randn(len(seqs[1]), 12).double())
+        assert scaffolds_cache_info()["misses"] == 3
+        build_scaffolds_from_scn_angles(seqs[0], device="cpu")
+        assert scaffolds_cache_info()["misses"] == 4
+        # angles still give angle-specific masks
+        angles = torch.randn(len(seqs[2]), 12)
+        assert torch.equal(build_scaffolds_from_scn_angles(seqs[2], angles)["angles_mask"],
+                           scn_angle_mask(seqs[2], angles))
+    finally:
+        set_scaffolds_cache(maxsize=0)
+        clear_scaffolds_cache()
+    assert scaffolds_cache_info()["currsize"] == 0
+
+
+def test_build_scaffolds_batch():
+    seqs = ["AGHHKLHRTVNMSTILWYFDEPQC", "MSTILW", "WK"]
+    angles = [torch.randn(len(seq), 12).double().clamp(-3, 3) for seq in seqs]
+    # padded tokens and angles
+    int_seq = torch.full((len(seqs), len(seqs[0])), AAS2INDEX["_"])
+    batch_angles = torch.zeros(len(seqs), len(seqs[0]), 12).double()
+    for i, (seq, angle) in enumerate(zip(seqs, angles)):
+        int_seq[i, :len(seq)], batch_angles[i, :len(seq)] = scn_seq_idxs(seq), angle
+    # same as stacking the scaffolds of each protein
+    batch = build_scaffolds_from_scn_angles_batch(int_seq, batch_angles)
+    reference = stack_scaffolds([build_scaffolds_from_scn_angles(seq, angle)
+                                 for seq, angle in zip(seqs, angles)])
+    for key, value in reference.items():
+        assert torch.equal(batch[key], value)
+    batch = build_scaffolds_from_scn_angles_batch(int_seq)
+    reference = stack_scaffolds([build_scaffolds_from_scn_angles(seq, device="cpu") for seq in seqs])
+    for key, value in reference.items():
+        assert torch.equal(batch[key], value)
+
+
+def test_modify_scaffolds_with_coords_batch():
+    seqs = ["AGHHKLHRTVNMSTILWYFDEPQC", "MSTILW", "WK"]
+    scaffolds_list, coords_list = [], []
+    for seq in seqs:
+        # thetas in (0, pi) so the measured angles are the same ones
+        angles = torch.rand(len(seq), 12).double() * 6 - 3
+        angles[:, 3:6] = 1.9 + 0.2 * torch.rand(len(seq), 3).double()
+        coords_list.append( protein_fold(**build_scaffolds_from_scn_angles(seq, angles))[0] )
+        # thetas not overwritten by the coords (ex. last ca_c_n) must stay in radians
+        scaffolds_list.append( build_scaffolds_from_scn_angles(seq, torch.randn(len(seq), 12).double().clamp(-3, 3)) )
+    # internals from the coords refold into the same coords 
+    # (but the sidechain of the 1st residue: its c-beta is measured from the next N)
+    coords = unpack_tensors(*pack_tensors(coords_list), padding_value=0.)
+    batch = modify_scaffolds_with_coords_batch(stack_scaffolds(scaffolds_list), coords)
+    refolded = protein_fold_batch(**batch)[0]
+    refolded[:, 0, 4:], coords[:, 0, 4:] = 0., 0.
+    assert torch.allclose(refolded, coords, atol=1e-6)
+    # same as one protein at a time
+    for i, (scaffolds, coords) in enumerate(zip(scaffolds_list, coords_list)):
+        single = modify_scaffolds_with_coords(scaffolds, coords)
+        assert torch.allclose(single["bond_mask"], batch["bond_mask"][i, :len(coords)])
+        assert torch.allclose(single["angles_mask"], batch["angles_mask"][i, :, :len(coords)])
+
+
+def test_scn_cloud_mask_strict():
+    seq = "AGHHKLHRTVNMSTILWYFDEPQC"
+    scaffolds = build_scaffolds_from_scn_angles(seq, torch.randn(len(seq), 12).clamp(-3, 3))
+    coords = protein_fold(**scaffolds)[0] + 1.
+    coords = (coords * scaffolds["cloud_mask"].unsqueeze(-1)).unsqueeze(0).repeat(2, 1, 1, 1)
+    coords[0, 3, 5] = 0.
+    coords[1, 7, 1] = 0.
+    coords = coords.reshape(2, -1, 3)
+    # the points after a missing one are missing too
+    expected = scn_cloud_mask(seq, coords=coords)
+    expected[0, 3, 5:] = 0.
+    expected[1, 7, 1:] = 0.
+    assert torch.equal(scn_cloud_mask(seq, coords=coords, strict=True), expected)
+
+
+LAZY_TABLES_CHECK = """
+import mp_nerf.kb_proteins as kb
+assert kb.SUPREME_INFO.data is None and kb.SUPREME_TABLES.data is None
+builds = []
+builder = kb.SUPREME_INFO.builder
+kb.SUPREME_INFO.builder = lambda: builds.append(1) or builder()
+kb.SUPREME_TABLES["cloud_mask"], kb.SUPREME_INFO["A"], dict(kb.SUPREME_INFO)
+assert len(builds) == 1
+"""
+
+def test_lazy_tables():
+    # a fresh interpreter: the tables of this one are already built
+    subprocess.run([sys.executable, "-c", LAZY_TABLES_CHECK], check=True,
+                   env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+    # read-only
+    assert isinstance(SUPREME_INFO, LazyTable) and not hasattr(SUPREME_INFO, "__setitem__")
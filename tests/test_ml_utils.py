@@ -33,6 +33,16 @@ def test_rename_symmetric_atoms():
     assert renamed[0].shape == pred_coors.shape and renamed[1].shape == pred_feats.shape, "Shapes don't match"
 
 
+def test_atom_selector_int_seq(): 
+    seq_list = ["AGHHKLHRTVNMSTIL", "WERTQLITANMWTCSD"]
+    int_seq = torch.stack([scn_seq_idxs(seq) for seq in seq_list], dim=0)
+    x = torch.randn(2, 16*14, 3)
+    for option in ["backbone", "backbone-with-cbeta", "all"]:
+        selected, mask = atom_selector(int_seq, x, option=option, discard_absent=False)
+        selected_str, mask_str = atom_selector(seq_list, x, option=option, discard_absent=False)
+        assert torch.equal(mask, mask_str) and torch.equal(selected, selected_str)
+
+
 def test_torsion_angle_loss():
     pred_torsions = torch.randn(1, 100, 7)
     true_torsions = torch.randn(1, 100, 7)
@@ -56,3 +66,83 @@ def test_fape_loss_torch():
 
 
 
+
+
+def test_fape_loss_torch_packed():
+    seq_list = ["AGHHKLHRTVNMSTIL", "WERTQLITANM", "AGHHKLHRTVNMSTIL"]
+    pred_coords = [torch.randn(len(seq), 14, 3) for seq in seq_list]
+    true_coords = [torch.randn(len(seq), 14, 3) for seq in seq_list]
+    packed_pred, cu_seqlens = pack_tensors(pred_coords)
+    packed_true, _ = pack_tensors(true_coords)
+
+    loss = fape_torch(packed_pred, packed_true, seq_list=seq_list, cu_seqlens=cu_seqlens)
+    losses = [fape_torch(pred.unsqueeze(0), true.unsqueeze(0), seq_list=[seq])[0]
+              for pred, true, seq in zip(pred_coords, true_coords, seq_list)]
+    assert torch.allclose(loss, torch.cat(losses, dim=0))
+
+
+def test_fape_loss_torch_padded():
+    seq_list = ["AGHHKLHRTVNMSTIL", "WERTQLITANM"]
+    pred_coords = torch.randn(2, 16, 14, 3)
+    true_coords = torch.randn(2, 16, 14, 3)
+    true_coords[1, len(seq_list[1]):] = 0.
+    loss = fape_torch(pred_coords, true_coords, seq_list=seq_list)
+    # same as one structure at a time, 0 at the padding
+    for b, seq in enumerate(seq_list):
+        n_points = (true_coords[b].abs().sum(dim=-1) != 0).sum()
+        single = fape_torch(pred_coords[b:b+1, :len(seq)], true_coords[b:b+1, :len(seq)], seq_list=[seq])
+        assert torch.allclose(loss[b, :n_points], single[0])
+        assert (loss[b, n_points:] == 0).all()
+
+
+def test_fape_loss_torch_batch():
+    pred_points = torch.randn(2, 30, 3)
+    true_points = torch.randn(2, 30, 3)
+    rot_mats = get_axis_matrix(*torch.randn(3, 2, 12, 3), norm=True)
+    point_mask = torch.arange(30) < torch.tensor([[30], [21]])
+    frame_mask = torch.arange(12) < torch.tensor([[12], [7]])
+    fape = fape_torch_batch(pred_points, true_points, rot_mats, 
+                            point_mask=point_mask, frame_mask=frame_mask)
+    # same as one frame at a time, without the padding
+    for b, (n, f) in enumerate([(30, 12), (21, 7)]):
+        expected = sum(((pred_points[b, :n] @ rot_mat - true_points[b, :n]).norm(dim=-1)).clamp(0, 10.)
+                       for rot_mat in rot_mats[b, :f]) / (10. * f)
+        assert torch.allclose(fape[b, :n], expected, atol=1e-5)
+        assert (fape[b, n:] == 0).all()
+    # chunking only bounds the memory
+    assert torch.allclose(fape, fape_torch_batch(pred_points, true_points, rot_mats, point_mask=point_mask, 
+                                                 frame_mask=frame_mask, chunk_size=5))
+
+
+def test_fape_loss_torch_memory_efficient():
+    seq_list = ["AGHHKLHRTVNMSTIL"] * 2
+    true_coords = torch.stack([scn_cloud_mask(seq).unsqueeze(-1) * torch.randn(16, 14, 3) 
+                               for seq in seq_list]).double()
+    pred_coords = (true_coords + torch.randn_like(true_coords)).requires_grad_()
+    for c_alpha in [True, False]:
+        loss = fape_torch(pred_coords, true_coords, seq_list=seq_list, c_alpha=c_alpha, max_val=2.)
+        loss_me = fape_torch(pred_coords, true_coords, seq_list=seq_list, c_alpha=c_alpha, max_val=2., 
+                             memory_efficient=True, chunk_size=7)
+        assert torch.allclose(loss, loss_me)
+        grad, = torch.autograd.grad(loss.sum(), pred_coords)
+        grad_me, = torch.autograd.grad(loss_me.sum(), pred_coords)
+        assert torch.allclose(grad, grad_me)
+    # gradients of the frames too
+    pred_points, true_points = torch.randn(2, 2, 20, 3).double()
+    rot_mats = get_axis_matrix(*torch.randn(3, 2, 6, 3), norm=True).double().requires_grad_()
+    fn = lambda x, rots: fape_torch_batch(x, true_points, rots, max_val=2., memory_efficient=True, chunk_size=4)
+    assert torch.autograd.gradcheck(fn, (pred_points.requires_grad_(), rot_mats))
+
+
+def test_combine_noise_device():
+    seq = "AGHHKLHRTVNMSTIL"
+    angles = torch.randn(len(seq), 12, generator=torch.Generator().manual_seed(0)).clamp(-3, 3)
+    scaffolds = build_scaffolds_from_scn_angles(seq, angles)
+    # shifted so no present atom is at the origin (taken as missing)
+    coords = (protein_fold(**scaffolds)[0] + 1.) * scaffolds["cloud_mask"].unsqueeze(-1)
+    devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+    for device in devices:
+        true_coords = coords.reshape(-1, 3).to(device)
+        noised_coords, cloud_mask = combine_noise(true_coords, seq=seq)
+        assert noised_coords.device == true_coords.device
+        assert noised_coords.shape == (1, len(seq) * 14, 3)